@@ -1,23 +1,63 @@
-
 from pathlib import Path
 
+import argparse
+import gzip
+import hashlib
+import json
+import logging
 import os
 import platform
-import sys
+import re
+import shutil
 import subprocess
+import sys
+import time
 import zipfile
 import urllib.request
 
-WORKAREA = Path(__file__).resolve().parent
-TWEEGO = "tweego"
+from html.parser import HTMLParser
 
-# Check if Tweego is in the system's PATH
-def is_tweego_in_path():
-	try:
-		subprocess.run([TWEEGO, "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-		return True
-	except FileNotFoundError:
-		return False
+from tools import twee
+
+# optional - only used by --optimize, which skips whatever is not installed
+try:
+	import rjsmin
+except ImportError:
+	rjsmin = None
+try:
+	import rcssmin
+except ImportError:
+	rcssmin = None
+try:
+	from fontTools import subset as font_subset
+	from fontTools.ttLib import TTFont
+except ImportError:
+	font_subset = None
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+WORKAREA = Path(__file__).resolve().parent
+TWEEGO = os.environ.get("TWEEGO", "tweego")
+TWEEGO_VERSION = "2.1.1"
+SUGARCUBE_VERSION = "2.37.0"
+OUTPUT = "AbyssDiver.html"
+BUILD_MANIFEST = WORKAREA / "tools" / "build-manifest.json"
+WATCH_INTERVAL = 0.5
+WATCH_DEBOUNCE = 0.3
+STAGING_DIRECTORY = WORKAREA / "tools" / "build" / "staging"
+BUNDLE_DIRECTORY = WORKAREA / "bundles"
+BUNDLE_LOADER_TEMPLATE = WORKAREA / "tools" / "lazy-bundle-loader.js"
+# source files whose passages are only loaded once the player gets to them
+LAZY_SOURCES = [f"layer{layer}.twee" for layer in range(1, 10)] + ["companionConversations.twee", "relics.twee"]
+LAZY_LOADING_PASSAGE = "Lazy Bundle Loading"
+EAGER_TAGS = {"init", "script", "stylesheet", "widget", "Twine.image", "Twine.audio", "Twine.video", "Twine.vtt"}
+REPORT_LARGEST_PASSAGES = 25
+REPORT_PARSE_RUNS = 3
+STATIC_INCLUDE = re.compile(r'<<include\s+(?:"([^"]+)"|\'([^\']+)\'|\[\[([^\]|]+)\]\])')
+DYNAMIC_INCLUDE = re.compile(r'<<include\s+`([^`]+)`|Story\.get\(([^()]*(?:\([^()]*\)[^()]*)*)\)')
+FONT_FACE_URL = re.compile(r'url\(\s*["\']?([^"\')]+\.(?:ttf|otf))["\']?\s*\)\s*format\(\s*["\'](?:truetype|opentype)["\']\s*\)')
 
 # Determine processor architecture
 def get_architecture():
@@ -37,57 +77,553 @@ def extract_zip(src, dest):
 	with zipfile.ZipFile(src, 'r') as zip_ref:
 		zip_ref.extractall(dest)
 
-if not is_tweego_in_path():
-	TWEEGO_VERSION = "2.1.1"
-	TWEEGO_OS = platform.system().lower()
-	TWEEGO_ARCH = get_architecture()
+def load_manifest():
+	try:
+		with open(BUILD_MANIFEST, "r") as file:
+			return json.load(file)
+	except (OSError, ValueError):
+		return {}
+
+def save_manifest(manifest):
+	BUILD_MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+	temp_path = BUILD_MANIFEST.with_suffix(".tmp")
+	with open(temp_path, "w") as file:
+		json.dump(manifest, file, indent=1)
+	os.replace(temp_path, BUILD_MANIFEST)
+
+def file_signature(path):
+	stat = path.stat()
+	return [stat.st_size, stat.st_mtime_ns]
 
-	if TWEEGO_OS == "darwin":
-		TWEEGO_OS = "macos"
+# Find Tweego and its version, caching `tweego --version` on the executable's size and mtime
+def resolve_tweego(manifest):
+	cache = manifest.setdefault("tweego", {})
+	found = shutil.which(str(TWEEGO))
+	if found is not None:
+		signature = [found] + file_signature(Path(found))
+		if cache.get("signature") == signature:
+			print(f"Using systemwide Tweego: {found}")
+			return found, cache["version"]
+		try:
+			result = subprocess.run([found, "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, text=True)
+			version = (result.stdout or result.stderr).strip().splitlines()[0]
+			cache.update({"signature" : signature, "version" : version})
+			print(f"Using systemwide Tweego: {found}")
+			return found, version
+		except (OSError, subprocess.CalledProcessError, IndexError):
+			pass
 
-	print(f"TWEEGO_VERSION: {TWEEGO_VERSION}")
-	print(f"TWEEGO_OS: {TWEEGO_OS}")
-	print(f"TWEEGO_ARCH: {TWEEGO_ARCH}")
+	tweego_os = platform.system().lower()
+	tweego_arch = get_architecture()
 
-	TWEEGO_ARCHIVE = f"tweego-{TWEEGO_VERSION}-{TWEEGO_OS}-{TWEEGO_ARCH}.zip"
-	tweego_archive_path = WORKAREA / "tools" / TWEEGO_ARCHIVE
+	if tweego_os == "darwin":
+		tweego_os = "macos"
+
+	tweego_archive = f"tweego-{TWEEGO_VERSION}-{tweego_os}-{tweego_arch}.zip"
+	tweego_archive_path = WORKAREA / "tools" / tweego_archive
 
 	if not tweego_archive_path.exists():
-		download_url = f"https://github.com/tmedwards/tweego/releases/download/v{TWEEGO_VERSION}/{TWEEGO_ARCHIVE}"
+		print(f"TWEEGO_VERSION: {TWEEGO_VERSION}")
+		print(f"TWEEGO_OS: {tweego_os}")
+		print(f"TWEEGO_ARCH: {tweego_arch}")
+
+		download_url = f"https://github.com/tmedwards/tweego/releases/download/v{TWEEGO_VERSION}/{tweego_archive}"
 		download_file(download_url, tweego_archive_path)
 
 		extract_zip(tweego_archive_path, WORKAREA / "tools")
 
-	TWEEGO = WORKAREA / "tools" / "tweego"
-	print(f"Using downloaded Tweego: {TWEEGO}")
-else:
-	print(f"Using systemwide Tweego: {TWEEGO}")
+	print(f"Using downloaded Tweego: {WORKAREA / 'tools' / 'tweego'}")
+	return str(WORKAREA / "tools" / "tweego"), tweego_archive
 
-SUGARCUBE_VERSION = "2.37.0"
-SUGARCUBE_ARCHIVE = f"sugarcube-{SUGARCUBE_VERSION}-for-twine-2.1-local.zip"
-sugarcube_archive_path = WORKAREA / "storyformats" / SUGARCUBE_ARCHIVE
+def ensure_sugarcube():
+	sugarcube_archive = f"sugarcube-{SUGARCUBE_VERSION}-for-twine-2.1-local.zip"
+	sugarcube_archive_path = WORKAREA / "storyformats" / sugarcube_archive
 
-if not sugarcube_archive_path.exists():
-	sugarcube_url = f"https://github.com/tmedwards/sugarcube-2/releases/download/v{SUGARCUBE_VERSION}/{SUGARCUBE_ARCHIVE}"
-	download_file(sugarcube_url, sugarcube_archive_path)
+	if not sugarcube_archive_path.exists():
+		sugarcube_url = f"https://github.com/tmedwards/sugarcube-2/releases/download/v{SUGARCUBE_VERSION}/{sugarcube_archive}"
+		download_file(sugarcube_url, sugarcube_archive_path)
 
-	extract_zip(sugarcube_archive_path, WORKAREA / "storyformats")
+		extract_zip(sugarcube_archive_path, WORKAREA / "storyformats")
 
-OUTPUT = "AbyssDiver.html"
-print(f"Compiling to: {OUTPUT}")
-TWEEGO_PATH = WORKAREA / "storyformats"
-src_dir = WORKAREA / "src"
-dependencies_dir = WORKAREA / "dependencies"
+def source_directories():
+	return [WORKAREA / "src", WORKAREA / "dependencies"]
+
+def source_files():
+	files = []
+	for directory in source_directories():
+		files.extend(path for path in directory.rglob("*") if path.is_file())
+	return sorted(files)
+
+# Hash every input file, only re-reading those whose size or mtime changed since the last build
+def hash_inputs(manifest, extra):
+	cache = manifest.get("files", {})
+	files = {}
+	digest = hashlib.sha256(json.dumps(extra, sort_keys=True).encode("utf-8"))
+	for path in source_files():
+		key = path.relative_to(WORKAREA).as_posix()
+		signature = file_signature(path)
+		cached = cache.get(key)
+		if cached is not None and cached[:2] == signature:
+			file_hash = cached[2]
+		else:
+			file_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+		files[key] = signature + [file_hash]
+		digest.update(key.encode("utf-8"))
+		digest.update(file_hash.encode("utf-8"))
+	manifest["files"] = files
+	return digest.hexdigest()
+
+def compile_story(tweego, additional_args, directories=None):
+	command = [
+		str(tweego),
+		*[str(directory) for directory in directories or source_directories()],
+		"-o", OUTPUT
+	] + additional_args
+
+	env = dict(os.environ, TWEEGO_PATH=str(WORKAREA / "storyformats"))
+	subprocess.run(command, check=True, env=env)
+
+def optimizers():
+	return {
+		"js" : rjsmin is not None,
+		"css" : rcssmin is not None,
+		"fonts" : font_subset is not None,
+		"brotli" : brotli is not None
+	}
+
+def print_missing_optimizers():
+	missing = {
+		"js" : "rjsmin (JS minification)",
+		"css" : "rcssmin (CSS minification)",
+		"fonts" : "fonttools (font subsetting)",
+		"brotli" : "brotli (WOFF2 fonts and .br output)"
+	}
+	available = optimizers()
+	skipped = [description for name, description in missing.items() if not available[name]]
+	if skipped:
+		print("Skipping optimizations whose packages are not installed: " + ", ".join(skipped))
+		print("Install them with: pip install rjsmin rcssmin fonttools brotli")
+
+def characters_used(files):
+	text = set(chr(code) for code in range(0x20, 0x7f))
+	for path in files:
+		if path.suffix in (".twee", ".js", ".css", ".html", ".tw"):
+			text.update(path.read_text(encoding="utf-8", errors="ignore"))
+	# the layer titles are shown with text-transform: uppercase
+	text.update("".join(text).upper())
+	return "".join(sorted(character for character in text if character.isprintable()))
+
+def subset_font(source, destination, text):
+	options = font_subset.Options()
+	options.flavor = "woff2" if brotli is not None else "woff"
+	options.layout_features = ["*"]
+	logging.getLogger("fontTools").setLevel(logging.ERROR)
+	font = TTFont(str(source))
+	subsetter = font_subset.Subsetter(options)
+	subsetter.populate(text=text)
+	subsetter.subset(font)
+	font.flavor = options.flavor
+	font.save(str(destination))
+	font.close()
+
+# Point @font-face rules at subsetted WOFF2 copies of their fonts, keeping the original as a fallback
+def optimize_fonts(stylesheet, text, sizes):
+	css = stylesheet.read_text(encoding="utf-8")
+	flavor = "woff2" if brotli is not None else "woff"
+
+	def replace(match):
+		url = match.group(1)
+		source = WORKAREA / url
+		if not source.exists():
+			return match.group(0)
+		destination = source.with_name(f"{source.stem}.subset.{flavor}")
+		subset_font(source, destination, text)
+		sizes.append((url, source.stat().st_size, destination.stat().st_size))
+		subset_url = Path(url).with_name(destination.name).as_posix()
+		return f'url("{subset_url}") format("{flavor}"), {match.group(0)}'
+
+	stylesheet.write_text(FONT_FACE_URL.sub(replace, css), encoding="utf-8")
+
+def minify_sources(sizes):
+	for path in sorted(STAGING_DIRECTORY.rglob("*")):
+		if path.suffix == ".js" and rjsmin is not None:
+			minify = rjsmin.jsmin
+		elif path.suffix == ".css" and rcssmin is not None:
+			minify = rcssmin.cssmin
+		else:
+			continue
+		source = path.read_text(encoding="utf-8")
+		minified = minify(source)
+		path.write_text(minified, encoding="utf-8")
+		sizes.append((path.relative_to(STAGING_DIRECTORY).as_posix(), len(source.encode("utf-8")), len(minified.encode("utf-8"))))
+
+def stage_sources():
+	shutil.rmtree(STAGING_DIRECTORY, ignore_errors=True)
+	directories = []
+	for directory in source_directories():
+		staged = STAGING_DIRECTORY / directory.name
+		shutil.copytree(directory, staged)
+		directories.append(staged)
+	return directories
+
+# Minify the staged scripts and stylesheets and subset the fonts they use
+def optimize_sources(sizes):
+	minify_sources(sizes)
+	if font_subset is not None:
+		text = characters_used(source_files())
+		for stylesheet in sorted(STAGING_DIRECTORY.rglob("*.css")):
+			optimize_fonts(stylesheet, text, sizes)
+
+# Write pre-compressed copies of the output for web servers which can serve them directly
+def compress_output(output, sizes):
+	data = output.read_bytes()
+	compressed = {".gz" : gzip.compress(data, compresslevel=9, mtime=0)}
+	if brotli is not None:
+		compressed[".br"] = brotli.compress(data, quality=11)
+	for suffix, content in compressed.items():
+		target = output.with_name(output.name + suffix)
+		target.write_bytes(content)
+		sizes.append((target.name, len(data), len(content)))
+
+def print_size_report(sizes):
+	if not sizes:
+		return
+	width = max(len(name) for name, _, _ in sizes)
+	print("\nOptimization report (bytes):")
+	for name, before, after in sizes:
+		saved = 100 * (before - after) / before if before else 0
+		print(f"  {name.ljust(width)}  {before:>10,} -> {after:>10,}  (-{saved:.1f}%)")
+	total_before = sum(before for _, before, _ in sizes)
+	total_after = sum(after for _, _, after in sizes)
+	print(f"  {'total'.ljust(width)}  {total_before:>10,} -> {total_after:>10,}")
+
+def read_passages(path):
+	return [(passage.name, passage.tags, passage.metadata, passage.text) for passage in twee.read_passages(path)]
+
+def format_passage(name, tags, metadata, text):
+	return twee.format_header(name, tags, metadata) + "\n" + text
+
+def included_passages(text, names):
+	found = set()
+	for match in STATIC_INCLUDE.finditer(text):
+		found.add(next(group for group in match.groups() if group is not None).strip())
+	for match in DYNAMIC_INCLUDE.finditer(text):
+		pattern = twee.expression_pattern(match.group(1) or match.group(2))
+		if pattern is not None:
+			found.update(name for name in names if pattern.fullmatch(name))
+	return found & names
+
+# Decide which passages of the lazy sources must stay in the main file: those SugarCube needs at startup and
+# everything <<include>>d (or read with Story.get) from a passage that is already in the main file
+def plan_bundles(eager_texts, lazy_passages):
+	lazy_names = set(lazy_passages)
+	eager = {name for name, (bundle, tags, metadata, text) in lazy_passages.items() if name in twee.SPECIAL_PASSAGES or EAGER_TAGS.intersection(tags)}
+	pending = list(eager_texts) + [lazy_passages[name][3] for name in eager]
+	while pending:
+		for name in included_passages(pending.pop(), lazy_names) - eager:
+			eager.add(name)
+			pending.append(lazy_passages[name][3])
+	return eager
+
+# Bundles whose passages a bundle <<include>>s - the game loads them together with it
+def bundle_dependencies(bundles, manifest_passages):
+	names = set(manifest_passages)
+	dependencies = {}
+	for bundle, passages in bundles.items():
+		needed = {manifest_passages[name] for _, _, text in passages for name in included_passages(text, names)}
+		dependencies[bundle] = sorted(needed - {bundle})
+	return {bundle : needed for bundle, needed in dependencies.items() if needed}
+
+def write_bundle(bundle, passages):
+	descriptors = [{"name" : name, "tags" : tags, "text" : text} for name, tags, text in passages]
+	content = f"abyssDiverRegisterBundle({json.dumps(bundle)}, {json.dumps(descriptors, ensure_ascii=False, separators=(',', ':'))});\n".encode("utf-8")
+	filename = f"{bundle}.{hashlib.sha256(content).hexdigest()[:10]}.js"
+	(BUNDLE_DIRECTORY / filename).write_bytes(content)
+	return filename
+
+# Move the passages of the lazy sources out of the staged story into bundles/*.js, loaded by the game on demand
+def split_lazy_bundles(staged_source):
+	lazy_passages = {}
+	for filename in LAZY_SOURCES:
+		path = staged_source / filename
+		if not path.exists():
+			continue
+		for name, tags, metadata, text in read_passages(path):
+			lazy_passages[name] = (path.stem, tags, metadata, text)
+		path.unlink()
+
+	eager_texts = [path.read_text(encoding="utf-8") for path in sorted(STAGING_DIRECTORY.rglob("*")) if path.suffix in (".twee", ".tw", ".js")]
+	eager = plan_bundles(eager_texts, lazy_passages)
+
+	bundles = {}
+	for name, (bundle, tags, metadata, text) in lazy_passages.items():
+		if name not in eager:
+			bundles.setdefault(bundle, []).append((name, tags, text))
+
+	shutil.rmtree(BUNDLE_DIRECTORY, ignore_errors=True)
+	BUNDLE_DIRECTORY.mkdir(parents=True)
+	manifest = {"bundles" : {}, "passages" : {}, "dependencies" : {}}
+	for bundle, passages in bundles.items():
+		manifest["bundles"][bundle] = write_bundle(bundle, passages)
+		for name, _, _ in passages:
+			manifest["passages"][name] = bundle
+	manifest["dependencies"] = bundle_dependencies(bundles, manifest["passages"])
+	with open(BUNDLE_DIRECTORY / "manifest.json", "w", encoding="utf-8") as file:
+		json.dump(manifest, file, indent=1, ensure_ascii=False)
+
+	eager_passages = [format_passage(LAZY_LOADING_PASSAGE, ["nobr", "noreturn"], {}, '<div class="lazy-bundle-loading">Loading…</div>')]
+	eager_passages += [format_passage(name, lazy_passages[name][1], lazy_passages[name][2], lazy_passages[name][3]) for name in sorted(eager)]
+	(staged_source / "zzLazyBundles.twee").write_text("\n\n\n".join(eager_passages) + "\n", encoding="utf-8")
+	loader = BUNDLE_LOADER_TEMPLATE.read_text(encoding="utf-8")
+	loader = loader.replace("/* MANIFEST */ { bundles: {}, passages: {}, dependencies: {} }", json.dumps(manifest, ensure_ascii=False))
+	(staged_source / "zzLazyBundles.js").write_text(loader, encoding="utf-8")
+
+	print(f"Lazy bundles: {len(manifest['passages'])} passages in {len(bundles)} bundles, {len(eager)} kept in {OUTPUT}.")
+	return manifest
+
+class StoryDataParser(HTMLParser):
+	"""Counts the passages in a compiled story the way a browser has to walk them: as HTML."""
+
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.passages = 0
+		self.text_bytes = 0
+		self.in_passage = False
+
+	def handle_starttag(self, tag, attrs):
+		if tag == "tw-passagedata":
+			self.passages += 1
+			self.in_passage = True
+
+	def handle_endtag(self, tag):
+		if tag == "tw-passagedata":
+			self.in_passage = False
+
+	def handle_data(self, data):
+		if self.in_passage:
+			self.text_bytes += len(data.encode("utf-8"))
+
+# Headless estimate of how long the story data takes to parse: best of a few html.parser runs over the output
+def measure_story_parse(html):
+	timings = []
+	for _ in range(REPORT_PARSE_RUNS):
+		parser = StoryDataParser()
+		started = time.perf_counter()
+		parser.feed(html)
+		parser.close()
+		timings.append(time.perf_counter() - started)
+	return parser, min(timings) * 1000
+
+def size_entry(data):
+	entry = {"bytes" : len(data), "gzip_bytes" : len(gzip.compress(data, compresslevel=9, mtime=0))}
+	if brotli is not None:
+		entry["brotli_bytes"] = len(brotli.compress(data, quality=11))
+	return entry
+
+def create_report(lazy=False):
+	"""Sizes of the output and of every source file and passage, plus a parse-time estimate of the story data."""
+	output = Path(OUTPUT)
+	data = output.read_bytes()
+	story, parse_ms = measure_story_parse(data.decode("utf-8", errors="replace"))
+	report = {
+		"time" : time.time(),
+		"output" : {"path" : OUTPUT, **size_entry(data)},
+		"story" : {"passages" : story.passages, "text_bytes" : story.text_bytes, "parse_ms" : round(parse_ms, 2)},
+		"files" : {},
+		"largest_passages" : []
+	}
+
+	passages = []
+	for path in source_files():
+		key = path.relative_to(WORKAREA).as_posix()
+		entry = {"bytes" : path.stat().st_size}
+		if path.suffix in (".twee", ".tw"):
+			file_passages = read_passages(path)
+			entry["passages"] = len(file_passages)
+			passages.extend((len(text.encode("utf-8")), name, key) for name, _, _, text in file_passages)
+		report["files"][key] = entry
+	passages.sort(reverse=True)
+	report["largest_passages"] = [{"name" : name, "file" : key, "bytes" : size} for size, name, key in passages[:REPORT_LARGEST_PASSAGES]]
+	report["passage_bytes"] = {name : size for size, name, _ in passages}
+
+	if lazy and (BUNDLE_DIRECTORY / "manifest.json").exists():
+		with open(BUNDLE_DIRECTORY / "manifest.json", "r", encoding="utf-8") as file:
+			bundles = json.load(file)["bundles"]
+		report["bundles"] = {bundle : size_entry((BUNDLE_DIRECTORY / filename).read_bytes()) for bundle, filename in bundles.items()}
+	return report
+
+def save_report(report, path):
+	with open(path, "w", encoding="utf-8") as file:
+		json.dump(report, file, indent=1, ensure_ascii=False)
+	print(f"Saved build report to {path}.")
+
+def print_report(report):
+	output = report["output"]
+	story = report["story"]
+	print(f"\n{output['path']}: {output['bytes']:,} bytes ({output['gzip_bytes']:,} gzip" + (f", {output['brotli_bytes']:,} brotli" if "brotli_bytes" in output else "") + ")")
+	print(f"Story data: {story['passages']:,} passages, {story['text_bytes']:,} bytes of passage text, ~{story['parse_ms']:.0f} ms to parse")
+	print("Largest passages:")
+	for passage in report["largest_passages"][:10]:
+		print(f"  {passage['bytes']:>9,}  {passage['name']} ({passage['file']})")
+
+def report_metrics(report):
+	metrics = {
+		"output bytes" : report["output"]["bytes"],
+		"output gzip bytes" : report["output"]["gzip_bytes"],
+		"story passages" : report["story"]["passages"]
+	}
+	for key, entry in report["files"].items():
+		metrics[f"{key} bytes"] = entry["bytes"]
+		if "passages" in entry:
+			metrics[f"{key} passages"] = entry["passages"]
+	for bundle, entry in report.get("bundles", {}).items():
+		metrics[f"bundle {bundle} gzip bytes"] = entry["gzip_bytes"]
+	return metrics
+
+def compare_reports(old, new, threshold):
+	"""Print what grew between two reports and return the metrics which grew by more than threshold percent."""
+	old_metrics = report_metrics(old)
+	new_metrics = report_metrics(new)
+	regressions = []
+	print(f"\nChanges since the previous report (threshold {threshold:g}%):")
+	for name in sorted(set(old_metrics) | set(new_metrics)):
+		before = old_metrics.get(name, 0)
+		after = new_metrics.get(name, 0)
+		if before == after:
+			continue
+		growth = 100 * (after - before) / before if before else float("inf")
+		flag = ""
+		if growth > threshold:
+			regressions.append(name)
+			flag = "  <-- REGRESSION"
+		print(f"  {name}: {before:,} -> {after:,} ({growth:+.1f}%){flag}")
+	# timings depend on the machine, so they are shown but never fail the comparison
+	print(f"  story parse time: {old['story']['parse_ms']:.0f} ms -> {new['story']['parse_ms']:.0f} ms")
+	if regressions:
+		print(f"{len(regressions)} metric(s) grew by more than {threshold:g}%.")
+	else:
+		print("No metric grew by more than the threshold.")
+	return regressions
+
+def build(additional_args, force=False, optimize=False, lazy=False):
+	"""Compile the story unless its inputs, toolchain and arguments are unchanged since the last build."""
+	started = time.perf_counter()
+	manifest = load_manifest()
+	tweego, tweego_version = resolve_tweego(manifest)
+	ensure_sugarcube()
+
+	settings = {"tweego" : tweego_version, "sugarcube" : SUGARCUBE_VERSION, "args" : additional_args, "output" : OUTPUT}
+	if optimize:
+		settings["optimize"] = optimizers()
+	if lazy:
+		settings["lazy"] = hashlib.sha256(BUNDLE_LOADER_TEMPLATE.read_bytes()).hexdigest()
+	inputs = hash_inputs(manifest, settings)
+	output = Path(OUTPUT)
+	if not force and manifest.get("inputs") == inputs and output.exists() and manifest.get("output") == file_signature(output):
+		save_manifest(manifest)
+		print(f"{OUTPUT} is up to date ({(time.perf_counter() - started) * 1000:.0f} ms).")
+		return False
+
+	print(f"BUILDING: {OUTPUT}")
+	sizes = []
+	directories = None
+	if optimize or lazy:
+		directories = stage_sources()
+	if lazy:
+		split_lazy_bundles(STAGING_DIRECTORY / "src")
+	if optimize:
+		print_missing_optimizers()
+		optimize_sources(sizes)
+	compile_story(tweego, additional_args, directories)
+	if optimize:
+		compress_output(output, sizes)
+		if lazy:
+			for bundle in sorted(BUNDLE_DIRECTORY.glob("*.js")):
+				compress_output(bundle, sizes)
+	manifest["inputs"] = inputs
+	manifest["output"] = file_signature(output)
+	save_manifest(manifest)
+	print_size_report(sizes)
+	print(f"Built {OUTPUT} in {time.perf_counter() - started:.2f}s.")
+	return True
+
+def snapshot_sources():
+	snapshot = {}
+	for path in source_files():
+		try:
+			snapshot[path] = file_signature(path)
+		except FileNotFoundError:
+			pass # deleted while scanning
+	return snapshot
+
+# Poll the source folders, debounce bursts of changes and rebuild only when content actually changed
+def watch(additional_args, force=False, optimize=False, lazy=False):
+	try:
+		build(additional_args, force=force, optimize=optimize, lazy=lazy)
+	except subprocess.CalledProcessError as e:
+		print(f"Build failed: {e}")
+
+	print("\nWatch mode started.  Press CTRL+C to stop.\n")
+	print(f"Recursively watched paths: {len(source_directories())}")
+	for directory in source_directories():
+		print(f"  {directory.relative_to(WORKAREA).as_posix()}")
+	print()
+
+	previous = snapshot_sources()
+	try:
+		while True:
+			time.sleep(WATCH_INTERVAL)
+			current = snapshot_sources()
+			if current == previous:
+				continue
+			# wait for editors to finish writing before building
+			while True:
+				time.sleep(WATCH_DEBOUNCE)
+				settled = snapshot_sources()
+				if settled == current:
+					break
+				current = settled
+			for path in sorted(set(current) | set(previous)):
+				if current.get(path) != previous.get(path):
+					print(f"WRITE: {path.relative_to(WORKAREA).as_posix()}")
+			previous = current
+			try:
+				build(additional_args, optimize=optimize, lazy=lazy)
+			except subprocess.CalledProcessError as e:
+				print(f"Build failed: {e}")
+	except KeyboardInterrupt:
+		print("Watch mode stopped.")
+
+def main():
+	parser = argparse.ArgumentParser(description="Build AbyssDiver.html. Unrecognised arguments are passed on to Tweego.")
+	parser.add_argument("-w", "--watch", action="store_true", help="rebuild whenever the source files change")
+	parser.add_argument("--force", action="store_true", help="compile even when nothing changed")
+	parser.add_argument("--optimize", action="store_true", help="minify scripts and stylesheets, subset fonts and write .gz/.br copies of the output")
+	parser.add_argument("--lazy", action="store_true", help="move the layer, companion conversation and relic passages into bundles/ which the game loads on demand")
+	parser.add_argument("--report", metavar="REPORT.json", help="save a size and parse-time report of the build")
+	parser.add_argument("--compare", metavar="OLD.json", help="compare the build with an earlier report and fail when it grew past --threshold")
+	parser.add_argument("--threshold", type=float, default=5.0, help="allowed growth in percent for --compare (default 5)")
+	args, additional_args = parser.parse_known_args()
+
+	print(f"Compiling to: {OUTPUT}")
 
-additional_args = sys.argv[1:]
+	if args.watch:
+		watch(additional_args, force=args.force, optimize=args.optimize, lazy=args.lazy)
+		return
 
-command = [
-	str(TWEEGO),
-	str(src_dir),
-	str(dependencies_dir),
-	"-o", OUTPUT
-] + additional_args
+	print("If you aren't constantly developing the game and updating the HTML file, you can close this prompt.")
+	build(additional_args, force=args.force, optimize=args.optimize, lazy=args.lazy)
 
-print("If you aren't constantly developing the game and updating the HTML file, you can close this prompt.")
+	if args.report or args.compare:
+		report = create_report(lazy=args.lazy)
+		print_report(report)
+		if args.report:
+			save_report(report, args.report)
+		if args.compare:
+			with open(args.compare, "r", encoding="utf-8") as file:
+				previous = json.load(file)
+			if compare_reports(previous, report, args.threshold):
+				sys.exit(1)
 
-subprocess.run(command, check=True)
+if __name__ == "__main__":
+	main()
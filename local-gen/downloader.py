@@ -0,0 +1,450 @@
+'''
+Segmented, resumable and checksum-verified downloader for the one-click installer.
+
+Large files are fetched as several parallel HTTP ranges written into a preallocated
+".part" file, with the per-segment progress persisted next to it so an interrupted
+download resumes where each segment stopped. Servers that do not honour ranges fall
+back to a single stream. The file is only renamed into place once its size (and
+SHA-256, when known) has been verified.
+
+Tar archives can instead be extracted while they download (stream_extract_tar), so a
+multi-GB archive never has to be written to disk before being unpacked.
+
+Can be run standalone for testing against any HTTP server:
+	python downloader.py <url> <destination> [--sha256 HEX] [--segments N]
+	python downloader.py --extract <url> <directory> [--strip-components N]
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel
+from threading import Lock
+from typing import Optional
+
+import argparse
+import hashlib
+import json
+import os
+import requests
+import tarfile
+import time
+
+DEFAULT_SEGMENTS : int = 8
+MIN_SEGMENT_SIZE : int = 32 * 1024 * 1024
+CHUNK_SIZE : int = 1024 * 1024
+WRITE_BUFFER_SIZE : int = 8 * 1024 * 1024
+STATE_SAVE_INTERVAL : float = 2.0
+EXTRACT_STATE_FILENAME : str = ".extract-state.json"
+STREAMABLE_ARCHIVE_SUFFIXES : tuple[str, ...] = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+SEGMENT_RETRIES : int = 3
+REQUEST_TIMEOUT : tuple[float, float] = (15.0, 60.0)
+
+class DownloadError(Exception):
+	'''Raised when a download cannot be completed.'''
+
+class RangeNotSupported(DownloadError):
+	'''Raised when the server answers a range request with the whole file.'''
+
+class ChecksumMismatch(DownloadError):
+	'''Raised when a downloaded file does not match its expected SHA-256.'''
+
+class RemoteFile(BaseModel):
+	url : str
+	size : Optional[int] = None
+	accepts_ranges : bool = False
+	etag : Optional[str] = None
+	sha256 : Optional[str] = None
+
+class _Progress:
+	'''Thread-safe byte counter that prints every tenth of the total size.'''
+
+	def __init__(self, total : Optional[int], done : int = 0) -> None:
+		self.total = total
+		self.done = done
+		self.started = time.monotonic()
+		self._start_bytes = done
+		self._lock = Lock()
+		self._next_report = self._next_step(done)
+
+	def _next_step(self, value : int) -> float:
+		if not self.total:
+			return value + 100_000_000
+		step = self.total / 10
+		return (int(value / step) + 1) * step
+
+	def add(self, amount : int) -> None:
+		with self._lock:
+			self.done += amount
+			if self.done < self._next_report:
+				return
+			self._next_report = self._next_step(self.done)
+			elapsed = max(time.monotonic() - self.started, 1e-6)
+			speed = (self.done - self._start_bytes) / elapsed / 1_000_000
+			if self.total:
+				print(f"{self.done / 1_000_000:.2f} / {self.total / 1_000_000:.2f} MB ({speed:.2f} MB/s)")
+			else:
+				print(f"{self.done / 1_000_000:.2f} MB ({speed:.2f} MB/s)")
+
+def sha256_of_file(filepath : str, buffer_size : int = WRITE_BUFFER_SIZE) -> str:
+	'''Compute the SHA-256 hex digest of a file.'''
+	digest = hashlib.sha256()
+	with open(filepath, 'rb') as file:
+		while True:
+			data = file.read(buffer_size)
+			if not data:
+				break
+			digest.update(data)
+	return digest.hexdigest()
+
+def _linked_sha256(response : requests.Response) -> Optional[str]:
+	'''HuggingFace advertises the SHA-256 of LFS files in the X-Linked-Etag header.'''
+	for item in list(response.history) + [response]:
+		value : str = item.headers.get('x-linked-etag', '').strip('W/').strip('"')
+		if len(value) == 64 and all(ch in '0123456789abcdef' for ch in value.lower()):
+			return value.lower()
+	return None
+
+def probe_remote_file(url : str, session : Optional[requests.Session] = None) -> RemoteFile:
+	'''Find the size, range support and advertised checksum of a remote file.'''
+	session = session or requests.Session()
+	try:
+		response = session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+		response.raise_for_status()
+	except requests.RequestException:
+		# some servers refuse HEAD - the download will simply use a single stream
+		return RemoteFile(url=url)
+	size : Optional[int] = None
+	if response.headers.get('content-length', '').isdigit():
+		size = int(response.headers['content-length'])
+	return RemoteFile(
+		url=url,
+		size=size,
+		accepts_ranges=response.headers.get('accept-ranges', '').lower() == 'bytes',
+		etag=response.headers.get('etag'),
+		sha256=_linked_sha256(response),
+	)
+
+def _plan_segments(size : int, segments : int) -> list[list[int]]:
+	'''Split [0, size) into [start, end, done] segments of at least MIN_SEGMENT_SIZE bytes.'''
+	count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+	step = size // count
+	plan : list[list[int]] = []
+	for index in range(count):
+		start = index * step
+		end = size if index == count - 1 else start + step
+		plan.append([start, end, 0])
+	return plan
+
+def _load_state(state_path : str, remote : RemoteFile) -> Optional[list[list[int]]]:
+	if not os.path.exists(state_path):
+		return None
+	try:
+		with open(state_path, 'r') as file:
+			state : dict = json.load(file)
+	except (OSError, ValueError):
+		return None
+	if state.get('size') != remote.size or state.get('etag') != remote.etag:
+		print("Remote file has changed since the last attempt - restarting download.")
+		return None
+	return state['segments']
+
+def _save_state(state_path : str, remote : RemoteFile, segments : list[list[int]]) -> None:
+	temp_path = state_path + '.tmp'
+	with open(temp_path, 'w') as file:
+		json.dump({'url' : remote.url, 'size' : remote.size, 'etag' : remote.etag, 'segments' : segments}, file)
+	os.replace(temp_path, state_path)
+
+def _download_segment(session : requests.Session, remote : RemoteFile, part_path : str, segment : list[int], progress : _Progress, on_flush) -> None:
+	'''Download the remaining bytes of one segment, flushing large buffered writes.'''
+	attempt = 0
+	while segment[0] + segment[2] < segment[1]:
+		offset = segment[0] + segment[2]
+		headers = {'Range' : f'bytes={offset}-{segment[1] - 1}'}
+		try:
+			with session.get(remote.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+				if response.status_code != 206:
+					raise RangeNotSupported(f"Server ignored the range request (status {response.status_code}).")
+				with open(part_path, 'r+b') as file:
+					file.seek(offset)
+					buffer = bytearray()
+					for data in response.iter_content(chunk_size=CHUNK_SIZE):
+						buffer += data
+						if len(buffer) >= WRITE_BUFFER_SIZE:
+							file.write(buffer)
+							segment[2] += len(buffer)
+							progress.add(len(buffer))
+							buffer.clear()
+							on_flush()
+					if buffer:
+						file.write(buffer)
+						segment[2] += len(buffer)
+						progress.add(len(buffer))
+		except DownloadError:
+			raise
+		except (requests.RequestException, OSError) as e:
+			attempt += 1
+			if attempt > SEGMENT_RETRIES:
+				raise DownloadError(f"Segment {segment[0]}-{segment[1]} failed after {SEGMENT_RETRIES} retries: {e}") from e
+			print(f"Segment {segment[0]}-{segment[1]} interrupted ({e}), retrying...")
+			time.sleep(2 ** attempt)
+			continue
+		if segment[0] + segment[2] < segment[1]:
+			# the connection closed early - continue from where it stopped
+			attempt += 1
+			if attempt > SEGMENT_RETRIES:
+				raise DownloadError(f"Segment {segment[0]}-{segment[1]} ended early at {segment[0] + segment[2]} {SEGMENT_RETRIES} times.")
+			print(f"Segment {segment[0]}-{segment[1]} ended early at {segment[0] + segment[2]}, retrying...")
+			time.sleep(2 ** attempt)
+
+def _download_segmented(session : requests.Session, remote : RemoteFile, part_path : str, state_path : str, segments : int) -> None:
+	plan : Optional[list[list[int]]] = _load_state(state_path, remote) if os.path.exists(part_path) else None
+	if plan is None:
+		plan = _plan_segments(remote.size, segments)
+		# preallocate so every segment can write at its own offset
+		with open(part_path, 'wb') as file:
+			file.truncate(remote.size)
+		_save_state(state_path, remote, plan)
+	else:
+		print("Resuming previous download.")
+
+	progress = _Progress(remote.size, sum(segment[2] for segment in plan))
+	state_lock = Lock()
+	last_save = [time.monotonic()]
+
+	def on_flush() -> None:
+		with state_lock:
+			if time.monotonic() - last_save[0] >= STATE_SAVE_INTERVAL:
+				_save_state(state_path, remote, plan)
+				last_save[0] = time.monotonic()
+
+	pending = [segment for segment in plan if segment[0] + segment[2] < segment[1]]
+	print(f"Downloading {len(pending)} segment(s) in parallel.")
+	try:
+		with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+			futures = [executor.submit(_download_segment, session, remote, part_path, segment, progress, on_flush) for segment in pending]
+			for future in futures:
+				future.result()
+	finally:
+		with state_lock:
+			_save_state(state_path, remote, plan)
+
+def _download_single_stream(session : requests.Session, remote : RemoteFile, part_path : str) -> None:
+	existing_size : int = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+	headers = {'Range' : f'bytes={existing_size}-'} if existing_size > 0 else {}
+	with session.get(remote.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+		if response.status_code == 416 and remote.size == existing_size:
+			return # already complete
+		response.raise_for_status()
+		if response.status_code == 206:
+			print(f"Resuming download at {existing_size / 1_000_000:.2f} MB.")
+			mode = 'ab'
+		else:
+			# the server ignored the range, so appending would corrupt the file
+			existing_size = 0
+			mode = 'wb'
+		total = remote.size or (int(response.headers['content-length']) + existing_size if response.headers.get('content-length', '').isdigit() else None)
+		progress = _Progress(total, existing_size)
+		with open(part_path, mode) as file:
+			buffer = bytearray()
+			for data in response.iter_content(chunk_size=CHUNK_SIZE):
+				buffer += data
+				if len(buffer) >= WRITE_BUFFER_SIZE:
+					file.write(buffer)
+					progress.add(len(buffer))
+					buffer.clear()
+			file.write(buffer)
+			progress.add(len(buffer))
+
+def download_file(url : str, destination : str, sha256 : Optional[str] = None, segments : int = DEFAULT_SEGMENTS) -> str:
+	'''
+	Download a file from a URL into destination, resuming any previous partial download.
+
+	The file is verified against the given SHA-256 (or the one the server advertises)
+	before it is moved into place. Returns the SHA-256 hex digest of the file.
+	'''
+	part_path : str = destination + '.part'
+	state_path : str = destination + '.part.json'
+	session = requests.Session()
+
+	remote : RemoteFile = probe_remote_file(url, session=session)
+	expected : Optional[str] = (sha256 or remote.sha256 or '').lower() or None
+
+	if os.path.exists(destination):
+		if remote.size is not None and os.path.getsize(destination) != remote.size:
+			# left behind by an older installer which downloaded in place
+			print(f"Found an incomplete {os.path.basename(destination)} - resuming it.")
+			os.replace(destination, part_path)
+		else:
+			digest = sha256_of_file(destination)
+			if expected is None or digest == expected:
+				print(f"{os.path.basename(destination)} is already downloaded.")
+				return digest
+			print(f"{os.path.basename(destination)} failed verification - downloading again.")
+			os.remove(destination)
+
+	if remote.size is not None:
+		print(f"File size: {remote.size / 1_000_000:.2f} MB")
+
+	segmented : bool = remote.accepts_ranges and remote.size is not None and remote.size >= 2 * MIN_SEGMENT_SIZE and segments > 1
+	if segmented and not os.path.exists(state_path) and os.path.exists(part_path):
+		# partial file from a single-stream attempt - keep streaming it
+		segmented = False
+
+	if segmented:
+		try:
+			_download_segmented(session, remote, part_path, state_path, segments)
+		except RangeNotSupported:
+			print("Server does not support ranged downloads - falling back to a single stream.")
+			for path in (part_path, state_path):
+				if os.path.exists(path):
+					os.remove(path)
+			_download_single_stream(session, remote, part_path)
+	else:
+		_download_single_stream(session, remote, part_path)
+
+	actual_size : int = os.path.getsize(part_path)
+	if remote.size is not None and actual_size != remote.size:
+		raise DownloadError(f"Downloaded {actual_size} bytes but expected {remote.size} bytes for {url}.")
+
+	print("Verifying download.")
+	digest : str = sha256_of_file(part_path)
+	if expected is not None and digest != expected:
+		for path in (part_path, state_path):
+			if os.path.exists(path):
+				os.remove(path)
+		raise ChecksumMismatch(f"Checksum mismatch for {url}: expected {expected}, got {digest}.")
+
+	os.replace(part_path, destination)
+	if os.path.exists(state_path):
+		os.remove(state_path)
+	print("Download complete.")
+	return digest
+
+class _CountingReader:
+	'''File-like wrapper over a streamed response that reports download progress.'''
+
+	def __init__(self, raw, progress : _Progress) -> None:
+		self._raw = raw
+		self._progress = progress
+
+	def read(self, size : int = -1) -> bytes:
+		data : bytes = self._raw.read(size)
+		self._progress.add(len(data))
+		return data
+
+def is_streamable_archive(filename : str) -> bool:
+	return filename.lower().endswith(STREAMABLE_ARCHIVE_SUFFIXES)
+
+def _member_target(directory : str, name : str, strip_components : int) -> Optional[str]:
+	parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+	parts = parts[strip_components:]
+	if not parts:
+		return None
+	if ".." in parts or os.path.isabs(name) or ":" in parts[0]:
+		raise DownloadError(f"Refusing to extract unsafe archive member: {name}")
+	return Path(os.path.join(directory, *parts)).as_posix()
+
+def _is_within(directory : str, path : str) -> bool:
+	'''Whether path, with symlinks resolved, stays inside directory.'''
+	root = os.path.realpath(directory)
+	return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+def stream_extract_tar(url : str, directory : str, strip_components : int = 0) -> int:
+	'''
+	Extract a (compressed) tar archive into directory while it downloads.
+
+	Completed entries are recorded in an extract state file; each file is written under a
+	temporary name and renamed once complete. An interrupted extraction resumes by skipping
+	entries which were recorded and still have their recorded size on disk. Returns the
+	number of files written.
+	'''
+	os.makedirs(directory, exist_ok=True)
+	state_path : str = Path(os.path.join(directory, EXTRACT_STATE_FILENAME)).as_posix()
+	completed : dict[str, int] = {}
+	if os.path.exists(state_path):
+		try:
+			with open(state_path, "r") as file:
+				state : dict = json.load(file)
+			if state.get("url") == url:
+				completed = state.get("members", {})
+				print(f"Resuming extraction - {len(completed)} entries already extracted.")
+		except (OSError, ValueError):
+			completed = {}
+
+	def save_state() -> None:
+		temp_path = state_path + ".tmp"
+		with open(temp_path, "w") as file:
+			json.dump({"url" : url, "members" : completed}, file)
+		os.replace(temp_path, state_path)
+
+	written = 0
+	last_save = time.monotonic()
+	with requests.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+		response.raise_for_status()
+		response.raw.decode_content = True
+		total = int(response.headers['content-length']) if response.headers.get('content-length', '').isdigit() else None
+		reader = _CountingReader(response.raw, _Progress(total))
+		with tarfile.open(fileobj=reader, mode="r|*") as archive:
+			for member in archive:
+				target = _member_target(directory, member.name, strip_components)
+				if target is None:
+					continue
+				if member.isdir():
+					os.makedirs(target, exist_ok=True)
+					continue
+				# a symlink extracted earlier must not lead a later entry outside the directory
+				if not _is_within(directory, os.path.dirname(target)):
+					raise DownloadError(f"Refusing to extract archive member through a symlink: {member.name}")
+				if member.issym():
+					if os.path.isabs(member.linkname) or not _is_within(directory, os.path.join(os.path.dirname(target), member.linkname)):
+						raise DownloadError(f"Refusing to extract symlink pointing outside the directory: {member.name} -> {member.linkname}")
+					if os.path.lexists(target):
+						continue
+					os.makedirs(os.path.dirname(target), exist_ok=True)
+					try:
+						os.symlink(member.linkname, target)
+					except OSError:
+						print(f"Unable to create symlink {target} - skipping it.")
+					continue
+				if not member.isfile():
+					continue
+				# verified resume point: skip entries already extracted with the recorded size
+				if completed.get(member.name) == member.size and os.path.isfile(target) and os.path.getsize(target) == member.size:
+					continue
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				source = archive.extractfile(member)
+				partial = target + ".partial"
+				with open(partial, "wb") as file:
+					while True:
+						data = source.read(CHUNK_SIZE)
+						if not data:
+							break
+						file.write(data)
+				if os.path.getsize(partial) != member.size:
+					raise DownloadError(f"Archive entry {member.name} was truncated.")
+				if member.mode & 0o111:
+					os.chmod(partial, 0o755)
+				os.replace(partial, target)
+				completed[member.name] = member.size
+				written += 1
+				if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+					save_state()
+					last_save = time.monotonic()
+	if os.path.exists(state_path):
+		os.remove(state_path)
+	print(f"Extraction complete - {written} files written.")
+	return written
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Download a file with parallel ranged segments and checksum verification.')
+	parser.add_argument('url')
+	parser.add_argument('destination', help='file to download to, or directory to extract into with --extract')
+	parser.add_argument('--sha256', default=None)
+	parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS)
+	parser.add_argument('--extract', action='store_true', help='extract a tar archive while it downloads')
+	parser.add_argument('--strip-components', type=int, default=0)
+	args = parser.parse_args()
+	if args.extract:
+		stream_extract_tar(args.url, args.destination, strip_components=args.strip_components)
+	else:
+		print(download_file(args.url, args.destination, sha256=args.sha256, segments=args.segments))
@@ -0,0 +1,237 @@
+'''
+Hardware detection and ComfyUI launch profiles.
+
+Probes nvidia-smi, rocm-smi and /proc / sysfs (sysctl on macOS) for the GPU type, VRAM,
+system RAM and CPU core count, and maps the result to ComfyUI launch arguments instead
+of forcing --lowvram on every card.
+
+All probes go through injectable functions so detection can be tested against recorded
+tool outputs:
+	python hardware.py
+	python hardware.py --nvidia-smi nvidia.txt --meminfo meminfo.txt --cpu-count 16
+'''
+
+from pydantic import BaseModel
+from typing import Callable, Optional
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+
+NVIDIA_SMI_COMMAND : list[str] = ["nvidia-smi", "--query-gpu=name,memory.total,compute_cap", "--format=csv,noheader,nounits"]
+ROCM_SMI_COMMAND : list[str] = ["rocm-smi", "--showproductname", "--showmeminfo", "vram", "--json"]
+
+# VRAM (MB) needed for ComfyUI to keep SDXL models resident
+HIGH_VRAM_MB : int = 16_000
+NORMAL_VRAM_MB : int = 8_000
+
+class GPUInfo(BaseModel):
+	name : str
+	vram_mb : Optional[int] = None
+	compute_capability : Optional[float] = None
+
+class HardwareInfo(BaseModel):
+	device_type : str = "cpu" # cuda, rocm, mps or cpu
+	gpus : list[GPUInfo] = []
+	system_ram_mb : Optional[int] = None
+	cpu_cores : int = 1
+
+	@property
+	def vram_mb(self) -> Optional[int]:
+		'''VRAM of the card ComfyUI will use (the first one).'''
+		return self.gpus[0].vram_mb if self.gpus else None
+
+	def summary(self) -> str:
+		ram = f"{self.system_ram_mb / 1024:.0f}GB RAM" if self.system_ram_mb else "unknown RAM"
+		if not self.gpus:
+			return f"{self.device_type.upper()} with {self.cpu_cores} cores and {ram}"
+		gpu = self.gpus[0]
+		vram = f"{gpu.vram_mb / 1024:.0f}GB VRAM" if gpu.vram_mb else "unknown VRAM"
+		return f"{gpu.name} ({self.device_type.upper()}, {vram}) with {self.cpu_cores} cores and {ram}"
+
+class LaunchProfile(BaseModel):
+	args : list[str] = []
+	env : dict[str, str] = {}
+
+def run_tool(command : list[str]) -> Optional[str]:
+	'''Run a probe command and return its output, or None when unavailable.'''
+	try:
+		result = subprocess.run(command, capture_output=True, text=True, timeout=15)
+	except (OSError, subprocess.TimeoutExpired):
+		return None
+	return result.stdout if result.returncode == 0 else None
+
+def read_text(filepath : str) -> Optional[str]:
+	try:
+		with open(filepath, "r") as file:
+			return file.read()
+	except OSError:
+		return None
+
+def parse_nvidia_smi(output : str) -> list[GPUInfo]:
+	'''Parse "name, memory.total, compute_cap" csv rows from nvidia-smi.'''
+	gpus : list[GPUInfo] = []
+	for line in output.strip().splitlines():
+		parts = [part.strip() for part in line.split(",")]
+		if len(parts) < 2:
+			continue
+		vram = int(float(parts[1])) if parts[1].replace(".", "", 1).isdigit() else None
+		capability = float(parts[2]) if len(parts) > 2 and parts[2].replace(".", "", 1).isdigit() else None
+		gpus.append(GPUInfo(name=parts[0], vram_mb=vram, compute_capability=capability))
+	return gpus
+
+def parse_rocm_smi(output : str) -> list[GPUInfo]:
+	'''Parse the json output of rocm-smi --showproductname --showmeminfo vram.'''
+	try:
+		data : dict = json.loads(output)
+	except ValueError:
+		return []
+	gpus : list[GPUInfo] = []
+	for card, values in sorted(data.items()):
+		if not card.startswith("card") or not isinstance(values, dict):
+			continue
+		total = values.get("VRAM Total Memory (B)")
+		name = values.get("Card Series") or values.get("Card series") or values.get("Card SKU") or card
+		vram = int(total) // (1024 * 1024) if total is not None and str(total).isdigit() else None
+		gpus.append(GPUInfo(name=name, vram_mb=vram))
+	return gpus
+
+def parse_meminfo(text : str) -> Optional[int]:
+	'''Total system RAM in MB from /proc/meminfo.'''
+	for line in text.splitlines():
+		if line.startswith("MemTotal:"):
+			return int(line.split()[1]) // 1024
+	return None
+
+def parse_amdgpu_sysfs(read_file : Callable[[str], Optional[str]], max_cards : int = 8) -> list[GPUInfo]:
+	'''Find AMD GPUs through /sys/class/drm when rocm-smi is not installed.'''
+	gpus : list[GPUInfo] = []
+	for index in range(max_cards):
+		base = f"/sys/class/drm/card{index}/device"
+		vendor = read_file(f"{base}/vendor")
+		if vendor is None or vendor.strip() != "0x1002":
+			continue
+		total = read_file(f"{base}/mem_info_vram_total")
+		vram = int(total.strip()) // (1024 * 1024) if total and total.strip().isdigit() else None
+		gpus.append(GPUInfo(name=f"AMD GPU (card{index})", vram_mb=vram))
+	return gpus
+
+def _windows_system_ram_mb() -> Optional[int]:
+	import ctypes
+	class MEMORYSTATUSEX(ctypes.Structure):
+		_fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong), ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong), ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong), ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong), ("sullAvailExtendedVirtual", ctypes.c_ulonglong)]
+	status = MEMORYSTATUSEX()
+	status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+	if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)) == 0:
+		return None
+	return status.ullTotalPhys // (1024 * 1024)
+
+def detect_hardware(
+	run : Callable[[list[str]], Optional[str]] = run_tool,
+	read_file : Callable[[str], Optional[str]] = read_text,
+	system : Optional[str] = None,
+	machine : Optional[str] = None,
+	cpu_count : Optional[int] = None,
+) -> HardwareInfo:
+	'''Detect the GPU, VRAM, system RAM and CPU cores of this machine.'''
+	system = system or platform.system()
+	machine = (machine or platform.machine()).lower()
+	info = HardwareInfo(cpu_cores=cpu_count or os.cpu_count() or 1)
+
+	if system == "Linux":
+		meminfo = read_file("/proc/meminfo")
+		info.system_ram_mb = parse_meminfo(meminfo) if meminfo else None
+	elif system == "Darwin":
+		memsize = run(["sysctl", "-n", "hw.memsize"])
+		info.system_ram_mb = int(memsize.strip()) // (1024 * 1024) if memsize and memsize.strip().isdigit() else None
+	elif system == "Windows":
+		try:
+			info.system_ram_mb = _windows_system_ram_mb()
+		except Exception:
+			info.system_ram_mb = None
+
+	nvidia = run(NVIDIA_SMI_COMMAND)
+	if nvidia:
+		info.gpus = parse_nvidia_smi(nvidia)
+		if info.gpus:
+			info.device_type = "cuda"
+			return info
+
+	if system == "Linux":
+		rocm = run(ROCM_SMI_COMMAND)
+		info.gpus = parse_rocm_smi(rocm) if rocm else parse_amdgpu_sysfs(read_file)
+		if info.gpus:
+			info.device_type = "rocm"
+			return info
+
+	if system == "Darwin" and machine == "arm64":
+		# apple silicon shares system memory with the GPU
+		info.device_type = "mps"
+		info.gpus = [GPUInfo(name="Apple Silicon", vram_mb=info.system_ram_mb)]
+
+	return info
+
+def vram_mode_argument(vram_mb : Optional[int]) -> str:
+	if vram_mb is None:
+		return "--lowvram" # unknown - stay safe
+	if vram_mb >= HIGH_VRAM_MB:
+		return "--highvram"
+	if vram_mb >= NORMAL_VRAM_MB:
+		return "--normalvram"
+	return "--lowvram"
+
+def launch_profile(info : HardwareInfo, device_type : Optional[str] = None) -> LaunchProfile:
+	'''
+	Map detected hardware to ComfyUI launch arguments.
+
+	device_type overrides the detected device (for example when the player chose CPU).
+	'''
+	device_type = device_type or info.device_type
+	profile = LaunchProfile()
+	threads = str(max(1, info.cpu_cores))
+	if device_type == "cpu":
+		profile.args = ["--cpu"]
+		profile.env = {"OMP_NUM_THREADS" : threads, "MKL_NUM_THREADS" : threads}
+		return profile
+	if device_type == "mps":
+		profile.args = ["--force-fp16"]
+		return profile
+	if device_type == "directml":
+		profile.args = ["--directml", vram_mode_argument(info.vram_mb)]
+		return profile
+	profile.args = [vram_mode_argument(info.vram_mb)]
+	capability = info.gpus[0].compute_capability if info.gpus else None
+	if device_type == "cuda" and capability is not None and capability >= 8.0:
+		# the SDXL VAE overflows in fp16 - ampere and newer run it in bf16 at no cost
+		profile.args.append("--bf16-vae")
+	return profile
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Detect hardware and print the ComfyUI launch profile.')
+	parser.add_argument('--nvidia-smi', help='file with recorded nvidia-smi csv output')
+	parser.add_argument('--rocm-smi', help='file with recorded rocm-smi json output')
+	parser.add_argument('--meminfo', help='file with a recorded /proc/meminfo')
+	parser.add_argument('--system', help='platform.system() to simulate')
+	parser.add_argument('--machine', help='platform.machine() to simulate')
+	parser.add_argument('--cpu-count', type=int)
+	args = parser.parse_args()
+
+	recorded = {
+		NVIDIA_SMI_COMMAND[0] : args.nvidia_smi,
+		ROCM_SMI_COMMAND[0] : args.rocm_smi,
+	}
+	def run(command : list[str]) -> Optional[str]:
+		if any(recorded.values()):
+			return read_text(recorded[command[0]]) if recorded.get(command[0]) else None
+		return run_tool(command)
+	def read_file(filepath : str) -> Optional[str]:
+		if filepath == "/proc/meminfo" and args.meminfo:
+			return read_text(args.meminfo)
+		return read_text(filepath)
+
+	info = detect_hardware(run=run, read_file=read_file, system=args.system, machine=args.machine, cpu_count=args.cpu_count)
+	print(info.summary())
+	print(json.dumps(info.model_dump() if hasattr(info, "model_dump") else info.dict(), indent=1))
+	print("Launch profile:", launch_profile(info))
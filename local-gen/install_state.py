@@ -0,0 +1,131 @@
+'''
+Install-state manifest and launch configuration for the one-click installer.
+
+Every install step records a fingerprint of what it installed from (requirement file
+contents, the chosen device, ...) together with a fingerprint of the resulting package
+set. On the next launch a step whose fingerprints still match is skipped, so a warm
+relaunch goes straight to starting ComfyUI.
+
+The answers to the launch questions are kept in tools/config.json; edit or delete that
+file to change them.
+'''
+
+from pydantic import BaseModel
+from threading import RLock
+from typing import Optional
+
+import hashlib
+import json
+import os
+import subprocess
+
+INSTALL_STATE_FILEPATH : str = "tools/install_state.json"
+LAUNCH_CONFIG_FILEPATH : str = "tools/config.json"
+
+PACKAGES_FINGERPRINT_SCRIPT : str = "import importlib.metadata as m; print('\\n'.join(sorted(f\"{d.metadata['Name']}=={d.version}\" for d in m.distributions())))"
+
+class LaunchConfig(BaseModel):
+	# 0:cpu, 1:cuda, 2:amd/rocm, 3:intel (windows) or mac (linux/macos), 4:directml
+	device : Optional[int] = None
+	disable_cuda_malloc : Optional[bool] = None
+	# ask the launch questions again on every start
+	always_ask : bool = False
+	# extra arguments for python/main.py, e.g. ["--host", "0.0.0.0", "--clients", "tools/clients.json"]
+	proxy_arguments : list[str] = []
+
+def load_launch_config(filepath : str = LAUNCH_CONFIG_FILEPATH) -> LaunchConfig:
+	if os.path.exists(filepath) is False:
+		return LaunchConfig()
+	try:
+		with open(filepath, "r") as file:
+			return LaunchConfig(**json.load(file))
+	except Exception as e:
+		print(f"Unable to read {filepath} - the launch questions will be asked again: {e}")
+		return LaunchConfig()
+
+def save_launch_config(config : LaunchConfig, filepath : str = LAUNCH_CONFIG_FILEPATH) -> None:
+	os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+	with open(filepath, "w") as file:
+		json.dump({"device" : config.device, "disable_cuda_malloc" : config.disable_cuda_malloc, "always_ask" : config.always_ask, "proxy_arguments" : config.proxy_arguments}, file, indent=1)
+
+def fingerprint(*parts : object, files : Optional[list[str]] = None) -> str:
+	'''Fingerprint of the given values and the contents of the given files.'''
+	digest = hashlib.sha256()
+	for part in parts:
+		digest.update(repr(part).encode("utf-8"))
+	for filepath in files or []:
+		digest.update(filepath.encode("utf-8"))
+		if os.path.exists(filepath):
+			with open(filepath, "rb") as file:
+				digest.update(file.read())
+		else:
+			digest.update(b"<missing>")
+	return digest.hexdigest()
+
+def installed_packages_fingerprint(python_command : str) -> Optional[str]:
+	'''Fingerprint of the package set installed for the given python interpreter.'''
+	try:
+		result = subprocess.run([python_command, "-c", PACKAGES_FINGERPRINT_SCRIPT], capture_output=True, text=True, timeout=60)
+	except (OSError, subprocess.TimeoutExpired):
+		return None
+	if result.returncode != 0:
+		return None
+	return hashlib.sha256(result.stdout.encode("utf-8")).hexdigest()
+
+class InstallState:
+	'''Records which install steps are up to date.'''
+	filepath : str
+	steps : dict[str, dict]
+
+	def __init__(self, filepath : str = INSTALL_STATE_FILEPATH) -> None:
+		self.filepath = filepath
+		self.steps = {}
+		self._packages : dict[str, Optional[str]] = {}
+		self._lock = RLock() # install steps run on several threads
+		if os.path.exists(filepath):
+			try:
+				with open(filepath, "r") as file:
+					self.steps = json.load(file).get("steps", {})
+			except (OSError, ValueError):
+				print("Install state is unreadable - all install steps will run again.")
+
+	def save(self) -> None:
+		with self._lock:
+			os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+			temp_path = self.filepath + ".tmp"
+			with open(temp_path, "w") as file:
+				json.dump({"steps" : self.steps}, file, indent=1)
+			os.replace(temp_path, self.filepath)
+
+	def packages(self, python_command : str, refresh : bool = False) -> Optional[str]:
+		if refresh or python_command not in self._packages:
+			self._packages[python_command] = installed_packages_fingerprint(python_command)
+		return self._packages[python_command]
+
+	def is_current(self, step : str, inputs : str, python_command : Optional[str] = None) -> bool:
+		'''Check the step already ran with these inputs and the package set has not changed since.'''
+		record : Optional[dict] = self.steps.get(step)
+		if record is None or record.get("inputs") != inputs:
+			return False
+		if python_command is None:
+			return True
+		packages = self.packages(python_command)
+		return packages is not None and record.get("packages") == packages
+
+	def mark(self, step : str, inputs : str, python_command : Optional[str] = None, **extra : object) -> None:
+		'''Record that the step completed with these inputs.'''
+		packages = self.packages(python_command, refresh=True) if python_command else None
+		with self._lock:
+			self.steps[step] = {"inputs" : inputs, "packages" : packages, **extra}
+			if python_command is not None:
+				# other steps installed into the same interpreter now see the new package set
+				for record in self.steps.values():
+					if record.get("python") == python_command:
+						record["packages"] = packages
+			self.steps[step]["python"] = python_command
+			self.save()
+
+	def invalidate(self, step : str) -> None:
+		with self._lock:
+			if self.steps.pop(step, None) is not None:
+				self.save()
@@ -12,18 +12,25 @@ Installs the following:
 To uninstall, delete the "tools" folder under this folder and optionally uninstall git as needed.
 '''
 
+from downloader import EXTRACT_STATE_FILENAME, download_file, is_streamable_archive, stream_extract_tar
+from hardware import HardwareInfo, LaunchProfile, detect_hardware, launch_profile
+from supervisor import ManagedProcess, Supervisor
+from install_state import InstallState, LaunchConfig, fingerprint, load_launch_config, save_launch_config, INSTALL_STATE_FILEPATH, LAUNCH_CONFIG_FILEPATH
+from modelstore import ModelStore, MODEL_STORE_DIRECTORY
+from tasks import TaskGraph
+from wheelhouse import Wheelhouse, WHEELHOUSE_DIRECTORY
 from pydantic import BaseModel
 from typing import Optional, Union
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
+import hashlib
+import json
 import os
 import platform
 import re
 import requests
-import signal
 import subprocess
-import tarfile
-import time
 import patoolib
 import logging
 
@@ -31,6 +38,9 @@ CUSTOM_COMMAND_LINE_ARGS_FOR_COMFYUI = []
 
 COMFYUI_REPOSITORY_URL : str = "https://github.com/comfyanonymous/ComfyUI"
 COMFYUI_API_REPOSITORY_URL : str = "https://api.github.com/repos/comfyanonymous/ComfyUI"
+COMFYUI_HEALTH_URL : str = "http://127.0.0.1:8188/system_stats"
+PROXY_HEALTH_URL : str = "http://127.0.0.1:12500/echo"
+BLOB_STORE_DIRECTORY : str = "tools/blobs"
 COMFYUI_CUSTOM_NODES : list[str] = ["https://github.com/ltdrdata/ComfyUI-Manager", "https://github.com/john-mnz/ComfyUI-Inspyrenet-Rembg"]
 
 CIVITAI_MODELS_TO_DOWNLOAD : dict[str, str] = {"hassakuXLPony_v13BetterEyesVersion.safetensors" : "https://civitai.com/api/download/models/575495?type=Model&format=SafeTensor&size=pruned&fp=bf16"}
@@ -39,6 +49,12 @@ CIVITAI_LORAS_TO_DOWNLOAD : dict[str, str] = {"DallE3-magik.safetensors" : "http
 HUGGINGFACE_CHECKPOINTS_TO_DOWNLOAD : dict[str, str] = {"hassakuXLPony_v13BetterEyesVersion.safetensors" : "https://huggingface.co/FloricSpacer/AbyssDiverModels/resolve/main/hassakuXLPony_v13BetterEyesVersion.safetensors?download=true"}
 HUGGINGFACE_LORAS_TO_DOWNLOAD : dict[str, str] = {"DallE3-magik.safetensors" : "https://huggingface.co/FloricSpacer/AbyssDiverModels/resolve/main/DallE3-magik.safetensors?download=true"}
 
+# filename -> sha256 of the model files; when missing, the checksum HuggingFace advertises is used instead
+MODEL_CHECKSUMS : dict[str, str] = {}
+
+CUSTOM_NODES_STATE_FILENAME : str = ".abyssdiver-nodes.json"
+CUSTOM_NODES_REQUIREMENTS_FILENAME : str = ".abyssdiver-requirements.txt"
+
 WHITELISTED_OPERATION_SYSTEMS : list[str] = ["Linux", "Windows", "Darwin"]
 WINDOWS_ZIP_FILENAME : str = "ComfyUI_windows_portable_nvidia.7z"
 LINUX_ZIP_FILENAME : str = "source.tar.gz"
@@ -47,6 +63,34 @@ FILEPATH_FOR_7z : Optional[str] = None
 COMFYUI_INSTALLATION_FOLDER : Optional[str] = None
 PYTHON_COMMAND : Optional[str] = None
 
+MODEL_STORE : ModelStore = ModelStore(MODEL_STORE_DIRECTORY)
+INSTALL_STATE : InstallState = InstallState(INSTALL_STATE_FILEPATH)
+# pip installs go through a local wheel cache (see wheelhouse.py), one folder per platform and device
+WHEELHOUSE : Wheelhouse = Wheelhouse(WHEELHOUSE_DIRECTORY, run=lambda command: run_command(command, shell=True)[0])
+WHEELHOUSE_DEVICE : str = "cpu"
+# finished install steps of an install which failed part way (see tasks.py)
+INSTALL_TASKS_FILEPATH : str = "tools/install_tasks.json"
+
+# device answers of the launch questions -> hardware.py device types
+WINDOWS_DEVICE_TYPES : dict[int, str] = {0 : "cpu", 1 : "cuda", 2 : "directml", 3 : "intel", 4 : "directml"}
+LINUX_DEVICE_TYPES : dict[int, str] = {0 : "cpu", 1 : "cuda", 2 : "rocm", 3 : "mps"}
+
+HARDWARE_INFO : Optional[HardwareInfo] = None
+
+# pip arguments and messages for the torch build of each linux/macos device (0:cpu, 1:cuda, 2:rocm, 3:mac)
+TORCH_INSTALL_ARGUMENTS : dict[int, str] = {
+	0 : "torch torchvision torchaudio",
+	1 : "torch torchvision torchaudio --extra-index-url https://download.pytorch.org/whl/cu124",
+	2 : "torch torchvision torchaudio --index-url https://download.pytorch.org/whl/rocm6.1",
+	3 : "--pre torch torchvision torchaudio --extra-index-url https://download.pytorch.org/whl/nightly/cpu",
+}
+TORCH_INSTALL_MESSAGES : dict[int, str] = {
+	0 : "Installing CPU",
+	1 : "Installing Torch CUDA, please wait a moment.",
+	2 : "Installing Torch AMD ROCM, please wait a moment.",
+	3 : "Installing Metal CPU",
+}
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -72,37 +116,6 @@ def request_prompt(prompt : str, allowed_responses : list[str]) -> str:
 		value = input("")
 	return value
 
-def download_file(url: str, destination: str, range : bool = False) -> None:
-	"""Download a file from a URL and save it to a specified destination with support for resuming."""
-	headers = {}
-	if os.path.exists(destination) and range is True:
-		# Get the size of the partially downloaded file
-		existing_size = os.path.getsize(destination)
-		headers['Range'] = f'bytes={existing_size}-'
-	else:
-		existing_size = 0
-
-	response = requests.get(url, headers=headers, stream=True)
-	response.raise_for_status()
-
-	# Get the total file size from headers
-	total_size = int(response.headers.get('content-length', 0)) + existing_size
-	print(f"File size: {total_size / 1_000_000:.2f} MB")
-
-	split_amount = total_size / 10
-	counter = existing_size
-
-	# Open the file in append mode if resuming
-	with open(destination, 'ab') as file:
-		for data in response.iter_content(chunk_size=1024):
-			size = file.write(data)
-			counter += size
-			if counter >= split_amount:
-				print(f"{counter / 1_000_000:.2f} / {total_size / 1_000_000:.2f} MB")
-				split_amount += total_size / 10
-
-	print("Download complete.")
-
 def run_command(command: str, shell : bool = False) -> tuple[int, str]:
 	print('RUNNING COMMAND:')
 	print(command)
@@ -128,11 +141,6 @@ def run_command(command: str, shell : bool = False) -> tuple[int, str]:
 		print('EXCEPTION:', e)
 		return -1, str(e) # FAILED
 
-def unzip_targz(filepath : str, directory : str) -> None:
-	os.makedirs(directory, exist_ok=True)
-	with tarfile.open(filepath, 'r:gz') as tar_ref:
-			tar_ref.extractall(directory)
-
 def get_miniconda_cmdline_filepath() -> str:
 	os_platform : str = platform.system() # Windows, Linux, Darwin (MacOS)
 	path = Path(os.path.expanduser("~/miniconda3/condabin/conda")).as_posix()
@@ -153,13 +161,13 @@ def install_miniconda_for_os() -> None:
 	os.makedirs(directory, exist_ok=True)
 	print('Working Directory: ', directory)
 	if os_platform == "Windows":
-		os.chdir("tools/miniconda3")
+		# no os.chdir - other install steps run on other threads at the same time
+		installer_filepath : str = os.path.abspath(os.path.join("tools", "miniconda3", "miniconda.exe"))
 		logger.info("Downloading miniconda.exe")
-		download_file("https://repo.anaconda.com/miniconda/Miniconda3-latest-Windows-x86_64.exe", "miniconda.exe")
+		download_file("https://repo.anaconda.com/miniconda/Miniconda3-latest-Windows-x86_64.exe", installer_filepath)
 		logger.info("Installing miniconda.sh")
-		s, e = run_command("miniconda.exe /S", shell=True)
+		s, e = run_command(f"\"{installer_filepath}\" /S", shell=True)
 		assert s==0, e
-		os.chdir("../..")
 	elif os_platform == "Linux":
 		logger.info("Downloading miniconda.sh")
 		download_file("https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh", "tools/miniconda3/miniconda.sh")
@@ -193,8 +201,8 @@ def create_conda_env_var() -> None:
 
 	logger.info("Creating new environment.")
 	print('The python conda environment will take about 2.8GB in total on disk.')
-	print('Press enter to install the python 3.10.9 conda environment. The command displayed below will not run until you do so, and will wait until finished.')
-	command = f"{get_miniconda_cmdline_filepath()} create -n py3_10_9 python=3.10.9 anaconda"
+	# -y: runs alongside the other install steps, so it must not wait for input
+	command = f"{get_miniconda_cmdline_filepath()} create -y -n py3_10_9 python=3.10.9 anaconda"
 	if platform.platform() == "Windows":
 		command = "start " + command
 	run_command(command, shell=True)
@@ -286,16 +294,105 @@ def find_github_file_of_name(files : list[GithubFile], name : str) -> Optional[G
 			return item
 	return None
 
+def custom_node_folder_name(url : str) -> str:
+	name : str = url.rstrip("/").split("/")[-1]
+	return name[:-4] if name.endswith(".git") else name
+
+def clone_comfyui_node(url : str, custom_nodes_folder : str) -> tuple[str, Optional[str]]:
+	"""Shallow clone a custom node (if not already cloned) and return its folder name and commit."""
+	folder_name : str = custom_node_folder_name(url)
+	target : str = Path(os.path.join(custom_nodes_folder, folder_name)).as_posix()
+	if os.path.isdir(target) is False:
+		status, message = run_command(f"git clone --depth 1 --filter=blob:none \"{url}\" \"{target}\"", shell=True)
+		if status != 0:
+			print(f"Failed to clone {url}: {message}")
+			return folder_name, None
+	status, commit = run_command(f"git -C \"{target}\" rev-parse HEAD", shell=True)
+	return folder_name, (commit if status == 0 else None)
+
+def normalize_requirement_name(name : str) -> str:
+	return re.sub(r"[-_.]+", "-", name).lower()
+
+def merge_requirement_files(requirement_files : dict[str, str]) -> tuple[list[str], list[str]]:
+	"""
+	Merge the requirements.txt of several custom nodes into one list for a single pip resolve.
+
+	Specifiers for the same package are combined; differing exact pins are reported as
+	conflicts and the pin from the first node (in COMFYUI_CUSTOM_NODES order) is kept.
+	"""
+	merged : dict[str, list[str]] = {} # key -> [name, specifier, marker, owner]
+	verbatim : list[str] = []
+	conflicts : list[str] = []
+	for owner, filepath in requirement_files.items():
+		with open(filepath, "r", encoding="utf-8", errors="ignore") as file:
+			lines = file.read().splitlines()
+		for line in lines:
+			line = line.split(" #")[0].strip()
+			if line == "" or line.startswith("#") or line.startswith("-"):
+				continue
+			match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*(?:\[[^\]]*\])?)\s*([^;]*?)\s*(;.*)?$", line)
+			if match is None or "://" in line or " @ " in line:
+				if line not in verbatim:
+					verbatim.append(line)
+				continue
+			name, specifier, marker = match.group(1), match.group(2).replace(" ", ""), (match.group(3) or "").strip()
+			key : str = normalize_requirement_name(name.split("[")[0]) + marker
+			if key not in merged:
+				merged[key] = [name, specifier, marker, owner]
+				continue
+			existing = merged[key]
+			if specifier == "" or specifier == existing[1]:
+				continue
+			if existing[1] == "":
+				existing[1] = specifier
+			elif specifier.startswith("==") and existing[1].startswith("=="):
+				conflicts.append(f"{name}: {existing[3]} wants {existing[1]} but {owner} wants {specifier} - keeping {existing[1]}")
+			else:
+				existing[1] = ",".join(dict.fromkeys(existing[1].split(",") + specifier.split(",")))
+	lines : list[str] = [f"{name}{specifier}{' ' + marker if marker else ''}" for name, specifier, marker, _ in merged.values()]
+	return lines + verbatim, conflicts
+
+def hash_file(filepath : str) -> str:
+	with open(filepath, "rb") as file:
+		return hashlib.sha256(file.read()).hexdigest()
+
 def install_comfyui_nodes(custom_nodes_folder : str) -> None:
 	print("Installing ComfyUI Custom Nodes")
-	before_cwd : str = os.getcwd()
-	os.chdir(custom_nodes_folder)
-	for url in COMFYUI_CUSTOM_NODES:
-		run_command(f"git clone {url}", shell=True)
-	os.chdir(before_cwd)
+	os.makedirs(custom_nodes_folder, exist_ok=True)
+
+	with ThreadPoolExecutor(max_workers=max(1, len(COMFYUI_CUSTOM_NODES))) as executor:
+		commits : dict[str, Optional[str]] = dict(executor.map(lambda url : clone_comfyui_node(url, custom_nodes_folder), COMFYUI_CUSTOM_NODES))
+
 	py_exe = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "..", "python_embeded", "python.exe")).as_posix()
 	site_pckge_folder = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "..", "python_embeded", "Lib", "site-packages")).as_posix()
 
+	# the custom nodes we ship first, then any the user added themselves
+	folder_names : list[str] = list(commits.keys()) + sorted(
+		name for name in os.listdir(custom_nodes_folder)
+		if name not in commits and os.path.isdir(Path(os.path.join(custom_nodes_folder, name)).as_posix())
+	)
+	requirement_files : dict[str, str] = {}
+	for folder_name in folder_names:
+		req_txtfile = Path(os.path.join(custom_nodes_folder, folder_name, "requirements.txt")).as_posix()
+		if os.path.exists(req_txtfile):
+			requirement_files[folder_name] = req_txtfile
+
+	state_filepath : str = Path(os.path.join(custom_nodes_folder, CUSTOM_NODES_STATE_FILENAME)).as_posix()
+	state : dict = {"python" : py_exe if os.path.exists(py_exe) else PYTHON_COMMAND, "nodes" : {
+		folder_name : {"commit" : commits.get(folder_name), "requirements" : hash_file(requirement_files[folder_name]) if folder_name in requirement_files else None}
+		for folder_name in folder_names
+	}}
+	previous_state : Optional[dict] = None
+	if os.path.exists(state_filepath):
+		try:
+			with open(state_filepath, "r") as file:
+				previous_state = json.load(file)
+		except (OSError, ValueError):
+			previous_state = None
+	if previous_state == state:
+		print("Custom nodes and their requirements are unchanged - skipping dependency install.")
+		return
+
 	if platform.platform() == "Darwin":
 		print("You are required to have CMAKE installed for the transparent background node to install properly.")
 		print("You will need to accept the xcodebuild license of building apps on your device using CMAKE.")
@@ -308,25 +405,32 @@ def install_comfyui_nodes(custom_nodes_folder : str) -> None:
 		s2, e2 = run_command('brew install cmake', shell=True)
 		assert s2, e2
 
+	requirements, conflicts = merge_requirement_files(requirement_files)
+	for conflict in conflicts:
+		print(f"WARNING: conflicting custom node requirement - {conflict}")
+	if not any(re.match(r"pydantic\b", line, re.IGNORECASE) for line in requirements):
+		requirements.append("pydantic")
+
+	merged_txtfile : str = Path(os.path.join(custom_nodes_folder, CUSTOM_NODES_REQUIREMENTS_FILENAME)).as_posix()
+	with open(merged_txtfile, "w") as file:
+		file.write("\n".join(requirements) + "\n")
+	print(f"Installing merged requirements of {len(requirement_files)} custom node(s) in one resolve.")
+
 	if os.path.exists(py_exe):
-		run_command(f"\"{py_exe}\" -m pip install --no-user --target \"{site_pckge_folder}\" pydantic --verbose ", shell=True)
+		print('ComfyUI Embeded Python')
+		status = WHEELHOUSE.install(py_exe, f"-r \"{merged_txtfile}\"", WHEELHOUSE_DEVICE, install_arguments=f"--no-user --target \"{site_pckge_folder}\"")
 	else:
-		run_command(f"\"{PYTHON_COMMAND}\" -m pip install pydantic --verbose ", shell=True)
-
-	for folder_name in os.listdir(custom_nodes_folder):
-		if os.path.isdir(Path(os.path.join(custom_nodes_folder, folder_name)).as_posix()) is False:
-			continue
-		req_txtfile = Path(os.path.join(custom_nodes_folder, folder_name, "requirements.txt")).as_posix()
-		if os.path.exists(req_txtfile):
-			print(f'Installing requirements for: {folder_name} {req_txtfile}')
-			if os.path.exists(py_exe):
-				print('ComfyUI Embeded Python')
-				run_command(f"\"{py_exe}\" -m pip install --no-user --target \"{site_pckge_folder}\" -r \"{Path(req_txtfile).as_posix()}\"", shell=True)
-			else:
-				print('System Python')
-				run_command(f"\"{PYTHON_COMMAND}\" -m pip install -r \"{Path(req_txtfile).as_posix()}\" --verbose", shell=True)
+		print('System Python')
+		status = WHEELHOUSE.install(PYTHON_COMMAND, f"-r \"{merged_txtfile}\"", WHEELHOUSE_DEVICE, install_arguments="--verbose")
 
-	print("Installed ComfyUI Custom Nodes")
+	if status == 0:
+		with open(state_filepath, "w") as file:
+			json.dump(state, file, indent=1)
+		# the other steps installed into this interpreter now see the new package set
+		INSTALL_STATE.mark("custom_nodes", fingerprint(state), state["python"])
+		print("Installed ComfyUI Custom Nodes")
+	else:
+		print("Failed to install the custom node requirements - they will be retried on the next run.")
 
 def prompt_safetensor_file_install(folder : str, filename : str, download_url : str) -> None:
 	if os.path.exists(Path(os.path.join(folder, filename)).as_posix()) is True:
@@ -354,6 +458,7 @@ def install_comfyui_checkpoints(checkpoints_folder : str) -> None:
 		run_command(f"start '{download_url}'")
 		run_command(f"explorer {checkpoints_folder}")
 		prompt_safetensor_file_install(checkpoints_folder, filename, download_url)
+		MODEL_STORE.adopt(Path(os.path.join(checkpoints_folder, filename)).as_posix(), filename)
 		index += 1
 
 def install_comfyui_loras(loras_folder : str) -> None:
@@ -370,6 +475,7 @@ def install_comfyui_loras(loras_folder : str) -> None:
 		run_command(f"start '{download_url}'")
 		run_command(f"explorer {loras_folder}")
 		prompt_safetensor_file_install(loras_folder, filename, download_url)
+		MODEL_STORE.adopt(Path(os.path.join(loras_folder, filename)).as_posix(), filename)
 		index += 1
 
 def is_huggingface_models_available() -> bool:
@@ -383,42 +489,77 @@ def is_huggingface_models_available() -> bool:
 			return False
 	return True
 
+def expected_model_hash(name : str) -> Optional[str]:
+	"""The content hash a model file should have, if it is known."""
+	return MODEL_CHECKSUMS.get(name) or MODEL_STORE.hash_of(name)
+
+def is_model_installed(folder : str, name : str) -> bool:
+	"""Check the model exists in the folder and, when its hash is known, that the content matches."""
+	filepath : str = Path(os.path.join(folder, name)).as_posix()
+	if os.path.exists(filepath) is False:
+		return False
+	expected : Optional[str] = expected_model_hash(name)
+	if expected is None:
+		return True
+	return MODEL_STORE.is_installed(filepath, expected)
+
 def has_all_required_comfyui_models() -> bool:
 	if COMFYUI_INSTALLATION_FOLDER is None or os.path.exists(Path(COMFYUI_INSTALLATION_FOLDER).as_posix()) is False:
 		print("Missing ComfyUI.")
 		return False
 	checkpoints_folder : str = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "checkpoints")).as_posix()
 	for name, _ in HUGGINGFACE_CHECKPOINTS_TO_DOWNLOAD.items():
-		if os.path.exists(Path(os.path.join(checkpoints_folder, name)).as_posix()) is False:
+		if is_model_installed(checkpoints_folder, name) is False:
 			print(f"Missing Checkpoint: {Path(os.path.join(checkpoints_folder, name)).as_posix()}")
 			return False
 	loras_folder : str = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "loras")).as_posix()
 	for name, _ in HUGGINGFACE_LORAS_TO_DOWNLOAD.items():
-		if os.path.exists(Path(os.path.join(loras_folder, name)).as_posix()) is False:
+		if is_model_installed(loras_folder, name) is False:
 			print(f"Missing LORA: {Path(os.path.join(loras_folder, name)).as_posix()}")
 			return False
 	return True
 
-def install_comfyui_models_from_hugginface() -> None:
+def fetch_model_into_store(folder : str, name : str, url : str) -> str:
+	"""Make sure the model is in the shared model store, downloading it if needed, and return its hash."""
+	destination : str = Path(os.path.join(folder, name)).as_posix()
+	expected : Optional[str] = expected_model_hash(name)
+	if MODEL_STORE.has(expected):
+		return expected
+	if os.path.exists(destination) and (expected is None or MODEL_STORE.is_installed(destination, expected)):
+		# downloaded before the model store existed
+		return MODEL_STORE.adopt(destination, name)
+	print("Downloading:", name)
+	incoming : str = MODEL_STORE.incoming_path(name)
+	digest : str = download_file(url, incoming, sha256=MODEL_CHECKSUMS.get(name))
+	return MODEL_STORE.add_file(incoming, name, digest=digest)
+
+def install_model_from_store_or_url(folder : str, name : str, url : str) -> None:
+	"""Link the model from the shared model store, downloading it into the store first if needed."""
+	digest : str = fetch_model_into_store(folder, name, url)
+	print(f"Linking {name} from the model store.")
+	MODEL_STORE.link(digest, Path(os.path.join(folder, name)).as_posix())
+
+def get_huggingface_models() -> list[tuple[str, str, str]]:
+	"""The (models folder, filename, url) of every model downloaded from HuggingFace."""
 	checkpoints_folder : str = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "checkpoints")).as_posix()
-	for name, url in HUGGINGFACE_CHECKPOINTS_TO_DOWNLOAD.items():
-		print("Downloading:", name)
-		try:
-			download_file(url, Path(os.path.join(checkpoints_folder, name)).as_posix(), range=True)
-		except Exception as e:
-			print("Failed to download model file:")
-			print(e)
-			exit()
-
 	loras_folder : str = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "loras")).as_posix()
-	for name, url in HUGGINGFACE_LORAS_TO_DOWNLOAD.items():
-		print("Downloading:", name)
-		try:
-			download_file(url, Path(os.path.join(loras_folder, name)).as_posix(), range=True)
-		except Exception as e:
-			print("Failed to download model file:")
-			print(e)
-			exit()
+	return [(checkpoints_folder, name, url) for name, url in HUGGINGFACE_CHECKPOINTS_TO_DOWNLOAD.items()] + [(loras_folder, name, url) for name, url in HUGGINGFACE_LORAS_TO_DOWNLOAD.items()]
+
+def install_comfyui_models_from_hugginface() -> None:
+	for folder, name, url in get_huggingface_models():
+		install_model_from_store_or_url(folder, name, url)
+
+def install_comfyui_models_manually() -> None:
+	print("HuggingFace resource unavailable - manual installation needed.")
+	print("For this section you will be manually installing and placing safetensor (AI Model) files in the given directories.")
+	print("Both the directory and the download will automatically open/start when you proceed.")
+	print("This is REQUIRED to run the local generation.")
+	print(f"You will need to download a total of {len(CIVITAI_MODELS_TO_DOWNLOAD.values()) + len(CIVITAI_LORAS_TO_DOWNLOAD.values())} files.")
+	print("Press enter to continue...")
+	input()
+
+	install_comfyui_checkpoints(Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "checkpoints")).as_posix())
+	install_comfyui_loras(Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "loras")).as_posix())
 
 def download_comfyui_latest(filename : str, directory : str) -> None:
 	"""Download the latest release."""
@@ -435,92 +576,72 @@ def download_comfyui_latest(filename : str, directory : str) -> None:
 	if target_file is None:
 		raise ValueError(f"Unable to find latest release file for ComfyUI: {filename}")
 
-	download_file(target_file.browser_download_url, filepath, range=True)
-
-def install_comfyui_and_models_process(install_directory : str) -> None:
-	global COMFYUI_INSTALLATION_FOLDER
-
-	COMFYUI_INSTALLATION_FOLDER = Path(os.path.abspath(install_directory)).as_posix() # install_directory
+	download_file(target_file.browser_download_url, filepath)
 
-	if has_all_required_comfyui_models() is False:
-		print("="*20)
-		print("Note: The total file size required for Conda will add up over 2.2GB.")
-		print("Note: The total file size required for ComfyUI will add up over 9GB.")
-		print("Note: The total file size required for the Abyss Diver content will add up to 7.1GB")
-		print("You will need a total of at least 19.3GBs available.")
-		print("Press enter to continue...")
-		input()
-
-	print("ComfyUI is located at: ", Path(os.path.abspath(install_directory)).as_posix()) # install_directory)
-	install_comfyui_nodes(Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "custom_nodes")).as_posix())
-
-	print("="*20)
-
-	if has_all_required_comfyui_models():
-		print("All models are already downloaded - skipping step.")
+def download_and_extract_comfyui_latest(filename : str, directory : str, extract_directory : str, strip_components : int = 0) -> None:
+	"""Download and extract the latest release, extracting tar archives while they download."""
+	if is_streamable_archive(filename) is False:
+		# 7z and zip archives need their central directory, so they are downloaded first
+		download_comfyui_latest(filename, directory)
+		print(f"Extracting {filename} using patool.")
+		patoolib.extract_archive(Path(os.path.join(directory, filename)).as_posix(), outdir=extract_directory)
 		return
 
-	if is_huggingface_models_available():
-		print("HuggingFace resource is available - automatically downloading models.")
-		install_comfyui_models_from_hugginface()
-	else:
-		print("HuggingFace resource unavailable - manual installation needed.")
-		print("For this section you will be manually installing and placing safetensor (AI Model) files in the given directories.")
-		print("Both the directory and the download will automatically open/start when you proceed.")
-		print("This is REQUIRED to run the local generation.")
-		print(f"You will need to download a total of {len(CIVITAI_MODELS_TO_DOWNLOAD.values()) + len(CIVITAI_LORAS_TO_DOWNLOAD.values())} files.")
-		print("Press enter to continue...")
-		input()
+	target_file : Optional[GithubFile] = find_github_file_of_name(get_comfyui_latest_release_files(), filename)
+	if target_file is None:
+		raise ValueError(f"Unable to find latest release file for ComfyUI: {filename}")
+	print(f"Downloading and extracting {filename} to {extract_directory}.")
+	stream_extract_tar(target_file.browser_download_url, extract_directory, strip_components=strip_components)
 
-		install_comfyui_checkpoints(Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "checkpoints")).as_posix())
-		install_comfyui_loras(Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "models", "loras")).as_posix())
+def print_disk_space_notice() -> None:
+	print("="*20)
+	print("Note: The total file size required for Conda will add up over 2.2GB.")
+	print("Note: The total file size required for ComfyUI will add up over 9GB.")
+	print("Note: The total file size required for the Abyss Diver content will add up to 7.1GB")
+	print("You will need a total of at least 19.3GBs available.")
+	print("Press enter to continue...")
+	input()
+
+def get_comfyui_install_directory(os_platform : str) -> str:
+	if os_platform == "Windows":
+		return Path(os.path.abspath(os.path.join("tools", "ComfyUI_windows_portable", "ComfyUI"))).as_posix()
+	return Path(os.path.abspath(os.path.join("tools", "ComfyUI"))).as_posix()
 
 def comfyui_windows_installer() -> None:
 	"""Install the ComfyUI portable on Windows."""
 	directory : str = "tools"
 
 	# unzip the file if not already done
-	install_directory : str = Path(os.path.join(directory, "ComfyUI_windows_portable", "ComfyUI")).as_posix()
-
-	if os.path.isdir(Path(install_directory).as_posix()) is False:
-		download_git_portal_windows()
-
-		download_comfyui_latest(WINDOWS_ZIP_FILENAME, directory)
-
-		print("Extracting the 7zip file using patool.")
-		before_cwd = os.getcwd()
-		os.chdir(Path(os.path.abspath(directory)).as_posix())
-		try:
-			patoolib.extract_archive("ComfyUI_windows_portable_nvidia.7z", outdir=".")
-		except Exception as e:
-			print("Failed to extract ComfyUI_windows_portable_nvidia.7z - please do it manually.")
-			print(e)
-			exit()
-		os.chdir(before_cwd)
-	else:
+	if os.path.isdir(COMFYUI_INSTALLATION_FOLDER) is True:
 		print("ComfyUI is already downloaded - skipping unpacking and release download.")
+		return
 
-	install_comfyui_and_models_process(install_directory)
+	try:
+		download_and_extract_comfyui_latest(WINDOWS_ZIP_FILENAME, directory, directory)
+	except Exception as e:
+		print(f"Failed to extract {WINDOWS_ZIP_FILENAME} - please do it manually.")
+		raise e
 
 def comfyui_linux_installer() -> None:
 	"""Install ComfyUI on Linux"""
 	directory : str = "tools"
 
-	# install directory
-
-	install_directory = Path(os.path.abspath(os.path.join(directory, "ComfyUI"))).as_posix()
-	if os.path.exists(Path(install_directory).as_posix()) is False:
-		download_git_portal_linux() # make sure git is installed
-
-		os.chdir(directory)
+	if os.path.exists(os.path.join(COMFYUI_INSTALLATION_FOLDER, EXTRACT_STATE_FILENAME)):
+		# the release archive fallback was interrupted - the folder is only partly extracted
+		print("Resuming the interrupted ComfyUI release extraction.")
+		download_and_extract_comfyui_latest(LINUX_ZIP_FILENAME, directory, COMFYUI_INSTALLATION_FOLDER, strip_components=1)
+		return
 
-		status, message = run_command(f"git clone {COMFYUI_REPOSITORY_URL}", shell=True)
-		if "already exists" not in message:
-			assert status == 0, f"Failed to clone repository {COMFYUI_REPOSITORY_URL}: {message}"
+	if os.path.exists(COMFYUI_INSTALLATION_FOLDER) is True:
+		print("ComfyUI is already downloaded - skipping clone.")
+		return
 
-		os.chdir('..')
+	status, message = run_command(f"git clone {COMFYUI_REPOSITORY_URL} \"{COMFYUI_INSTALLATION_FOLDER}\"", shell=True)
 
-	install_comfyui_and_models_process(install_directory)
+	if status != 0 and "already exists" not in message:
+		print(f"Failed to clone repository {COMFYUI_REPOSITORY_URL}: {message}")
+		print("Falling back to the latest release archive.")
+		download_and_extract_comfyui_latest(LINUX_ZIP_FILENAME, directory, COMFYUI_INSTALLATION_FOLDER, strip_components=1)
 
 def ask_windows_gpu_cpu() -> int:
 	is_gpu_mode : str = request_prompt("Will you be running image generation on your graphics card? (y/n)", ["y", "n"])
@@ -569,115 +690,164 @@ def ask_linux_gpu_cpu() -> int:
 	print("You have a unsupported graphics card - will default to CPU mode.")
 	return 0
 
-def get_last_device() -> Optional[int]:
-	if os.path.exists('device') is False:
-		return None
-	try:
-		with open("device", "r") as file:
-			return int(file.read())
-	except:
-		return None
+def get_hardware_info() -> HardwareInfo:
+	global HARDWARE_INFO
+	if HARDWARE_INFO is None:
+		HARDWARE_INFO = detect_hardware()
+		print(f"Detected hardware: {HARDWARE_INFO.summary()}")
+	return HARDWARE_INFO
+
+def get_launch_device(ask_device, device_types : dict[int, str]) -> int:
+	"""Get the device from the launch config, otherwise offer the detected one before asking the questions."""
+	config : LaunchConfig = load_launch_config()
+	if config.device is not None and config.always_ask is False:
+		print(f"Using device {config.device} from {LAUNCH_CONFIG_FILEPATH} - delete that file to choose again.")
+		return config.device
+	hardware : HardwareInfo = get_hardware_info()
+	detected : Optional[int] = next((device for device, device_type in device_types.items() if device != 0 and device_type == hardware.device_type), None)
+	if detected is not None and request_prompt(f"Detected {hardware.summary()}. Run image generation on it? (y/n)", ["y", "n"]) == "y":
+		config.device = detected
+	else:
+		config.device = ask_device()
+	save_launch_config(config)
+	return config.device
+
+def get_launch_profile(device_type : str) -> LaunchProfile:
+	"""ComfyUI arguments tuned for the detected hardware and the chosen device."""
+	profile : LaunchProfile = launch_profile(get_hardware_info(), device_type=device_type)
+	print(f"ComfyUI launch profile: {' '.join(profile.args)}")
+	return profile
+
+def get_disable_cuda_malloc() -> bool:
+	config : LaunchConfig = load_launch_config()
+	if config.disable_cuda_malloc is None or config.always_ask is True:
+		config.disable_cuda_malloc = request_prompt("Are any of your currently plugged-in GPUs older than the 1060 series (but not including the 1060)? (y/n): ", ["y", "n"]) == "y"
+		save_launch_config(config)
+	return config.disable_cuda_malloc
+
+def pip_install_step(step : str, python_command : str, arguments : str, files : Optional[list[str]] = None, **extra : object) -> bool:
+	"""Run a pip install unless it already ran with the same inputs and the package set is unchanged."""
+	inputs : str = fingerprint(arguments, sorted(extra.items()), files=files)
+	if INSTALL_STATE.is_current(step, inputs, python_command):
+		print(f"Skipping {step} - already installed and unchanged.")
+		return True
+	status : int = WHEELHOUSE.install(python_command, arguments, WHEELHOUSE_DEVICE)
+	if status != 0:
+		return False
+	INSTALL_STATE.mark(step, inputs, python_command, **extra)
+	return True
 
-def write_last_device(device : int) -> None:
-	with open("device", "w") as file:
-		file.write(str(device))
+def require_pip_install_step(step : str, python_command : str, arguments : str, files : Optional[list[str]] = None, **extra : object) -> None:
+	"""pip_install_step for install tasks - a failed install fails the task."""
+	if pip_install_step(step, python_command, arguments, files=files, **extra) is False:
+		raise RuntimeError(f"pip install for {step} failed - see the output above.")
 
-def comfyui_windows_runner() -> subprocess.Popen:
-	"""Run the ComfyUI portable on Windows."""
-	assert COMFYUI_INSTALLATION_FOLDER, "COMFYUI_INSTALLATION_FOLDER is not set to anything - exiting."
+def get_embeded_python_filepath() -> str:
+	return os.path.abspath(f"{COMFYUI_INSTALLATION_FOLDER}/../python_embeded/python.exe")
 
-	print("Running ComfyUI.")
+def install_linux_torch(device : int) -> None:
+	last_device : Optional[int] = INSTALL_STATE.steps.get("torch", {}).get("device")
 
-	device : int = ask_windows_gpu_cpu() # 0:cpu, 1:cuda, 2:amd, 3:intel
+	# remove torch for it to be reinstalled for GPU
+	if device != 0 and last_device != device:
+		print('Uninstalling old torch.')
+		run_command(f"{PYTHON_COMMAND} -m pip uninstall -y torch", shell=True)
 
-	embeded_py_filepath = os.path.abspath(f"{COMFYUI_INSTALLATION_FOLDER}/../python_embeded/python.exe")
-	embeded_pip_filepath = os.path.abspath(f"{COMFYUI_INSTALLATION_FOLDER}/../python_embeded/Scripts/pip.exe")
+	print(TORCH_INSTALL_MESSAGES[device])
+	require_pip_install_step("torch", PYTHON_COMMAND, TORCH_INSTALL_ARGUMENTS[device], device=device)
 
-	process : subprocess.Popen = None
-	args = [embeded_py_filepath, "-s", "main.py", "--windows-standalone-build", '--disable-auto-launch'] + CUSTOM_COMMAND_LINE_ARGS_FOR_COMFYUI
+def install_comfyui_requirements() -> None:
+	print('Installing ComfyUI requirements')
+	requirements_abs = Path(os.path.abspath(os.path.join(COMFYUI_INSTALLATION_FOLDER, "requirements.txt"))).as_posix()
+	require_pip_install_step("comfyui_requirements", PYTHON_COMMAND, f"-r \"{requirements_abs}\"", files=[requirements_abs])
+
+def build_install_graph(os_platform : str, device : int, models : str) -> TaskGraph:
+	"""
+	The install steps and what each needs. `models` is "installed", "huggingface" or "manual".
+
+	pip installs into the same interpreter share a lock, everything else overlaps: the model
+	downloads only need the model store, so they start straight away and are linked into
+	ComfyUI once it is downloaded.
+	"""
+	graph : TaskGraph = TaskGraph(INSTALL_TASKS_FILEPATH)
+	custom_nodes_folder : str = Path(os.path.join(COMFYUI_INSTALLATION_FOLDER, "custom_nodes")).as_posix()
+
+	# the longest downloads are added first so they are started first
+	downloads : list[str] = []
+	if models == "huggingface":
+		for folder, name, url in get_huggingface_models():
+			downloads.append(graph.add(f"download:{name}", lambda folder=folder, name=name, url=url: fetch_model_into_store(folder, name, url)).name)
+
+	graph.add("conda", install_conda_for_python)
+	graph.add("git", download_git_portal_windows if os_platform == "Windows" else download_git_portal_linux, exclusive=True)
+	graph.add("comfyui", comfyui_windows_installer if os_platform == "Windows" else comfyui_linux_installer, after=["git"])
+	graph.add("proxy_requirements", lambda: require_pip_install_step("proxy_requirements", PYTHON_COMMAND, "-r requirements.txt", files=["requirements.txt"]), after=["conda"], locks=["pip:conda"])
 
-	if device != 0:
-		args.append('--lowvram')
+	if os_platform == "Windows":
+		# the custom nodes and DirectML go into the portable's embedded python
+		graph.add("custom_nodes", lambda: install_comfyui_nodes(custom_nodes_folder), after=["comfyui"], locks=["pip:embeded"])
+		if device == 2 or device == 4:
+			# amd/DirectML
+			graph.add("torch_directml", lambda: require_pip_install_step("torch_directml", get_embeded_python_filepath(), "torch_directml"), after=["comfyui"], locks=["pip:embeded"])
+	else:
+		graph.add("torch", lambda: install_linux_torch(device), after=["conda"], locks=["pip:conda"], key=str(device))
+		graph.add("comfyui_requirements", install_comfyui_requirements, after=["comfyui", "torch"], locks=["pip:conda"])
+		# after torch so the node requirements do not pull in a different torch build
+		graph.add("custom_nodes", lambda: install_comfyui_nodes(custom_nodes_folder), after=["comfyui", "torch"], locks=["pip:conda"])
+
+	if models == "huggingface":
+		graph.add("models", install_comfyui_models_from_hugginface, after=["comfyui", *downloads])
+	elif models == "manual":
+		graph.add("models", install_comfyui_models_manually, after=["comfyui"], exclusive=True)
+	return graph
+
+def comfyui_windows_runner(device : int) -> ManagedProcess:
+	"""Prepare the ComfyUI portable process on Windows."""
+	assert COMFYUI_INSTALLATION_FOLDER, "COMFYUI_INSTALLATION_FOLDER is not set to anything - exiting."
 
-	if device == 0:
-		# cpu
-		args.append("--cpu")
-	elif device == 2 or device == 4:
-		# amd/DirectML
-		print('Installing Torch DirectML. Please wait a moment.')
-		run_command(f'{embeded_pip_filepath} install torch_directml', shell=True)
-		args.append("--directml")
+	print("Running ComfyUI.")
 
-	print("Running the comfyui process.")
-	process = subprocess.Popen(args, cwd=COMFYUI_INSTALLATION_FOLDER, shell=False)
-	return process
+	profile : LaunchProfile = get_launch_profile(WINDOWS_DEVICE_TYPES[device])
 
-def comfyui_linux_runner() -> None:
-	"""Run ComfyUI on Linux"""
-	assert COMFYUI_INSTALLATION_FOLDER, "COMFYUI_INSTALLATION_FOLDER is not set to anything - exiting."
+	args = [get_embeded_python_filepath(), "-s", "main.py", "--windows-standalone-build", '--disable-auto-launch'] + CUSTOM_COMMAND_LINE_ARGS_FOR_COMFYUI
 
-	# 0:cpu, 1:cuda, 2:romc
-	last_device : Optional[int] = get_last_device()
-	device : int = ask_linux_gpu_cpu()
+	args += profile.args
 
-	# remove torch for it to be reinstalled for GPU
-	if device != 0 and (last_device is None or last_device != device):
-		print('Uninstalling old torch.')
-		run_command(f"{PYTHON_COMMAND} -m pip uninstall torch", shell=True)
-
-	if device == 0:
-		# CPU
-		print('Installing CPU')
-		run_command(f"{PYTHON_COMMAND} -m pip install torch torchvision torchaudio", shell=True)
-	elif device == 1:
-		# NVIDIA (CUDA)
-		print('Installing Torch CUDA, please wait a moment.')
-		run_command(f"{PYTHON_COMMAND} -m pip install torch torchvision torchaudio --extra-index-url https://download.pytorch.org/whl/cu124", shell=True)
-	elif device == 2:
-		# AMD (ROCM)
-		print('Installing Torch AMD ROCM, please wait a moment.')
-		run_command(f"{PYTHON_COMMAND} -m pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/rocm6.1", shell=True)
-	elif device ==3:
-		# Mac
-		print('Installing Metal CPU')
-		run_command(f"{PYTHON_COMMAND} -m pip install --pre torch torchvision torchaudio --extra-index-url https://download.pytorch.org/whl/nightly/cpu", shell=True)
-
-	write_last_device(device)
+	return ManagedProcess("ComfyUI", args, cwd=COMFYUI_INSTALLATION_FOLDER, env={**os.environ, **profile.env}, health_url=COMFYUI_HEALTH_URL)
 
-	print('Installing ComfyUI requirements')
-	requirements_abs = Path(os.path.abspath(os.path.join(COMFYUI_INSTALLATION_FOLDER, "requirements.txt"))).as_posix()
-	run_command(f"{PYTHON_COMMAND} -m pip install -r {requirements_abs}", shell=True)
+def comfyui_linux_runner(device : int, disable_cuda_malloc : bool) -> ManagedProcess:
+	"""Prepare the ComfyUI process on Linux/MacOS"""
+	assert COMFYUI_INSTALLATION_FOLDER, "COMFYUI_INSTALLATION_FOLDER is not set to anything - exiting."
+
+	# 0:cpu, 1:cuda, 2:romc, 3:mac
+	profile : LaunchProfile = get_launch_profile(LINUX_DEVICE_TYPES[device])
 
 	main_py_filepath = Path(os.path.abspath(os.path.join(COMFYUI_INSTALLATION_FOLDER, "main.py"))).as_posix()
 
-	process : subprocess.Popen = None
 	args = [PYTHON_COMMAND, "-s", main_py_filepath, '--disable-auto-launch'] + CUSTOM_COMMAND_LINE_ARGS_FOR_COMFYUI
 
-	if device != 0:
-		args.append('--lowvram')
-
-	if device == 0:
-		# cpu
-		print('Added CPU argument')
-		args.append("--cpu")
-	elif device == 1:
-		print("Check Cuda Malloc")
-		if request_prompt("Are any of your currently plugged-in GPUs older than the 1060 series (but not including the 1060)? (y/n): ", ["y", "n"]) == "y":
-			args.append("--disable-cuda-malloc")
-	elif device == 3:
-		# mac
-		print('Enable Mac Options')
-		args.append("--cpu --force-fp16")
-
-	print("Running the ComfyUI process.")
+	args += profile.args
+
+	if device == 1 and disable_cuda_malloc:
+		args.append("--disable-cuda-malloc")
+
 	print(args, COMFYUI_INSTALLATION_FOLDER)
-	process = subprocess.Popen(args, cwd=COMFYUI_INSTALLATION_FOLDER, shell=False)
-	return process
+	return ManagedProcess("ComfyUI", args, cwd=COMFYUI_INSTALLATION_FOLDER, env={**os.environ, **profile.env}, health_url=COMFYUI_HEALTH_URL)
 
-def proxy_runner() -> subprocess.Popen:
-	return subprocess.Popen([PYTHON_COMMAND, 'python/main.py'], shell=False)
+def proxy_runner() -> ManagedProcess:
+	proxy_arguments : list[str] = load_launch_config().proxy_arguments
+	return ManagedProcess("Proxy", [PYTHON_COMMAND, 'python/main.py', '--blob-store', BLOB_STORE_DIRECTORY, *proxy_arguments], health_url=PROXY_HEALTH_URL, ready_timeout=120.0, unresponsive_timeout=60.0)
+
+def get_conda_python_command(os_platform : str) -> str:
+	if os_platform == "Windows":
+		return Path(os.path.join(get_conda_env_directory(), "python.exe")).as_posix()
+	return Path(os.path.join(get_conda_env_directory(), "bin", "python3.10")).as_posix()
 
 def main() -> None:
+	global PYTHON_COMMAND
+	global COMFYUI_INSTALLATION_FOLDER
+	global WHEELHOUSE_DEVICE
+
 	os_platform : str = platform.system() # Windows, Linux, Darwin (MacOS)
 
 	available_ops : str = ", ".join(WHITELISTED_OPERATION_SYSTEMS)
@@ -685,58 +855,54 @@ def main() -> None:
 
 	print(f'Running one-click-comfyui on operating system {os_platform}.')
 
-	print("Checking conda.")
-	install_conda_for_python()
-
-	get_windows_miniconda_envs_folder()
+	PYTHON_COMMAND = get_conda_python_command(os_platform)
+	COMFYUI_INSTALLATION_FOLDER = get_comfyui_install_directory(os_platform)
+	print("ComfyUI is located at: ", COMFYUI_INSTALLATION_FOLDER)
 
+	# every question is asked before the install steps start running side by side
 	if os_platform == "Windows":
-		py_cmd = Path(os.path.join(get_conda_env_directory(), "python.exe")).as_posix()
-	elif os_platform == "Darwin":
-		py_cmd = Path(os.path.join(get_conda_env_directory(), "bin", "python3.10")).as_posix()
-	elif os_platform == "Linux":
-		py_cmd = Path(os.path.join(get_conda_env_directory(), "bin", "python3.10")).as_posix()
-
-	version = "3.10.9"
-
-	print(py_cmd)
-	assert os.path.exists(py_cmd), "Conda failed to install."
-
-	print(py_cmd, version)
-
-	global PYTHON_COMMAND
-	PYTHON_COMMAND = py_cmd
+		device : int = get_launch_device(ask_windows_gpu_cpu, WINDOWS_DEVICE_TYPES) # 0:cpu, 1:cuda, 2:amd, 3:intel, 4:directml
+	else:
+		device = get_launch_device(ask_linux_gpu_cpu, LINUX_DEVICE_TYPES) # 0:cpu, 1:cuda, 2:romc, 3:mac
+	WHEELHOUSE_DEVICE = (WINDOWS_DEVICE_TYPES if os_platform == "Windows" else LINUX_DEVICE_TYPES)[device]
+	disable_cuda_malloc : bool = os_platform != "Windows" and device == 1 and get_disable_cuda_malloc()
 
-	print(f"Found python ({py_cmd}) of version {version}.")
+	if has_all_required_comfyui_models():
+		print("All models are already downloaded - skipping step.")
+		models : str = "installed"
+	else:
+		print_disk_space_notice()
+		if is_huggingface_models_available():
+			print("HuggingFace resource is available - automatically downloading models.")
+			models = "huggingface"
+		else:
+			models = "manual"
 
-	run_command(f"\"{PYTHON_COMMAND}\" -m pip install -r requirements.txt", shell=True)
+	print(f'Installing for {os_platform}!')
+	if build_install_graph(os_platform, device, models).run() is False:
+		return
 
-	process_proxy : subprocess.Popen
-	process_comfyui : subprocess.Popen
+	print(f"Found python ({PYTHON_COMMAND}).")
 
-	if os_platform == "Windows":
-		print('Installing for Windows!')
-		comfyui_windows_installer()
-		process_proxy = proxy_runner()
-		time.sleep(3) # let proxy output its message first
-		process_comfyui = comfyui_windows_runner()
-	elif os_platform == "Linux" or os_platform == "Darwin":
-		print(f'Installing for {os_platform}!')
-		comfyui_linux_installer()
-		print('Running proxy.')
-		process_proxy = proxy_runner()
-		time.sleep(3) # let proxy output its message first
-		print('Running main.')
-		process_comfyui = comfyui_linux_runner()
-	else:
-		exit()
+	supervisor = Supervisor()
 
 	try:
-		process_proxy.wait() # wait for process to terminate
-		process_comfyui.wait() # wait for comfyui to terminate
+		print('Running proxy.')
+		if supervisor.start(proxy_runner()) is False: # let proxy output its message first
+			print("ERROR: The proxy did not start, so the game cannot reach ComfyUI. Check its output above - another program using port 12500 is a common cause.")
+			supervisor.stop()
+			return
+		print('Running ComfyUI.')
+		if os_platform == "Windows":
+			supervisor.start(comfyui_windows_runner(device))
+		else:
+			supervisor.start(comfyui_linux_runner(device, disable_cuda_malloc))
 	except KeyboardInterrupt: # CTRL+C
-		os.kill(process_proxy.pid, signal.SIGTERM)
-		os.kill(process_comfyui.pid, signal.SIGTERM)
+		supervisor.stop()
+		return
+
+	supervisor.install_signal_handlers()
+	supervisor.run()
 
 def install_conda_for_python() -> None:
 	if has_miniconda_been_installed() is False:
@@ -748,6 +914,7 @@ def install_conda_for_python() -> None:
 		print("Creating Conda Environment.")
 		create_conda_env_var()
 	assert os.path.exists(get_conda_env_directory()), "Conda Environment does not exist."
+	assert os.path.exists(PYTHON_COMMAND), "Conda failed to install."
 	print("Conda Environment exists.")
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+'''
+Content-addressed model store shared by every ComfyUI install under "tools".
+
+Model files are kept once under tools/models/sha256/<ab>/<sha256> and linked into each
+install's models folders (hardlink, falling back to a symlink and then a copy). The
+index remembers which filename maps to which hash and caches file hashes by size and
+mtime so checking an install does not re-read gigabytes every launch.
+
+Usage:
+	python modelstore.py list
+	python modelstore.py verify
+	python modelstore.py gc
+'''
+
+from pathlib import Path
+from threading import RLock
+from typing import Optional
+
+import argparse
+import json
+import os
+import shutil
+
+from downloader import sha256_of_file
+
+MODEL_STORE_DIRECTORY : str = "tools/models"
+MODEL_FOLDER_NAMES : list[str] = ["checkpoints", "loras"]
+
+class ModelStore:
+	'''Hash-keyed model file storage with linking into ComfyUI installs.'''
+	root : str
+
+	def __init__(self, root : str = MODEL_STORE_DIRECTORY) -> None:
+		self.root = Path(os.path.abspath(root)).as_posix()
+		self._lock = RLock()
+		self._index : Optional[dict] = None
+
+	@property
+	def index_path(self) -> str:
+		return Path(os.path.join(self.root, "index.json")).as_posix()
+
+	@property
+	def incoming_directory(self) -> str:
+		return Path(os.path.join(self.root, "incoming")).as_posix()
+
+	def _load_index(self) -> dict:
+		if self._index is None:
+			self._index = {'names' : {}, 'hash_cache' : {}}
+			if os.path.exists(self.index_path):
+				try:
+					with open(self.index_path, 'r') as file:
+						self._index.update(json.load(file))
+				except (OSError, ValueError):
+					print("Model store index is unreadable - it will be rebuilt.")
+		return self._index
+
+	def _save_index(self) -> None:
+		os.makedirs(self.root, exist_ok=True)
+		temp_path = self.index_path + '.tmp'
+		with open(temp_path, 'w') as file:
+			json.dump(self._load_index(), file, indent=1)
+		os.replace(temp_path, self.index_path)
+
+	def object_path(self, digest : str) -> str:
+		return Path(os.path.join(self.root, "sha256", digest[:2], digest)).as_posix()
+
+	def has(self, digest : Optional[str]) -> bool:
+		return digest is not None and os.path.isfile(self.object_path(digest))
+
+	def hash_of(self, name : str) -> Optional[str]:
+		'''The hash last stored under the given model filename.'''
+		with self._lock:
+			return self._load_index()['names'].get(name)
+
+	def incoming_path(self, name : str) -> str:
+		'''Where to download a model before it is added to the store.'''
+		os.makedirs(self.incoming_directory, exist_ok=True)
+		return Path(os.path.join(self.incoming_directory, name)).as_posix()
+
+	def file_digest(self, filepath : str) -> str:
+		'''SHA-256 of a file, cached on its size and modification time.'''
+		filepath = Path(os.path.abspath(filepath)).as_posix()
+		stat = os.stat(filepath)
+		key = [stat.st_size, stat.st_mtime_ns]
+		with self._lock:
+			cached = self._load_index()['hash_cache'].get(filepath)
+			if cached is not None and cached[:2] == key:
+				return cached[2]
+		print(f"Hashing {os.path.basename(filepath)}...")
+		digest = sha256_of_file(filepath)
+		with self._lock:
+			self._load_index()['hash_cache'][filepath] = key + [digest]
+			self._save_index()
+		return digest
+
+	def add_file(self, filepath : str, name : str, digest : Optional[str] = None) -> str:
+		'''Move a file into the store under its content hash and return the hash.'''
+		digest = digest or self.file_digest(filepath)
+		target = self.object_path(digest)
+		with self._lock:
+			if os.path.exists(target):
+				os.remove(filepath)
+			else:
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				shutil.move(filepath, target)
+			index = self._load_index()
+			index['names'][name] = digest
+			index['hash_cache'].pop(Path(os.path.abspath(filepath)).as_posix(), None)
+			self._remember(target, digest)
+		return digest
+
+	def link(self, digest : str, destination : str) -> None:
+		'''Place the stored object at destination, preferring a hardlink.'''
+		source = self.object_path(digest)
+		assert os.path.exists(source), f"Model {digest} is not in the store."
+		if os.path.lexists(destination):
+			if os.path.exists(destination) and os.path.samefile(source, destination):
+				return
+			os.remove(destination)
+		os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+		try:
+			os.link(source, destination)
+		except OSError:
+			try:
+				os.symlink(source, destination)
+			except OSError:
+				print(f"Unable to link {os.path.basename(destination)} - copying it instead.")
+				shutil.copyfile(source, destination)
+		self._remember(destination, digest)
+
+	def _remember(self, filepath : str, digest : str) -> None:
+		filepath = Path(os.path.abspath(filepath)).as_posix()
+		stat = os.stat(filepath)
+		with self._lock:
+			self._load_index()['hash_cache'][filepath] = [stat.st_size, stat.st_mtime_ns, digest]
+			self._save_index()
+
+	def adopt(self, filepath : str, name : str) -> str:
+		'''Move an existing model file into the store and link it back in place.'''
+		if os.path.islink(filepath):
+			return self.file_digest(filepath)
+		digest = self.file_digest(filepath)
+		if not self.has(digest) or not os.path.samefile(self.object_path(digest), filepath):
+			staged = self.incoming_path(name)
+			shutil.move(filepath, staged)
+			self.add_file(staged, name, digest=digest)
+			self.link(digest, filepath)
+		with self._lock:
+			self._load_index()['names'][name] = digest
+			self._save_index()
+		return digest
+
+	def is_installed(self, destination : str, digest : str) -> bool:
+		'''Check the model at destination has the expected content hash.'''
+		if not os.path.exists(destination):
+			return False
+		return self.file_digest(destination) == digest
+
+	def objects(self) -> list[str]:
+		'''All hashes currently held in the store.'''
+		folder = os.path.join(self.root, "sha256")
+		if not os.path.isdir(folder):
+			return []
+		return sorted(name for prefix in os.listdir(folder) for name in os.listdir(os.path.join(folder, prefix)))
+
+	def verify(self) -> list[str]:
+		'''Re-hash every stored object and return the hashes which are corrupt.'''
+		corrupt : list[str] = []
+		for digest in self.objects():
+			print(f"Verifying {digest}...")
+			if sha256_of_file(self.object_path(digest)) != digest:
+				print(f"Corrupt object: {digest}")
+				corrupt.append(digest)
+		return corrupt
+
+	def gc(self, model_folders : list[str], dry_run : bool = False) -> int:
+		'''Remove objects which no install links to and no model name refers to. Returns bytes freed.'''
+		referenced : set[str] = set(self._load_index()['names'].values())
+		for folder in model_folders:
+			if not os.path.isdir(folder):
+				continue
+			for entry in os.scandir(folder):
+				if entry.is_symlink():
+					referenced.add(os.path.basename(os.path.realpath(entry.path)))
+		freed = 0
+		for digest in self.objects():
+			path = self.object_path(digest)
+			# a hardlinked object has more than one link while any install still uses it
+			if digest in referenced or os.stat(path).st_nlink > 1:
+				continue
+			size = os.path.getsize(path)
+			print(f"Removing unreferenced object {digest} ({size / 1_000_000:.2f} MB)")
+			if not dry_run:
+				os.remove(path)
+			freed += size
+		with self._lock:
+			index = self._load_index()
+			index['hash_cache'] = {path : value for path, value in index['hash_cache'].items() if os.path.exists(path)}
+			if not dry_run:
+				self._save_index()
+		return freed
+
+def find_install_model_folders(tools_directory : str = "tools") -> list[str]:
+	'''Find the checkpoint/lora folders of every ComfyUI install under the tools folder.'''
+	folders : list[str] = []
+	root = Path(tools_directory)
+	for models_folder in list(root.glob("ComfyUI/models")) + list(root.glob("*/ComfyUI/models")):
+		for name in MODEL_FOLDER_NAMES:
+			folders.append((models_folder / name).as_posix())
+	return folders
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Manage the shared ComfyUI model store.')
+	parser.add_argument('command', choices=['list', 'verify', 'gc'])
+	parser.add_argument('--root', default=MODEL_STORE_DIRECTORY)
+	parser.add_argument('--dry-run', action='store_true', help='(gc) only report what would be removed')
+	args = parser.parse_args()
+
+	store = ModelStore(args.root)
+	if args.command == 'list':
+		names = store._load_index()['names']
+		for digest in store.objects():
+			labels = ", ".join(name for name, value in names.items() if value == digest) or "(unnamed)"
+			print(f"{digest}  {os.path.getsize(store.object_path(digest)) / 1_000_000:>10.2f} MB  {labels}")
+	elif args.command == 'verify':
+		corrupt = store.verify()
+		print(f"{len(corrupt)} corrupt object(s).")
+		exit(1 if corrupt else 0)
+	elif args.command == 'gc':
+		freed = store.gc(find_install_model_folders(), dry_run=args.dry_run)
+		print(f"Freed {freed / 1_000_000:.2f} MB.")
@@ -0,0 +1,108 @@
+'''
+Indexed asset packs of pre-rendered images.
+
+A pack is a single file:
+
+	header : magic (8 bytes), index offset (u64), index length (u64) - little endian
+	data   : the image files, back to back, exactly as ComfyUI saved them
+	index  : UTF-8 JSON {"version" : 1, "entries" : {name : [offset, length, sha256, content_type]}}
+
+Identical images are stored once and several names may point at the same bytes, so
+the pack can be served (whole or by byte range) straight from disk without decoding.
+'''
+
+from typing import Optional
+
+import hashlib
+import json
+import os
+import struct
+import threading
+
+MAGIC : bytes = b"ADPACK\x00\x01"
+HEADER = struct.Struct("<8sQQ")
+VERSION : int = 1
+
+class AssetEntry:
+	offset : int
+	length : int
+	sha256 : str
+	content_type : str
+
+	def __init__(self, offset : int, length : int, sha256 : str, content_type : str) -> None:
+		self.offset = offset
+		self.length = length
+		self.sha256 = sha256
+		self.content_type = content_type
+
+class AssetPackWriter:
+	'''Write a pack through a temporary file which replaces the target on close().'''
+
+	def __init__(self, path : str) -> None:
+		self.path = path
+		self.temp_path = f"{path}.{os.getpid()}.tmp"
+		self._file = open(self.temp_path, "wb")
+		self._file.write(HEADER.pack(MAGIC, 0, 0))
+		self._entries : dict[str, AssetEntry] = {}
+		self._by_hash : dict[str, AssetEntry] = {}
+		self.stored_bytes = 0
+
+	def add(self, name : str, data : bytes, content_type : str = "image/png") -> AssetEntry:
+		if name in self._entries:
+			raise ValueError(f"Duplicate asset name '{name}'.")
+		sha256 = hashlib.sha256(data).hexdigest()
+		existing = self._by_hash.get(sha256)
+		if existing is None:
+			existing = AssetEntry(self._file.tell(), len(data), sha256, content_type)
+			self._file.write(data)
+			self._by_hash[sha256] = existing
+			self.stored_bytes += len(data)
+		self._entries[name] = existing
+		return existing
+
+	def close(self) -> None:
+		index = {"version" : VERSION, "entries" : {name : [entry.offset, entry.length, entry.sha256, entry.content_type] for name, entry in sorted(self._entries.items())}}
+		index_data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+		index_offset = self._file.tell()
+		self._file.write(index_data)
+		self._file.seek(0)
+		self._file.write(HEADER.pack(MAGIC, index_offset, len(index_data)))
+		self._file.close()
+		os.replace(self.temp_path, self.path)
+
+	def discard(self) -> None:
+		self._file.close()
+		os.remove(self.temp_path)
+
+class AssetPack:
+	'''Read-only, thread-safe access to a pack written by AssetPackWriter.'''
+
+	def __init__(self, path : str) -> None:
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = open(path, "rb")
+		magic, index_offset, index_length = HEADER.unpack(self._file.read(HEADER.size))
+		if magic != MAGIC:
+			raise ValueError(f"{path} is not an asset pack.")
+		self._file.seek(index_offset)
+		index = json.loads(self._file.read(index_length).decode("utf-8"))
+		self.entries : dict[str, AssetEntry] = {name : AssetEntry(*values) for name, values in index["entries"].items()}
+
+	def names(self) -> list[str]:
+		return list(self.entries.keys())
+
+	def info(self, name : str) -> Optional[AssetEntry]:
+		return self.entries.get(name)
+
+	def read(self, name : str, start : int = 0, end : Optional[int] = None) -> Optional[bytes]:
+		'''Return the asset (or the bytes start..end inclusive), or None when it is not in the pack.'''
+		entry = self.entries.get(name)
+		if entry is None:
+			return None
+		end = entry.length - 1 if end is None else min(end, entry.length - 1)
+		with self._lock:
+			self._file.seek(entry.offset + start)
+			return self._file.read(max(0, end - start + 1))
+
+	def close(self) -> None:
+		self._file.close()
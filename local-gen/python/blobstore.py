@@ -0,0 +1,189 @@
+'''
+Content-addressed blob store for generated images and large save payloads.
+
+Blobs are stored under their SHA-256 in <root>/<ab>/<hash>, zlib-compressed when that
+makes them smaller (PNGs usually are not, JSON saves are). The store is capped in size
+and evicts the least recently used blobs first; the order is kept in the file mtimes,
+so it survives restarts without a separate database.
+'''
+
+from collections import OrderedDict
+from typing import Optional
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+COMPRESSED_SUFFIX : str = ".z"
+INDEX_FILENAME : str = "index.json"
+DEFAULT_MAX_BYTES : int = 2 * 1024 * 1024 * 1024
+COMPRESSION_LEVEL : int = 6
+
+class BlobInfo:
+	size : int # uncompressed size
+	stored_size : int
+	content_type : str
+	compressed : bool
+
+	def __init__(self, size : int, stored_size : int, content_type : str, compressed : bool) -> None:
+		self.size = size
+		self.stored_size = stored_size
+		self.content_type = content_type
+		self.compressed = compressed
+
+class BlobStore:
+	'''Thread-safe content-addressed store with a size cap and LRU eviction.'''
+	root : str
+	max_bytes : int
+
+	def __init__(self, root : str, max_bytes : int = DEFAULT_MAX_BYTES) -> None:
+		self.root = root
+		self.max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self._blobs : OrderedDict[str, BlobInfo] = OrderedDict()
+		self._stored_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		os.makedirs(root, exist_ok=True)
+		self._load()
+
+	@staticmethod
+	def is_valid_hash(blob_hash : str) -> bool:
+		return HASH_PATTERN.match(blob_hash) is not None
+
+	def _path(self, blob_hash : str, compressed : bool) -> str:
+		return os.path.join(self.root, blob_hash[:2], blob_hash + (COMPRESSED_SUFFIX if compressed else ""))
+
+	def _load(self) -> None:
+		'''Rebuild the LRU order from the blobs on disk (oldest mtime first).'''
+		content_types : dict[str, str] = {}
+		try:
+			with open(os.path.join(self.root, INDEX_FILENAME), "r") as file:
+				content_types = json.load(file)
+		except (OSError, ValueError):
+			pass
+		found : list[tuple[float, str, BlobInfo]] = []
+		for directory, _, filenames in os.walk(self.root):
+			for filename in filenames:
+				blob_hash = filename.removesuffix(COMPRESSED_SUFFIX)
+				if self.is_valid_hash(blob_hash) is False:
+					continue
+				filepath = os.path.join(directory, filename)
+				stat = os.stat(filepath)
+				compressed = filename.endswith(COMPRESSED_SUFFIX)
+				entry = content_types.get(blob_hash, {})
+				info = BlobInfo(entry.get("size", stat.st_size), stat.st_size, entry.get("content_type", "application/octet-stream"), compressed)
+				found.append((stat.st_mtime, blob_hash, info))
+		for _, blob_hash, info in sorted(found, key=lambda item: item[0]):
+			self._blobs[blob_hash] = info
+			self._stored_bytes += info.stored_size
+
+	def _save_index(self) -> None:
+		index = {blob_hash : {"size" : info.size, "content_type" : info.content_type} for blob_hash, info in self._blobs.items()}
+		temp_path = os.path.join(self.root, INDEX_FILENAME + ".tmp")
+		with open(temp_path, "w") as file:
+			json.dump(index, file)
+		os.replace(temp_path, os.path.join(self.root, INDEX_FILENAME))
+
+	def _evict(self, keep : str) -> None:
+		while self._stored_bytes > self.max_bytes and len(self._blobs) > 1:
+			blob_hash, info = next(iter(self._blobs.items()))
+			if blob_hash == keep:
+				self._blobs.move_to_end(blob_hash)
+				continue
+			self._remove(blob_hash)
+			self.evictions += 1
+
+	def _remove(self, blob_hash : str) -> None:
+		info = self._blobs.pop(blob_hash)
+		self._stored_bytes -= info.stored_size
+		try:
+			os.remove(self._path(blob_hash, info.compressed))
+		except FileNotFoundError:
+			pass
+
+	def put(self, data : bytes, content_type : str = "application/octet-stream", expected_hash : Optional[str] = None) -> str:
+		'''Store the data and return its hash. Raises ValueError when expected_hash does not match.'''
+		blob_hash = hashlib.sha256(data).hexdigest()
+		if expected_hash is not None and expected_hash != blob_hash:
+			raise ValueError(f"Content hash is {blob_hash}, not {expected_hash}.")
+		with self._lock:
+			if blob_hash in self._blobs:
+				self._touch(blob_hash)
+				return blob_hash
+			compressed_data = zlib.compress(data, COMPRESSION_LEVEL)
+			compressed = len(compressed_data) < len(data)
+			stored = compressed_data if compressed else data
+			filepath = self._path(blob_hash, compressed)
+			os.makedirs(os.path.dirname(filepath), exist_ok=True)
+			temp_path = filepath + ".tmp"
+			with open(temp_path, "wb") as file:
+				file.write(stored)
+			os.replace(temp_path, filepath)
+			self._blobs[blob_hash] = BlobInfo(len(data), len(stored), content_type, compressed)
+			self._stored_bytes += len(stored)
+			self._evict(keep=blob_hash)
+			self._save_index()
+		return blob_hash
+
+	def _touch(self, blob_hash : str) -> None:
+		self._blobs.move_to_end(blob_hash)
+		now = time.time()
+		try:
+			os.utime(self._path(blob_hash, self._blobs[blob_hash].compressed), (now, now))
+		except FileNotFoundError:
+			pass
+
+	def info(self, blob_hash : str) -> Optional[BlobInfo]:
+		with self._lock:
+			return self._blobs.get(blob_hash)
+
+	def get(self, blob_hash : str, start : int = 0, end : Optional[int] = None) -> Optional[bytes]:
+		'''Return the blob (or the bytes start..end inclusive), or None when it is not stored.'''
+		with self._lock:
+			info = self._blobs.get(blob_hash)
+			if info is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self._touch(blob_hash)
+			filepath = self._path(blob_hash, info.compressed)
+			compressed = info.compressed
+		try:
+			with open(filepath, "rb") as file:
+				if compressed is False:
+					file.seek(start)
+					return file.read(None if end is None else end - start + 1)
+				data = zlib.decompress(file.read())
+		except FileNotFoundError:
+			with self._lock:
+				if blob_hash in self._blobs:
+					self._remove(blob_hash)
+			return None
+		return data[start:None if end is None else end + 1]
+
+	def delete(self, blob_hash : str) -> bool:
+		with self._lock:
+			if blob_hash not in self._blobs:
+				return False
+			self._remove(blob_hash)
+			self._save_index()
+			return True
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"blobs" : len(self._blobs),
+				"stored_bytes" : self._stored_bytes,
+				"size_bytes" : sum(info.size for info in self._blobs.values()),
+				"max_bytes" : self.max_bytes,
+				"hits" : self.hits,
+				"misses" : self.misses,
+				"evictions" : self.evictions,
+			}
@@ -3,7 +3,7 @@
 # pip install pydantic pillow websockets-client aiohttp
 
 from io import BytesIO
-from typing import Literal, Optional, Union
+from typing import Awaitable, Callable, Literal, Optional, TypeVar, Union
 from urllib.parse import urlencode
 from uuid import uuid4
 from PIL import Image
@@ -12,9 +12,14 @@ import aiohttp
 import asyncio
 import base64
 import json
+import math
+import random
+import time
 import traceback
 import websockets
 
+T = TypeVar("T")
+
 COMFYUI_IMAGE_TYPE = Literal["input", "output", "temp"]
 
 COMFYUI_SAMPLERS = Literal[
@@ -37,35 +42,154 @@ def base64_to_image(b64 : str) -> Image.Image:
 	buffer = BytesIO(base64.b64decode(b64))
 	return Image.open(buffer).convert('RGB')
 
-async def async_post(url : str, headers : Optional[dict] = None, cookies : Optional[dict] = None, json : Optional[dict] = None, data : Optional[str] = None) -> bytes:
+# per-call timeouts in seconds; main.py sets these from the command line
+CONNECT_TIMEOUT : float = 5.0
+REQUEST_TIMEOUT : float = 30.0
+GENERATION_TIMEOUT : float = 600.0
+
+# bounded retries with full jitter for idempotent calls (/history, /view)
+RETRY_ATTEMPTS : int = 3
+RETRY_BASE_DELAY : float = 0.25
+RETRY_MAX_DELAY : float = 4.0
+
+class ComfyUIError(Exception):
+	'''A failed ComfyUI call and the HTTP status the proxy should answer with.'''
+	status_code : int
+	retry_after : Optional[int]
+
+	def __init__(self, message : str, status_code : int = 502, retry_after : Optional[int] = None) -> None:
+		super().__init__(message)
+		self.status_code = status_code
+		self.retry_after = retry_after
+
+	@property
+	def transient(self) -> bool:
+		'''Whether the backend (rather than the request) is at fault, so retrying may help.'''
+		return self.status_code >= 500
+
+class CircuitBreaker:
+	'''
+	Fail fast while a backend is unhealthy.
+
+	After `failure_threshold` consecutive transient failures the breaker opens and calls
+	fail immediately. Once `reset_timeout` seconds have passed a single trial call is let
+	through (half open): success closes the breaker, failure opens it again.
+	'''
+	failure_threshold : int = 5
+	reset_timeout : float = 30.0
+
+	def __init__(self, server_address : str) -> None:
+		self.server_address = server_address
+		self.failures = 0
+		self.opened_at : Optional[float] = None
+		self._trial_running = False
+
+	@property
+	def state(self) -> str:
+		if self.opened_at is None:
+			return "closed"
+		return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+	def before_call(self) -> bool:
+		'''Raises while the breaker is open. Returns True when the call is the half open trial.'''
+		if self.opened_at is None:
+			return False
+		remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+		if remaining > 0 or self._trial_running:
+			raise ComfyUIError(f"ComfyUI at {self.server_address} is unavailable after {self.failures} consecutive failures.", 503, retry_after=max(1, math.ceil(remaining)))
+		self._trial_running = True
+		return True
+
+	def abandon_trial(self) -> None:
+		'''The trial call ended without an answer either way (e.g. it was cancelled) - let the next call try.'''
+		self._trial_running = False
+
+	def record_success(self) -> None:
+		self.failures = 0
+		self.opened_at = None
+		self._trial_running = False
+
+	def record_failure(self) -> None:
+		self.failures += 1
+		if self._trial_running or self.failures >= self.failure_threshold:
+			if self.opened_at is None or self._trial_running:
+				print(f"ComfyUI at {self.server_address} is failing - pausing requests for {self.reset_timeout:.0f}s.")
+			self.opened_at = time.monotonic()
+		self._trial_running = False
+
+# one breaker per backend, shared by every ComfyUI_API instance
+BREAKERS : dict[str, CircuitBreaker] = {}
+
+def get_breaker(server_address : str) -> CircuitBreaker:
+	if server_address not in BREAKERS:
+		BREAKERS[server_address] = CircuitBreaker(server_address)
+	return BREAKERS[server_address]
+
+def error_message(body : bytes) -> str:
+	'''The message of a ComfyUI error response (e.g. a rejected prompt), or the raw body.'''
+	try:
+		data = json.loads(body.decode('utf-8'))
+		error = data.get('error', data)
+		message : str = error.get('message', str(error)) if isinstance(error, dict) else str(error)
+		if isinstance(error, dict) and error.get('details'):
+			message += ": " + error['details']
+		if data.get('node_errors'):
+			message += " " + json.dumps(data['node_errors'])
+		return message
+	except (ValueError, AttributeError):
+		return body.decode('utf-8', errors='replace')[:500]
+
+async def async_request(method : str, url : str, timeout : Optional[float] = None, **kwargs) -> bytes:
+	'''Send a request and return the body. Raises ComfyUIError on connection errors, timeouts and error statuses.'''
+	client_timeout = aiohttp.ClientTimeout(total=timeout or REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+	try:
+		client : aiohttp.ClientSession
+		async with aiohttp.ClientSession(timeout=client_timeout) as client:
+			response : aiohttp.ClientResponse
+			async with client.request(method, url, **kwargs) as response:
+				body : bytes = await response.read()
+	except asyncio.TimeoutError:
+		raise ComfyUIError(f"ComfyUI did not answer {method} {url} within {timeout or REQUEST_TIMEOUT:.0f}s.", 504)
+	except aiohttp.ClientError as e:
+		raise ComfyUIError(f"Cannot connect to ComfyUI ({method} {url}): {e}", 503)
+	if response.status >= 500:
+		raise ComfyUIError(f"ComfyUI failed {method} {url} with status {response.status}: {error_message(body)}", 502)
+	if response.status >= 400:
+		raise ComfyUIError(f"ComfyUI rejected {method} {url}: {error_message(body)}", 400 if response.status == 400 else response.status)
+	return body
+
+async def async_post(url : str, headers : Optional[dict] = None, cookies : Optional[dict] = None, json : Optional[dict] = None, data : Optional[str] = None, timeout : Optional[float] = None) -> bytes:
 	'''Asynchronously POST to the given url with the parameters.'''
-	client : aiohttp.ClientSession
-	async with aiohttp.ClientSession(headers=headers, cookies=cookies) as client:
-		response : aiohttp.ClientResponse = await client.post(url, data=data, json=json)
-		return await response.read()
+	return await async_request("POST", url, timeout=timeout, headers=headers, cookies=cookies, data=data, json=json)
 
-async def post_json_response(url : str, data : Optional[dict]) -> Union[dict, list, None]:
+async def post_json_response(url : str, data : Optional[dict], timeout : Optional[float] = None) -> Union[dict, list]:
+	response : bytes = await async_post(url, json=data, timeout=timeout)
 	try:
-		response : bytes = await async_post(url, json=data)
 		return json.loads(response.decode('utf-8'))
-	except Exception as e:
-		traceback.print_exception(e)
-		return None
+	except ValueError:
+		raise ComfyUIError(f"ComfyUI returned invalid JSON for {url}.", 502)
 
-async def async_get(url : str, headers : Optional[dict] = None, cookies : Optional[dict] = None, json : Optional[dict] = None, data : Optional[str] = None) -> bytes:
-	'''Asynchronously POST to the given url with the parameters.'''
-	client : aiohttp.ClientSession
-	async with aiohttp.ClientSession(headers=headers, cookies=cookies) as client:
-		response : aiohttp.ClientResponse = await client.get(url, data=data, json=json)
-		return await response.read()
+async def async_get(url : str, headers : Optional[dict] = None, cookies : Optional[dict] = None, json : Optional[dict] = None, data : Optional[str] = None, timeout : Optional[float] = None) -> bytes:
+	'''Asynchronously GET the given url with the parameters.'''
+	return await async_request("GET", url, timeout=timeout, headers=headers, cookies=cookies, data=data, json=json)
 
-async def get_json_response(url : str) -> Union[dict, list, None]:
+async def get_json_response(url : str, timeout : Optional[float] = None) -> Union[dict, list]:
+	response : bytes = await async_get(url, timeout=timeout)
 	try:
-		response : bytes = await async_get(url)
 		return json.loads(response.decode('utf-8'))
-	except Exception as e:
-		traceback.print_exception(e)
-		return None
+	except ValueError:
+		raise ComfyUIError(f"ComfyUI returned invalid JSON for {url}.", 502)
+
+async def with_retries(call : Callable[[], Awaitable[T]], attempts : Optional[int] = None) -> T:
+	'''Retry an idempotent call on transient errors, sleeping a random 0..base*2^n (capped) between attempts.'''
+	attempts = attempts or RETRY_ATTEMPTS
+	for attempt in range(attempts):
+		try:
+			return await call()
+		except ComfyUIError as e:
+			if e.transient is False or e.retry_after is not None or attempt == attempts - 1:
+				raise
+			await asyncio.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
 
 class ComfyUI_API:
 	'''
@@ -84,14 +208,32 @@ class ComfyUI_API:
 		self.server_address = server_address
 		self.client_id = uuid4().hex
 		self._active_ids = dict()
+		self.breaker = get_breaker(server_address)
+		# seconds each node of the last tracked prompt ran for (cached nodes are left out)
+		self.node_seconds : dict[str, float] = {}
 
 		print(self.client_id)
 
-	async def is_available(self) -> None:
+	async def _guarded(self, call : Callable[[], Awaitable[T]]) -> T:
+		'''Run a call through the backend's circuit breaker.'''
+		is_trial : bool = self.breaker.before_call()
 		try:
-			_ = await async_get(f"http://{self.server_address}")
-		except:
-			raise Exception("Cannot connect to ComfyUI!")
+			result = await call()
+		except ComfyUIError as e:
+			if e.transient:
+				self.breaker.record_failure()
+			else:
+				self.breaker.record_success() # the backend answered, the request was bad
+			raise
+		except BaseException:
+			if is_trial:
+				self.breaker.abandon_trial()
+			raise
+		self.breaker.record_success()
+		return result
+
+	async def is_available(self) -> None:
+		await self._guarded(lambda: async_get(f"http://{self.server_address}", timeout=CONNECT_TIMEOUT))
 
 	async def open_websocket(self) -> None:
 		address : str = f"ws://{self.server_address}/ws?clientId={self.client_id}"
@@ -102,11 +244,25 @@ class ComfyUI_API:
 
 	async def queue_prompt(self, prompt : dict) -> str:
 		'''Queue the given prompt and return a prompt_id'''
-		payload = {"prompt": prompt, "client_id": self.client_id}
-		response = await post_json_response(f"http://{self.server_address}/prompt", data=payload)
+		# the id is recorded before the request is sent, so cancel_active can remove the prompt
+		# even when the request is cancelled before ComfyUI answers (older ComfyUI picks its own id)
+		requested_id : str = str(uuid4())
+		self._active_ids[requested_id] = False
+		payload = {"prompt": prompt, "client_id": self.client_id, "prompt_id": requested_id}
+		# not retried - a retry after a lost response would queue the prompt twice
+		try:
+			response = await self._guarded(lambda: post_json_response(f"http://{self.server_address}/prompt", data=payload))
+		except ComfyUIError:
+			self._active_ids.pop(requested_id, None)
+			raise
+		if not isinstance(response, dict) or 'prompt_id' not in response:
+			self._active_ids.pop(requested_id, None)
+			raise ComfyUIError(f"ComfyUI did not queue the prompt: {response}", 502)
 		prompt_id : str = response['prompt_id']
 		print(prompt_id)
-		self._active_ids[prompt_id] = False
+		if prompt_id != requested_id:
+			self._active_ids.pop(requested_id, None)
+			self._active_ids[prompt_id] = False
 		return prompt_id
 
 	async def is_prompt_id_finished(self, prompt_id : str) -> Optional[bool]:
@@ -123,15 +279,49 @@ class ComfyUI_API:
 
 	async def fetch_prompt_id_history(self, prompt_id : str) -> dict:
 		'''Fetch the generation history for the given prompt_id.'''
-		history = await get_json_response(f"http://{self.server_address}/history/{prompt_id}")
-		return history.get(prompt_id)
+		async def fetch() -> dict:
+			history = await get_json_response(f"http://{self.server_address}/history/{prompt_id}")
+			if not isinstance(history, dict) or prompt_id not in history:
+				# the history is written just after the final websocket message
+				raise ComfyUIError(f"ComfyUI has no history for prompt {prompt_id}.", 502)
+			return history[prompt_id]
+		return await with_retries(lambda: self._guarded(fetch))
+
+	async def fetch_object_info(self) -> dict:
+		'''The node classes ComfyUI knows, with their inputs, outputs and choices.'''
+		return await with_retries(lambda: self._guarded(lambda: get_json_response(f"http://{self.server_address}/object_info")))
 
 	async def fetch_image(self, filename : str, subfolder : str, folder_type : str) -> bytes:
 		payload = {"filename": filename, "subfolder": subfolder, "type": folder_type}
 		query : str = urlencode(payload)
-		response : bytes = await async_get(f"http://{self.server_address}/view?{query}")
+		response : bytes = await with_retries(lambda: self._guarded(lambda: async_get(f"http://{self.server_address}/view?{query}")))
 		return response
 
+	async def cancel_prompt(self, prompt_id : str) -> None:
+		'''Remove the prompt from the queue, or interrupt it if it is the one running.'''
+		try:
+			await post_json_response(f"http://{self.server_address}/queue", data={"delete" : [prompt_id]})
+			queue = await get_json_response(f"http://{self.server_address}/queue")
+			if any(item[1] == prompt_id for item in queue.get('queue_running', [])):
+				await async_post(f"http://{self.server_address}/interrupt")
+		except ComfyUIError as e:
+			print(f"Unable to cancel prompt {prompt_id}: {e}")
+
+	async def cancel_active(self) -> None:
+		'''Cancel every prompt of this connection which has not finished yet.'''
+		prompt_ids : set[str] = {prompt_id for prompt_id, finished in self._active_ids.items() if finished is False}
+		# prompts queued by an older ComfyUI whose answer never arrived are found by client id
+		try:
+			queue = await get_json_response(f"http://{self.server_address}/queue")
+			for item in queue.get('queue_running', []) + queue.get('queue_pending', []):
+				if len(item) > 3 and isinstance(item[3], dict) and item[3].get('client_id') == self.client_id:
+					prompt_ids.add(item[1])
+		except ComfyUIError as e:
+			print(f"Unable to read the ComfyUI queue: {e}")
+		for prompt_id in prompt_ids:
+			await self.cancel_prompt(prompt_id)
+			await self.cleanup_prompt_id(prompt_id)
+
 	async def fetch_prompt_id_images(self, prompt_id : str, include_previews : bool = False) -> list[dict]:
 		'''Fetch the generated images for the given prompt_id if any.'''
 		images : list[dict] = list()
@@ -155,6 +345,9 @@ class ComfyUI_API:
 	async def track_progress(self, prompt_id : str, node_ids : list[int]) -> None:
 		'''Echo the progress of the prompt_id.'''
 		finished_nodes : list[str] = []
+		self.node_seconds = {}
+		running_node : Optional[str] = None
+		running_since : float = 0.0
 		async with self._websocket as socket:
 			while True:
 				# receive content
@@ -178,6 +371,10 @@ class ComfyUI_API:
 				# executing a new node if any
 				if message['type'] == 'executing':
 					data = message['data']
+					now : float = time.perf_counter()
+					if running_node is not None:
+						self.node_seconds[running_node] = self.node_seconds.get(running_node, 0.0) + now - running_since
+					running_node, running_since = data['node'], now
 					if data['node'] not in finished_nodes:
 						finished_nodes.append(data['node'])
 						print('Progess: ', len(finished_nodes)-1, '/', len(node_ids), ' Tasks done')
@@ -197,7 +394,15 @@ class ComfyUI_API:
 	async def generate_images_using_workflow_prompt(self, prompt : dict, include_previews : bool = True) -> list[dict]:
 		'''Complete the full sequence of giving a prompt and receiving the images.'''
 		prompt_id : str = await self.queue_prompt(prompt)
-		await self.track_progress( prompt_id, prompt.keys() )
+		try:
+			await asyncio.wait_for(self.track_progress( prompt_id, prompt.keys() ), GENERATION_TIMEOUT)
+		except asyncio.TimeoutError:
+			await self.cancel_prompt(prompt_id)
+			self.breaker.record_failure()
+			raise ComfyUIError(f"ComfyUI did not finish prompt {prompt_id} within {GENERATION_TIMEOUT:.0f}s.", 504)
+		except (OSError, websockets.exceptions.WebSocketException) as e:
+			self.breaker.record_failure()
+			raise ComfyUIError(f"Lost the ComfyUI progress websocket: {e}", 503)
 		images_spookexe : list[dict] = await self.fetch_prompt_id_images(prompt_id, include_previews=include_previews)
 		await self.cleanup_prompt_id(prompt_id)
 		return images_spookexe
@@ -218,7 +423,7 @@ class ComfyUI_API:
 		try:
 			url : str = f'http://{self.server_address}/upload/image'
 			client : aiohttp.ClientSession
-			async with aiohttp.ClientSession() as client:
+			async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)) as client:
 				response : aiohttp.ClientResponse = await client.post(url, data=data)
 				if response.status != 200:
 					print(f"Failed to upload image due to: {response.reason} (typicallycfile data)")
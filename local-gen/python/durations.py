@@ -0,0 +1,20 @@
+'''
+Summaries of measured durations for the proxy's status and /debug pages.
+'''
+
+from typing import Iterable
+
+import statistics
+
+def summarize(values : Iterable[float]) -> dict:
+	'''Count, mean, p50, p95 and max of durations in seconds, reported in milliseconds.'''
+	ordered = sorted(values)
+	if len(ordered) == 0:
+		return {"count" : 0}
+	return {
+		"count" : len(ordered),
+		"mean_ms" : round(statistics.mean(ordered) * 1000),
+		"p50_ms" : round(ordered[len(ordered) // 2] * 1000),
+		"p95_ms" : round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000),
+		"max_ms" : round(ordered[-1] * 1000),
+	}
@@ -1,43 +1,418 @@
 
 from PIL import Image
-from fastapi import FastAPI
+from collections import OrderedDict
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from io import BytesIO
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
-from comfyui import ComfyUI_API, image_to_base64
+from assetpack import AssetPack
+from blobstore import BlobStore
+from comfyui import ComfyUI_API, ComfyUIError, image_to_base64
+from profiler import LoopLagMonitor, SamplingProfiler, pending_tasks
+from scheduler import ClientQuota, FairScheduler, QuotaExceeded, Superseded
+from workflow import WorkflowError, model_key, model_loader_nodes, prepare_workflow
 
+import argparse
+import base64
+import comfyui
+import ipaddress
+import json
+import prompts
+import scheduler
 import uvicorn
 import asyncio
+import re
+import threading
 
 class GenerateImagesResponse(BaseModel):
 	images : List[str]
 
-app = FastAPI(title='Local Image Generation', description='This api allows local image generation with ComfyUI. Coded by @SPOOKEXE on GitHub', version="0.1.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+class BlobResponse(BaseModel):
+	hash : str
+	size : int
+
+class ScenePayload(BaseModel):
+	character : dict # setup.comfyUI_PrepareCharacterData()
+	scene : dict # setup.comfyUI_PrepareSceneData()
+
+class SceneResponse(BaseModel):
+	images : List[str]
+	cached : int # number of shots served from the render cache
+
+# enabled with --blob-store
+BLOB_STORE : Optional[BlobStore] = None
+# enabled with --asset-pack (see prerender.py)
+ASSET_PACK : Optional[AssetPack] = None
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+# /debug endpoints, enabled with --debug and only answered for this computer (see profiler.py)
+DEBUG_ENABLED : bool = False
+LOOP_MONITOR : LoopLagMonitor = LoopLagMonitor()
+PROFILE_LOCK : asyncio.Lock = asyncio.Lock()
+MAX_PROFILE_SECONDS : float = 120.0
+RENDER_CACHE_ENTRIES : int = 64
+
+class RenderCache:
+	'''
+	LRU of finished shot renders keyed on prompts.render_key.
+
+	With the blob store enabled only the blob hashes are kept in memory. Called from worker
+	threads - the blob store is read and written outside the lock.
+	'''
+
+	def __init__(self, max_entries : int = RENDER_CACHE_ENTRIES) -> None:
+		self.max_entries = max_entries
+		self._entries : OrderedDict[str, list] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key : str) -> Optional[list[bytes]]:
+		with self._lock:
+			entry = self._entries.get(key)
+		if entry is None:
+			return None
+		if BLOB_STORE is not None and entry and isinstance(entry[0], str):
+			images = [BLOB_STORE.get(blob_hash) for blob_hash in entry]
+			if any(image is None for image in images): # evicted from the blob store
+				with self._lock:
+					if self._entries.get(key) is entry:
+						del self._entries[key]
+				return None
+		else:
+			images = entry
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+		return images
+
+	def put(self, key : str, images : list[bytes]) -> None:
+		entry : list = [BLOB_STORE.put(image, "image/png") for image in images] if BLOB_STORE is not None else images
+		with self._lock:
+			self._entries[key] = entry
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+RENDER_CACHE = RenderCache()
+
+# every generation waits for its turn here (see scheduler.py)
+SCHEDULER : FairScheduler = FairScheduler()
+# token -> (client name, quota), loaded with --clients; when empty clients identify with X-Client-Id
+CLIENT_TOKENS : dict[str, tuple[str, ClientQuota]] = {}
+CLIENT_ID_PATTERN = re.compile(r"[^A-Za-z0-9_.:-]")
+
+def load_client_tokens(filepath : str, default_quota : ClientQuota) -> dict[str, tuple[str, ClientQuota]]:
+	'''Read {token : {"name" : ..., "weight" : ..., "concurrency" : ..., "max_queued" : ..., "rate_per_minute" : ..., "burst" : ...}}.'''
+	with open(filepath, "r") as file:
+		data : dict = json.load(file)
+	tokens : dict[str, tuple[str, ClientQuota]] = {}
+	for token, entry in data.items():
+		quota = ClientQuota(**{**vars(default_quota), **{key : value for key, value in entry.items() if key != "name"}})
+		tokens[token] = (entry.get("name", token[:8]), quota)
+	return tokens
+
+def is_loopback(host : str) -> bool:
+	try:
+		return ipaddress.ip_address(host).is_loopback
+	except ValueError:
+		return host == 'localhost'
+
+async def identify_client(request : Request) -> None:
+	'''Set request.state.client_id, request.state.quota and request.state.session, checking the token when --clients is used.'''
+	if request.url.path == '/echo' or request.url.path.startswith('/debug/'):
+		return
+	# a newer request of the same session replaces the client's older ones (see scheduler.py)
+	request.state.session = CLIENT_ID_PATTERN.sub('', request.headers.get('x-session-id', ''))[:64] or None
+	token : Optional[str] = request.headers.get('x-client-token')
+	authorization : str = request.headers.get('authorization', '')
+	if token is None and authorization.lower().startswith('bearer '):
+		token = authorization[7:].strip()
+	if CLIENT_TOKENS:
+		if token not in CLIENT_TOKENS:
+			raise HTTPException(status_code=401, detail="This proxy needs a client token. Enter the token you were given in the game's ComfyUI section.")
+		request.state.client_id, request.state.quota = CLIENT_TOKENS[token]
+		return
+	client_id : str = request.headers.get('x-client-id') or (request.client.host if request.client else 'local')
+	request.state.client_id = CLIENT_ID_PATTERN.sub('', client_id)[:64] or 'anonymous'
+	request.state.quota = None
+
+app = FastAPI(title='Local Image Generation', description='This api allows local image generation with ComfyUI. Coded by @SPOOKEXE on GitHub', version="0.1.0", dependencies=[Depends(identify_client)])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["Content-Range", "Accept-Ranges", "ETag", "Retry-After"])
+
+@app.exception_handler(ComfyUIError)
+async def comfyui_error_handler(request : Request, error : ComfyUIError) -> JSONResponse:
+	'''Answer failed ComfyUI calls with their status (400 rejected workflow, 502 bad response, 503 unavailable, 504 timeout).'''
+	headers = {"Retry-After" : str(error.retry_after)} if error.retry_after is not None else None
+	return JSONResponse(status_code=error.status_code, content={"detail" : str(error)}, headers=headers)
+
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_handler(request : Request, error : QuotaExceeded) -> JSONResponse:
+	return JSONResponse(status_code=429, content={"detail" : str(error)}, headers={"Retry-After" : str(error.retry_after)})
+
+@app.exception_handler(Superseded)
+async def superseded_handler(request : Request, error : Superseded) -> JSONResponse:
+	return JSONResponse(status_code=409, content={"detail" : str(error), "superseded" : True})
+
+@app.exception_handler(WorkflowError)
+async def workflow_error_handler(request : Request, error : WorkflowError) -> JSONResponse:
+	return JSONResponse(status_code=400, content={"detail" : str(error), "problems" : error.problems})
 
 @app.get('/echo', description='Echo back to let the client know the api is running.')
 async def echo() -> bool:
 	return True
 
+@app.get('/clients', description='Queue and latency statistics of each client, and model swaps of each backend.')
+async def client_stats() -> dict:
+	return SCHEDULER.stats()
+
+def workflow_cost(workflow : dict) -> int:
+	'''Number of images the workflow renders - the share of the GPU it uses.'''
+	return max(1, sum(node['inputs'].get('batch_size', 0) for node in workflow.values() if isinstance(node['inputs'].get('batch_size'), int)))
+
+async def run_prompt(prompt : dict, request : Request, cost : float, include_previews : bool = True) -> list[dict]:
+	'''Wait for the client's turn and run the prompt on the backend the scheduler picks for its models.'''
+	async with SCHEDULER.slot(request.state.client_id, cost, request.state.quota, model_key(prompt), request.state.session) as ticket:
+		COMFYUI_NODE = ComfyUI_API(ticket.backend.address)
+		await COMFYUI_NODE.open_websocket()
+		try:
+			image_array : list[dict] = await COMFYUI_NODE.generate_images_using_workflow_prompt(prompt, include_previews=include_previews)
+		except asyncio.CancelledError:
+			if ticket.superseded is False:
+				raise
+			# a newer request of the session took over - free the GPU for it
+			ticket.clear_cancel()
+			await COMFYUI_NODE.cancel_active()
+			raise Superseded("Replaced by a newer request of the same session.") from None
+		finally:
+			await COMFYUI_NODE.close_websocket()
+		ticket.load_seconds = sum(COMFYUI_NODE.node_seconds.get(node_id, 0.0) for node_id in model_loader_nodes(prompt))
+	return image_array
+
 @app.post('/generate_workflow', description='Generate a image given the generation workflow.')
-async def generate_image(workflow : dict) -> GenerateImagesResponse:
+async def generate_image(workflow : dict, request : Request) -> GenerateImagesResponse:
 	print(workflow)
-	COMFYUI_NODE = ComfyUI_API('127.0.0.1:8188')
+	COMFYUI_NODE = ComfyUI_API(SCHEDULER.backends[0].address)
 	await COMFYUI_NODE.is_available()
-	await COMFYUI_NODE.open_websocket()
-	image_array : list[dict] = await COMFYUI_NODE.generate_images_using_workflow_prompt(workflow)
-	await COMFYUI_NODE.close_websocket()
+	workflow = await prepare_workflow(COMFYUI_NODE, workflow)
+	image_array : list[dict] = await run_prompt(workflow, request, workflow_cost(workflow))
 	if len(image_array) == 0: return None
 	raw_image : bytes = image_array[0]['image_data']
 	image = Image.open(BytesIO(raw_image))
 	b64_image = image_to_base64(image)
 	return GenerateImagesResponse(images=[b64_image])
 
+@app.post('/generate_scene', description='Compile the prompts of a scene for the character and generate its images in one batch.')
+async def generate_scene(payload : ScenePayload, request : Request) -> SceneResponse:
+	scene_id : str = payload.scene.get('scene_id', 'portrait')
+	scene_params : dict = payload.scene.get('scene_params') or {}
+	try:
+		shots = prompts.scene_shots(scene_id, scene_params)
+	except KeyError as e:
+		raise HTTPException(status_code=404, detail=e.args[0])
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+
+	character_positive, character_negative = prompts.character_tags(payload.character)
+	negative : str = prompts.PREFIX_NEGATIVE_PROMPT + character_negative
+	checkpoint : str = scene_params.get('checkpoint', prompts.DEFAULT_CHECKPOINT)
+	steps : int = scene_params.get('steps', prompts.DEFAULT_STEPS)
+	cfg : float = scene_params.get('cfg', prompts.DEFAULT_CFG)
+	seed : Optional[int] = scene_params.get('seed')
+	remove_background : bool = scene_params.get('remove_background', False)
+
+	# shots already rendered for this character (in this or another scene) are reused
+	results : list[Optional[list[bytes]]] = []
+	pending : list[tuple[int, str, str, prompts.Shot, Optional[int]]] = []
+	for index, shot in enumerate(shots):
+		positive = prompts.shot_positive_prompt(character_positive, shot, payload.scene.get('prefix'), payload.scene.get('suffix'))
+		# the seed follows the shot's place in the scene, not in the batch of pending shots
+		shot_seed : Optional[int] = prompts.shot_seed(seed, index)
+		key = prompts.render_key(positive, negative, shot, checkpoint, steps, cfg, shot_seed, remove_background)
+		cached = None if scene_params.get('refresh') else await asyncio.to_thread(RENDER_CACHE.get, key)
+		results.append(cached)
+		if cached is None:
+			pending.append((index, key, positive, shot, shot_seed))
+
+	if len(pending) > 0:
+		workflow, save_nodes = prompts.build_scene_workflow(checkpoint, [(positive, shot, shot_seed) for _, _, positive, shot, shot_seed in pending], negative, steps, cfg, remove_background)
+		COMFYUI_NODE = ComfyUI_API(SCHEDULER.backends[0].address)
+		await COMFYUI_NODE.is_available()
+		workflow = await prepare_workflow(COMFYUI_NODE, workflow)
+		image_array : list[dict] = await run_prompt(workflow, request, sum(shot.count for _, _, _, shot, _ in pending), include_previews=False)
+		for (index, key, _, _, _), node_id in zip(pending, save_nodes):
+			images = [item['image_data'] for item in image_array if item['node_id'] == node_id and item.get('image_data') is not None]
+			if len(images) == 0:
+				continue
+			results[index] = images
+			await asyncio.to_thread(RENDER_CACHE.put, key, images)
+
+	images : list[str] = [base64.b64encode(image).decode('utf-8') for shot_images in results if shot_images is not None for image in shot_images]
+	return SceneResponse(images=images, cached=len(shots) - len(pending))
+
+def get_blob_store() -> BlobStore:
+	if BLOB_STORE is None:
+		raise HTTPException(status_code=404, detail="The blob store is disabled. Start the proxy with --blob-store to enable it.")
+	return BLOB_STORE
+
+def parse_range(header : str, size : int) -> Optional[tuple[int, int]]:
+	'''Parse a single "bytes=start-end" range into an inclusive (start, end), or raise 416.'''
+	match = RANGE_PATTERN.match(header.strip())
+	if match is None or match.group(1) == match.group(2) == "":
+		raise HTTPException(status_code=416, detail="Only single byte ranges are supported.", headers={"Content-Range" : f"bytes */{size}"})
+	if match.group(1) == "": # suffix range - the last N bytes
+		start, end = max(0, size - int(match.group(2))), size - 1
+	else:
+		start = int(match.group(1))
+		end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+	if start > end or start >= size:
+		raise HTTPException(status_code=416, detail="Range not satisfiable.", headers={"Content-Range" : f"bytes */{size}"})
+	return start, end
+
+@app.get('/blobs', description='Blob store statistics (404 when the blob store is disabled).')
+async def blob_stats() -> dict:
+	return get_blob_store().stats()
+
+@app.post('/blobs', description='Store the request body and return its SHA-256 hash.')
+async def post_blob(request : Request) -> BlobResponse:
+	store = get_blob_store()
+	data : bytes = await request.body()
+	blob_hash : str = await asyncio.to_thread(store.put, data, request.headers.get("content-type", "application/octet-stream"))
+	return BlobResponse(hash=blob_hash, size=len(data))
+
+@app.put('/blobs/{blob_hash}', description='Store the request body under its SHA-256 hash, which must match the url.')
+async def put_blob(blob_hash : str, request : Request) -> BlobResponse:
+	store = get_blob_store()
+	if BlobStore.is_valid_hash(blob_hash) is False:
+		raise HTTPException(status_code=400, detail="Blob hashes are lowercase hex SHA-256 digests.")
+	data : bytes = await request.body()
+	try:
+		await asyncio.to_thread(store.put, data, request.headers.get("content-type", "application/octet-stream"), blob_hash)
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	return BlobResponse(hash=blob_hash, size=len(data))
+
+@app.get('/blobs/{blob_hash}', description='Fetch a blob by hash. Supports single Range requests.')
+async def get_blob(blob_hash : str, request : Request) -> Response:
+	store = get_blob_store()
+	info = store.info(blob_hash) if BlobStore.is_valid_hash(blob_hash) else None
+	if info is None:
+		raise HTTPException(status_code=404, detail="Blob not found.")
+	headers = {"Accept-Ranges" : "bytes", "ETag" : f'"{blob_hash}"', "Cache-Control" : "public, max-age=31536000, immutable"}
+	if request.headers.get("if-none-match") == f'"{blob_hash}"':
+		return Response(status_code=304, headers=headers)
+	byte_range = request.headers.get("range")
+	if byte_range is None:
+		data = await asyncio.to_thread(store.get, blob_hash)
+		status_code = 200
+	else:
+		start, end = parse_range(byte_range, info.size)
+		data = await asyncio.to_thread(store.get, blob_hash, start, end)
+		headers["Content-Range"] = f"bytes {start}-{end}/{info.size}"
+		status_code = 206
+	if data is None:
+		raise HTTPException(status_code=404, detail="Blob not found.")
+	return Response(content=data, status_code=status_code, media_type=info.content_type, headers=headers)
+
+@app.delete('/blobs/{blob_hash}', description='Delete a blob.')
+async def delete_blob(blob_hash : str) -> bool:
+	return get_blob_store().delete(blob_hash)
+
+@app.get('/assets/{name:path}', description='Fetch a pre-rendered image from the asset pack. Supports single Range requests.')
+async def get_asset(name : str, request : Request) -> Response:
+	entry = ASSET_PACK.info(name) if ASSET_PACK is not None else None
+	if entry is None:
+		raise HTTPException(status_code=404, detail="Asset not found.")
+	headers = {"Accept-Ranges" : "bytes", "ETag" : f'"{entry.sha256}"', "Cache-Control" : "public, max-age=31536000, immutable"}
+	if request.headers.get("if-none-match") == f'"{entry.sha256}"':
+		return Response(status_code=304, headers=headers)
+	byte_range = request.headers.get("range")
+	if byte_range is None:
+		data = await asyncio.to_thread(ASSET_PACK.read, name)
+		status_code = 200
+	else:
+		start, end = parse_range(byte_range, entry.length)
+		data = await asyncio.to_thread(ASSET_PACK.read, name, start, end)
+		headers["Content-Range"] = f"bytes {start}-{end}/{entry.length}"
+		status_code = 206
+	return Response(content=data, status_code=status_code, media_type=entry.content_type, headers=headers)
+
+def require_debug(request : Request) -> None:
+	if DEBUG_ENABLED is False:
+		raise HTTPException(status_code=404, detail="The debug endpoints are disabled. Start the proxy with --debug to enable them.")
+	if request.client is None or is_loopback(request.client.host) is False:
+		raise HTTPException(status_code=403, detail="The debug endpoints only answer requests from this computer.")
+
+@app.get('/debug/profile', dependencies=[Depends(require_debug)], description='Sample the stacks of every proxy thread for some seconds. format=collapsed (flame graph input) or pstats (python -m pstats).')
+async def debug_profile(seconds : float = 5.0, format : str = 'collapsed', interval_ms : float = 5.0, idle : bool = False) -> Response:
+	if format not in ('collapsed', 'pstats'):
+		raise HTTPException(status_code=400, detail="format is either collapsed or pstats.")
+	if PROFILE_LOCK.locked():
+		raise HTTPException(status_code=409, detail="A profile is already running.")
+	async with PROFILE_LOCK:
+		profiler = SamplingProfiler(max(0.001, interval_ms / 1000), include_idle=idle)
+		await asyncio.to_thread(profiler.sample, min(max(seconds, 0.1), MAX_PROFILE_SECONDS))
+	headers = {"X-Profile-Samples" : str(profiler.samples)}
+	if len(profiler.stacks) == 0: # every thread was idle - use idle=true to see where they wait
+		return Response(status_code=204, headers=headers)
+	if format == 'pstats':
+		headers["Content-Disposition"] = 'attachment; filename="proxy.pstats"'
+		return Response(content=profiler.pstats_dump(), media_type='application/octet-stream', headers=headers)
+	return Response(content=profiler.collapsed(), media_type='text/plain', headers=headers)
+
+@app.get('/debug/loop', dependencies=[Depends(require_debug)], description='How late the event loop runs scheduled callbacks.')
+async def debug_loop() -> dict:
+	return LOOP_MONITOR.stats()
+
+@app.get('/debug/tasks', dependencies=[Depends(require_debug)], description='The pending asyncio tasks and where each is waiting.')
+async def debug_tasks() -> dict:
+	tasks = pending_tasks()
+	return {"count" : len(tasks), "tasks" : tasks}
+
 async def uvicorn_run(app : FastAPI, host : str = "127.0.0.1", port : int = 12500) -> None:
+	if DEBUG_ENABLED:
+		LOOP_MONITOR.start()
 	config = uvicorn.Config(app, host=host, port=port, access_log=False, server_header=True, date_header=False, proxy_headers=False)
 	await uvicorn.Server(config).serve()
 
 if __name__ == '__main__':
-	asyncio.run(uvicorn_run(app, host='127.0.0.1', port=12500))
+	parser = argparse.ArgumentParser(description='Local image generation proxy for Abyss Diver.')
+	parser.add_argument('--blob-store', metavar='DIRECTORY', help='enable the /blobs image and save store in this directory')
+	parser.add_argument('--blob-store-max-mb', type=int, default=2048, help='size cap of the blob store before the least recently used blobs are evicted')
+	parser.add_argument('--comfyui-timeout', type=float, default=comfyui.REQUEST_TIMEOUT, help='seconds to wait for each ComfyUI api call')
+	parser.add_argument('--generation-timeout', type=float, default=comfyui.GENERATION_TIMEOUT, help='seconds to wait for ComfyUI to finish a workflow')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on - use 0.0.0.0 to serve the other computers of your network')
+	parser.add_argument('--port', type=int, default=12500, help='port to listen on')
+	parser.add_argument('--clients', metavar='FILE', help='JSON file of client tokens and quotas; clients without a valid token are refused')
+	parser.add_argument('--backend', action='append', help='ComfyUI address (repeat for several GPUs; default 127.0.0.1:8188)')
+	parser.add_argument('--gpu-slots', type=int, default=1, help='generations sent to each ComfyUI backend at once')
+	parser.add_argument('--fairness-window', type=float, default=scheduler.FAIRNESS_WINDOW, help='images of other clients\' work a request may overtake when its model is already loaded (0 for strict fair order)')
+	parser.add_argument('--client-concurrency', type=int, default=1, help='generations each client may run at once')
+	parser.add_argument('--client-max-queued', type=int, default=4, help='generations each client may have waiting')
+	parser.add_argument('--client-rate', type=float, default=30.0, help='generation requests each client may send per minute')
+	parser.add_argument('--asset-pack', metavar='FILE', help='serve the pre-rendered images of this asset pack under /assets')
+	parser.add_argument('--debug', action='store_true', help='enable the /debug profiler, event loop lag and task endpoints for requests from this computer')
+	args = parser.parse_args()
+
+	comfyui.REQUEST_TIMEOUT = args.comfyui_timeout
+	comfyui.GENERATION_TIMEOUT = args.generation_timeout
+
+	if args.blob_store is not None:
+		BLOB_STORE = BlobStore(args.blob_store, max_bytes=args.blob_store_max_mb * 1024 * 1024)
+		print(f"Blob store enabled in {args.blob_store} ({BLOB_STORE.stats()['blobs']} blobs).")
+
+	if args.asset_pack is not None:
+		ASSET_PACK = AssetPack(args.asset_pack)
+		print(f"Serving {len(ASSET_PACK.entries)} assets from {args.asset_pack}.")
+
+	DEBUG_ENABLED = args.debug
+
+	default_quota = ClientQuota(concurrency=args.client_concurrency, max_queued=args.client_max_queued, rate_per_minute=args.client_rate)
+	SCHEDULER = FairScheduler(capacity=args.gpu_slots, default_quota=default_quota, backends=args.backend, fairness_window=args.fairness_window)
+	if args.clients is not None:
+		CLIENT_TOKENS = load_client_tokens(args.clients, default_quota)
+		print(f"Accepting {len(CLIENT_TOKENS)} client tokens from {args.clients}.")
+	elif is_loopback(args.host) is False:
+		print(f"WARNING: listening on {args.host} without --clients - anyone on your network can use this proxy.")
+
+	asyncio.run(uvicorn_run(app, host=args.host, port=args.port))
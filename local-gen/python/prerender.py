@@ -0,0 +1,259 @@
+'''
+Offline bulk renderer for asset packs.
+
+	python prerender.py manifest.json assets.adpack --backend 127.0.0.1:8188 --backend 192.168.1.20:8188
+
+The manifest lists the images to render:
+
+	{
+		"backends" : ["127.0.0.1:8188"],
+		"jobs" : [
+			{"name" : "companions/cherry", "workflow" : {...ComfyUI API workflow...}},
+			{"name" : "companions/lyra", "workflow_file" : "workflows/lyra.json"},
+			{"name" : "mc/female_fox", "character" : {...setup.comfyUI_PrepareCharacterData()...}, "scene" : "portrait", "scene_params" : {"seed" : 1}}
+		]
+	}
+
+Jobs which resolve to the same workflow are rendered once. Finished jobs are
+checkpointed in <pack>.work/, so running the same command again after an interruption
+only renders what is missing. The pack is written once every job is done (see assetpack.py).
+'''
+
+from assetpack import AssetPackWriter
+from comfyui import ComfyUI_API
+from workflow import Workflow, WorkflowError, prepare_workflow
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import prompts
+import shutil
+import statistics
+import time
+
+DEFAULT_BACKEND : str = "127.0.0.1:8188"
+PROGRESS_FILENAME : str = "progress.jsonl"
+
+class Job:
+	'''A unique workflow and every manifest name which resolved to it.'''
+	key : str
+	workflow : dict
+	names : list[str]
+
+	def __init__(self, key : str, workflow : dict, name : str) -> None:
+		self.key = key
+		self.workflow = workflow
+		self.names = [name]
+
+def workflow_key(workflow : dict) -> str:
+	'''Jobs whose workflows only differ in node ids or UI data render the same images.'''
+	return Workflow.parse(workflow).canonical_hash()
+
+def resolve_workflow(entry : dict, manifest_directory : str) -> dict:
+	'''Turn a manifest job into a ComfyUI workflow.'''
+	if "workflow" in entry:
+		return entry["workflow"]
+	if "workflow_file" in entry:
+		with open(os.path.join(manifest_directory, entry["workflow_file"]), "r") as file:
+			return json.load(file)
+	if "character" in entry:
+		scene_params : dict = dict(entry.get("scene_params", {}))
+		# renders must be reproducible for deduplication and resuming, so never use a random seed
+		if "seed" not in scene_params:
+			scene_params["seed"] = int(hashlib.sha256(json.dumps([entry["character"], entry.get("scene", "portrait")], sort_keys=True).encode("utf-8")).hexdigest()[:8], 16)
+		positive, negative = prompts.character_tags(entry["character"])
+		shots = prompts.scene_shots(entry.get("scene", "portrait"), scene_params)
+		workflow, _ = prompts.build_scene_workflow(
+			scene_params.get("checkpoint", prompts.DEFAULT_CHECKPOINT),
+			[(prompts.shot_positive_prompt(positive, shot, entry.get("prefix"), entry.get("suffix")), shot, prompts.shot_seed(scene_params["seed"], index)) for index, shot in enumerate(shots)],
+			prompts.PREFIX_NEGATIVE_PROMPT + negative,
+			scene_params.get("steps", prompts.DEFAULT_STEPS),
+			scene_params.get("cfg", prompts.DEFAULT_CFG),
+			scene_params.get("remove_background", False),
+		)
+		return workflow
+	raise ValueError(f"Job '{entry.get('name')}' needs a workflow, workflow_file or character.")
+
+def load_jobs(manifest : dict, manifest_directory : str) -> list[Job]:
+	jobs : dict[str, Job] = {}
+	names : set[str] = set()
+	for index, entry in enumerate(manifest["jobs"]):
+		name : str = entry.get("name", f"job{index}")
+		if name in names:
+			raise ValueError(f"Duplicate job name '{name}' in the manifest.")
+		names.add(name)
+		workflow = resolve_workflow(entry, manifest_directory)
+		key = workflow_key(workflow)
+		if key in jobs:
+			jobs[key].names.append(name)
+		else:
+			jobs[key] = Job(key, workflow, name)
+	return list(jobs.values())
+
+def load_progress(work_directory : str) -> dict[str, dict]:
+	'''The finished jobs of earlier runs, by job key.'''
+	finished : dict[str, dict] = {}
+	try:
+		with open(os.path.join(work_directory, PROGRESS_FILENAME), "r") as file:
+			for line in file:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue # a line cut short by an interruption
+				if all(os.path.exists(os.path.join(work_directory, filename)) for filename in record["files"]):
+					finished[record["key"]] = record
+	except FileNotFoundError:
+		pass
+	return finished
+
+class Renderer:
+	'''Runs jobs across the backends, at most `concurrency` at a time on each.'''
+
+	def __init__(self, backends : list[str], concurrency : int, retries : int, work_directory : str) -> None:
+		self.backends = backends
+		self.concurrency = concurrency
+		self.retries = retries
+		self.work_directory = work_directory
+		self.finished : dict[str, dict] = {}
+		self.resumed : set[str] = set()
+		self.failed : dict[str, str] = {}
+		self.completed = 0
+		self.total = 0
+		self._progress = None
+
+	async def render(self, job : Job, backend : str) -> list[bytes]:
+		COMFYUI_NODE = ComfyUI_API(backend)
+		await COMFYUI_NODE.is_available()
+		prompt = await prepare_workflow(COMFYUI_NODE, job.workflow)
+		await COMFYUI_NODE.open_websocket()
+		try:
+			image_array : list[dict] = await COMFYUI_NODE.generate_images_using_workflow_prompt(prompt, include_previews=False)
+		finally:
+			await COMFYUI_NODE.close_websocket()
+		return [item["image_data"] for item in sorted(image_array, key=lambda item: (int(item["node_id"]) if item["node_id"].isdigit() else 0, item["file_name"])) if item.get("image_data") is not None]
+
+	def checkpoint(self, job : Job, images : list[bytes], seconds : float, backend : str) -> None:
+		files : list[str] = []
+		for index, image in enumerate(images):
+			filename = f"{job.key}_{index}.png"
+			temp_path = os.path.join(self.work_directory, filename + ".tmp")
+			with open(temp_path, "wb") as file:
+				file.write(image)
+			os.replace(temp_path, os.path.join(self.work_directory, filename))
+			files.append(filename)
+		record = {"key" : job.key, "files" : files, "seconds" : round(seconds, 3), "backend" : backend}
+		self._progress.write(json.dumps(record) + "\n")
+		self._progress.flush()
+		self.finished[job.key] = record
+
+	async def worker(self, queue : asyncio.Queue, backend : str) -> None:
+		while True:
+			try:
+				job, attempt = queue.get_nowait()
+			except asyncio.QueueEmpty:
+				return
+			started = time.perf_counter()
+			try:
+				images = await self.render(job, backend)
+				if len(images) == 0:
+					raise RuntimeError("ComfyUI returned no images.")
+			except Exception as e:
+				if attempt < self.retries and isinstance(e, WorkflowError) is False:
+					queue.put_nowait((job, attempt + 1))
+				else:
+					self.failed[job.key] = str(e)
+					self.completed += 1
+					print(f"[{self.completed}/{self.total}] FAILED {', '.join(job.names)} on {backend}: {e}")
+				continue
+			seconds = time.perf_counter() - started
+			self.checkpoint(job, images, seconds, backend)
+			self.completed += 1
+			print(f"[{self.completed}/{self.total}] {', '.join(job.names)}: {len(images)} image(s) in {seconds:.1f}s on {backend}")
+
+	async def run(self, jobs : list[Job]) -> None:
+		os.makedirs(self.work_directory, exist_ok=True)
+		self.total = len(jobs)
+		queue : asyncio.Queue = asyncio.Queue()
+		for job in jobs:
+			queue.put_nowait((job, 0))
+		with open(os.path.join(self.work_directory, PROGRESS_FILENAME), "a") as self._progress:
+			await asyncio.gather(*[self.worker(queue, backend) for backend in self.backends for _ in range(self.concurrency)])
+
+def write_pack(path : str, jobs : list[Job], finished : dict[str, dict], work_directory : str) -> tuple[int, int]:
+	'''Write every finished job into the pack. Returns the number of names and stored bytes.'''
+	writer = AssetPackWriter(path)
+	count = 0
+	try:
+		for job in jobs:
+			record = finished.get(job.key)
+			if record is None:
+				continue
+			for filename_index, filename in enumerate(record["files"]):
+				with open(os.path.join(work_directory, filename), "rb") as file:
+					data = file.read()
+				for name in job.names:
+					writer.add(name if len(record["files"]) == 1 else f"{name}/{filename_index}", data)
+					count += 1
+	except BaseException:
+		writer.discard()
+		raise
+	writer.close()
+	return count, writer.stored_bytes
+
+def print_report(jobs : list[Job], renderer : Renderer, resumed : int, elapsed : float) -> None:
+	rendered = [renderer.finished[job.key] for job in jobs if job.key in renderer.finished and job.key not in renderer.resumed]
+	images = sum(len(record["files"]) for record in rendered)
+	names = sum(len(job.names) for job in jobs)
+	print()
+	print(f"Jobs: {names} in the manifest, {len(jobs)} unique, {resumed} already done, {len(rendered)} rendered, {len(renderer.failed)} failed.")
+	if len(rendered) == 0:
+		return
+	times = sorted(record["seconds"] for record in rendered)
+	p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+	print(f"Images: {images} in {elapsed:.1f}s ({images * 3600 / elapsed:.0f} images/hour).")
+	print(f"Job time: mean {statistics.mean(times):.1f}s, median {statistics.median(times):.1f}s, p95 {p95:.1f}s, max {times[-1]:.1f}s.")
+	for backend in renderer.backends:
+		backend_times = [record["seconds"] for record in rendered if record["backend"] == backend]
+		if backend_times:
+			print(f"  {backend}: {len(backend_times)} jobs, mean {statistics.mean(backend_times):.1f}s")
+
+async def main(args : argparse.Namespace) -> int:
+	with open(args.manifest, "r") as file:
+		manifest : dict = json.load(file)
+	jobs = load_jobs(manifest, os.path.dirname(os.path.abspath(args.manifest)))
+	work_directory : str = args.work_directory or args.output + ".work"
+	backends : list[str] = args.backend or manifest.get("backends") or [DEFAULT_BACKEND]
+
+	renderer = Renderer(backends, args.concurrency, args.retries, work_directory)
+	renderer.finished = load_progress(work_directory)
+	renderer.resumed = set(renderer.finished)
+	pending = [job for job in jobs if job.key not in renderer.finished]
+	resumed = len(jobs) - len(pending)
+	if resumed > 0:
+		print(f"Resuming: {resumed} of {len(jobs)} jobs are already rendered.")
+
+	started = time.perf_counter()
+	await renderer.run(pending)
+	print_report(jobs, renderer, resumed, time.perf_counter() - started)
+
+	if len(renderer.failed) > 0:
+		print(f"Not writing {args.output}: {len(renderer.failed)} jobs failed. Run again to retry them.")
+		return 1
+	count, stored_bytes = write_pack(args.output, jobs, renderer.finished, work_directory)
+	print(f"Wrote {args.output}: {count} assets, {stored_bytes / 1024 / 1024:.1f}MB of images.")
+	if args.keep_work is False:
+		shutil.rmtree(work_directory)
+	return 0
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Render a manifest of workflows into an asset pack.')
+	parser.add_argument('manifest', help='JSON manifest of the jobs to render')
+	parser.add_argument('output', help='asset pack to write')
+	parser.add_argument('--backend', action='append', help='ComfyUI address (repeat for several backends; defaults to the manifest or 127.0.0.1:8188)')
+	parser.add_argument('--concurrency', type=int, default=1, help='jobs queued at once on each backend')
+	parser.add_argument('--retries', type=int, default=2, help='attempts before a job is given up')
+	parser.add_argument('--work-directory', help='checkpoint directory (default: <output>.work)')
+	parser.add_argument('--keep-work', action='store_true', help='keep the checkpoint directory after the pack is written')
+	raise SystemExit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,157 @@
+'''
+Cheap runtime diagnostics for the proxy, served under /debug when it runs with --debug.
+
+SamplingProfiler reads the stack of every thread from sys._current_frames() a few
+hundred times a second and counts them, so nothing is instrumented and the proxy runs at
+full speed outside a profile. The result is either collapsed stacks (one "a;b;c count"
+line per stack, the input of flamegraph.pl and speedscope) or a pstats dump:
+
+	curl "http://127.0.0.1:12500/debug/profile?seconds=10" > proxy.folded
+	curl "http://127.0.0.1:12500/debug/profile?seconds=10&format=pstats" > proxy.pstats
+	python -m pstats proxy.pstats
+
+Work done in C (PIL encoding, json) is counted against the python function calling it.
+
+LoopLagMonitor measures how late the event loop runs a callback scheduled with a sleep -
+time the loop spent on blocking work instead of serving requests.
+'''
+
+from collections import Counter, deque
+from durations import summarize
+from typing import Optional
+
+import asyncio
+import marshal
+import os
+import sys
+import threading
+import time
+
+# leaf frames of threads which are waiting rather than working
+IDLE_FRAMES : set[tuple[str, str]] = {
+	("threading.py", "wait"),
+	("selectors.py", "select"),
+	("queue.py", "get"),
+	("thread.py", "_worker"),
+}
+
+FrameKey = tuple[str, int, str] # pstats function key: filename, first line, name
+
+class SamplingProfiler:
+	'''Statistical profiler over every thread of the process.'''
+	interval : float
+	include_idle : bool
+
+	def __init__(self, interval : float = 0.005, include_idle : bool = False) -> None:
+		self.interval = interval
+		self.include_idle = include_idle
+		self.stacks : Counter[tuple[str, tuple[FrameKey, ...]]] = Counter()
+		self.samples = 0
+		self.elapsed = 0.0
+
+	def _is_idle(self, key : FrameKey) -> bool:
+		return (os.path.basename(key[0]), key[2]) in IDLE_FRAMES
+
+	def sample(self, seconds : float) -> None:
+		'''Sample for the given number of seconds - blocking, so run it in a thread.'''
+		own_thread : int = threading.get_ident()
+		started : float = time.perf_counter()
+		deadline : float = started + seconds
+		while time.perf_counter() < deadline:
+			names : dict[int, str] = {thread.ident : thread.name for thread in threading.enumerate()}
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_thread:
+					continue
+				stack : list[FrameKey] = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+					frame = frame.f_back
+				if len(stack) == 0 or (self.include_idle is False and self._is_idle(stack[0])):
+					continue
+				stack.reverse()
+				self.stacks[(names.get(thread_id, str(thread_id)), tuple(stack))] += 1
+			self.samples += 1
+			time.sleep(self.interval)
+		self.elapsed = time.perf_counter() - started
+
+	def collapsed(self) -> str:
+		'''One "thread;outer;...;inner count" line per distinct stack.'''
+		lines : list[str] = []
+		for (thread_name, stack), count in self.stacks.most_common():
+			frames = [thread_name] + [f"{os.path.basename(filename)}:{name}" for filename, _, name in stack]
+			lines.append(f"{';'.join(frame.replace(';', ':') for frame in frames)} {count}")
+		return "\n".join(lines) + "\n"
+
+	def pstats_dump(self) -> bytes:
+		'''The samples as a marshalled pstats table; "calls" are the number of samples.'''
+		seconds : float = self.elapsed / max(1, self.samples)
+		stats : dict[FrameKey, list] = {}
+		def entry(key : FrameKey) -> list:
+			if key not in stats:
+				stats[key] = [0, 0, 0.0, 0.0, {}]
+			return stats[key]
+		for (_, stack), count in self.stacks.items():
+			entry(stack[-1])[2] += count * seconds # time in the function itself
+			for key in set(stack): # recursion is counted once per sample
+				record = entry(key)
+				record[0] += count
+				record[1] += count
+				record[3] += count * seconds
+			for caller, callee in set(zip(stack, stack[1:])):
+				callers : dict = entry(callee)[4]
+				calls, primitive, total, cumulative = callers.get(caller, (0, 0, 0.0, 0.0))
+				callers[caller] = (calls + count, primitive + count, total + (count * seconds if callee == stack[-1] else 0.0), cumulative + count * seconds)
+		return marshal.dumps({key : tuple(record) for key, record in stats.items()})
+
+class LoopLagMonitor:
+	'''Measures how late the event loop wakes up from a sleep of `interval` seconds.'''
+	interval : float
+
+	def __init__(self, interval : float = 0.1, window : int = 600) -> None:
+		self.interval = interval
+		self.lags : deque[float] = deque(maxlen=window)
+		self.max_lag = 0.0
+		self._task : Optional[asyncio.Task] = None
+
+	def start(self) -> None:
+		if self._task is None:
+			self._task = asyncio.get_running_loop().create_task(self._run(), name="loop-lag-monitor")
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		while True:
+			expected : float = loop.time() + self.interval
+			await asyncio.sleep(self.interval)
+			lag : float = max(0.0, loop.time() - expected)
+			self.lags.append(lag)
+			self.max_lag = max(self.max_lag, lag)
+
+	def stats(self) -> dict:
+		return {
+			"interval_ms" : round(self.interval * 1000),
+			"last_ms" : round(self.lags[-1] * 1000, 1) if self.lags else None,
+			"window" : summarize(self.lags),
+			"max_since_start_ms" : round(self.max_lag * 1000, 1),
+		}
+
+def describe_awaiting(task : asyncio.Task, limit : int = 8) -> list[str]:
+	'''Where the task is suspended, outermost coroutine first.'''
+	locations : list[str] = []
+	awaitable = task.get_coro()
+	while awaitable is not None and len(locations) < limit:
+		frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None) or getattr(awaitable, "ag_frame", None)
+		if frame is None:
+			if asyncio.isfuture(awaitable):
+				locations.append(f"<{type(awaitable).__name__}>")
+			break
+		locations.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+		awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None) or getattr(awaitable, "ag_await", None)
+	return locations
+
+def pending_tasks() -> list[dict]:
+	'''Every unfinished task of the running event loop.'''
+	return [
+		{"name" : task.get_name(), "coroutine" : getattr(task.get_coro(), "__qualname__", repr(task.get_coro())), "awaiting" : describe_awaiting(task)}
+		for task in asyncio.all_tasks() if task.done() is False
+	]
@@ -0,0 +1,210 @@
+'''
+Server-side prompt compilation for character scenes.
+
+A port of setup.comfyUI_GenerateCurseParameters / comfyUI_GenerateStandardParameters in
+src/imageGeneration.js, so /generate_scene only needs the character data and a scene id.
+Character tags are memoized on the parts of the character state they depend on, and
+every shot of a scene is built into a single ComfyUI workflow sharing one checkpoint
+loader, so the whole scene is queued (and the model loaded) once.
+'''
+
+from functools import lru_cache
+from pydantic import BaseModel, ValidationError
+from typing import Optional
+
+import hashlib
+import json
+import random
+
+PREFIX_POSITIVE_PROMPT : str = "score_9, score_8_up, score_7_up, masterpiece, best quality, cowboy shot, 1girl, solo, source_anime, front view <lora:Dalle3_AnimeStyle_PONY_Lora:1>"
+PREFIX_NEGATIVE_PROMPT : str = "score_5, score_4, pony, ugly, ugly face, poorly drawn face, blurry, blurry face, (3d), realistic, muscular, long torso, blurry eyes, poorly drawn eyes, patreon, artist name, (sd, super deformed),"
+BODY_FITNESS : list[str] = ["fragile body", "weak body", "average body", "fit body", "very fit body"]
+HEIGHT_RANGES : list[tuple[str, int]] = [("dwarf", 150), ("midget", 160), ("short", 170), ("", 183), ("tall", 195)]
+PENIS_SIZES : list[str] = ["small penis", "below average penis", "average penis", "large penis", "huge penis"]
+
+DEFAULT_CHECKPOINT : str = "hassakuXLPony_v13BetterEyesVersion.safetensors"
+DEFAULT_STEPS : int = 20
+DEFAULT_CFG : float = 7.0
+
+# curses which add a fixed tag to the prompt
+CURSE_TAGS : dict[str, str] = {
+	"WrigglyAntennae" : "pink antennae,",
+	"Megadontia" : "sharp teeth,",
+	"FreckleSpeckle" : "freckles,",
+	"KnifeEar" : "pointy ears,",
+	"Horny" : "succubus horns,",
+	"DrawingSpades" : "spade tail,",
+}
+
+# the state values the character tags are built from - anything else does not change the prompt
+PROMPT_STATE_KEYS : list[str] = ["sex", "apparent_age", "height", "hair", "tail", "ears", "eyeColor", "skinColor", "penis_size", "breastsLabel"]
+
+class Shot(BaseModel):
+	'''One image (or batch of identical images) of a scene.'''
+	prompt : str
+	width : int = 1024
+	height : int = 1024
+	count : int = 1
+
+# shots of the scenes the game knows about; scene_params.shots overrides these
+SCENE_PRESETS : dict[str, list[Shot]] = {
+	"portrait" : [Shot(prompt="portrait,upper_body,plain dark background")],
+	"full_body" : [Shot(prompt="full body,standing,plain dark background", width=832, height=1216)],
+	"character_sheet" : [
+		Shot(prompt="portrait,upper_body,plain dark background"),
+		Shot(prompt="full body,standing,plain dark background", width=832, height=1216),
+		Shot(prompt="full body,from behind,plain dark background", width=832, height=1216),
+	],
+}
+
+def height_to_ranged_value(height : float) -> str:
+	for label, max_height in HEIGHT_RANGES:
+		if height < max_height:
+			return label
+	return HEIGHT_RANGES[-1][0]
+
+def character_key(character_data : dict) -> str:
+	'''Canonical key of the character state the prompt depends on.'''
+	state : dict = character_data.get("state", {})
+	return json.dumps({
+		"curses" : sorted(set(character_data.get("curses", []))),
+		"fit" : character_data.get("character", {}).get("fit", 0),
+		"state" : {key : state.get(key) for key in PROMPT_STATE_KEYS},
+	}, sort_keys=True)
+
+def character_tags(character_data : dict) -> tuple[str, str]:
+	'''Positive and negative character tags for the payload of setup.comfyUI_PrepareCharacterData.'''
+	return _character_tags(character_key(character_data))
+
+@lru_cache(maxsize=256)
+def _character_tags(key : str) -> tuple[str, str]:
+	data : dict = json.loads(key)
+	curses : set[str] = set(data["curses"])
+	state : dict = data["state"]
+
+	positive = ""
+	negative = ""
+
+	positive += f"{state['sex']},"
+	positive += f"{max(state['apparent_age'] or 0, 21)} years old,"
+	positive += BODY_FITNESS[max(min((data['fit'] or 0) + 2, 4), 0)] + ","
+	positive += f"{height_to_ranged_value(state['height'] or 0)},"
+	positive += f"{state['hair']} hair,"
+	for tail in state["tail"] or []:
+		positive += f"{state['hair']} {tail} tail,"
+	positive += f"{state['hair']} {state['ears']} ears,"
+
+	# CreatureOfTheNight -> Vampire
+	if "CreatureOfTheNight" in curses:
+		positive += "vampire,fangs,red eyes,glowing eyes,pale skin,"
+	else:
+		positive += f"{state['eyeColor']} eyes,"
+		positive += f"{state['skinColor']} skin,"
+
+	for curse, tag in CURSE_TAGS.items():
+		if curse in curses:
+			positive += tag
+
+	if state["sex"] == "female" and "ClothingRestrictionA" not in curses:
+		positive += "earrings,"
+
+	if "ClothingRestrictionC" not in curses:
+		positive += "adventurer,leather armor,"
+	else:
+		if "ClothingRestrictionB" in curses:
+			positive += "nude,"
+		elif state["sex"] == "female":
+			positive += "bra,panties,"
+		else:
+			positive += "underwear,shirtless,no pants,small penis bulge,"
+
+		if "ClothingRestrictionB" in curses:
+			# NUDE
+			if "Null" in curses:
+				positive += "smooth featureless body, no genitalia, soft abstract body aesthetic without explicit details,"
+			else:
+				if state["sex"] == "female":
+					positive += "succubus tattoo," if "TattooTally" in curses else ""
+					positive += "pussy juice," if "Leaky" in curses else ""
+				else:
+					positive += "incubus tattoo," if "TattooTally" in curses else ""
+					positive += "pre-ejaculation," if "Leaky" in curses else ""
+
+				# lactation (both M/F)
+				lactation = int("LactationRejuvenationA" in curses) + int("LactationRejuvenationB" in curses)
+				if lactation == 2:
+					positive += "milk,lactating,lactation,"
+				elif lactation == 1:
+					positive += "dripping lactation,"
+
+				penis_size = state["penis_size"] or 0
+				if penis_size > 0:
+					positive += PENIS_SIZES[min(penis_size, len(PENIS_SIZES)) - 1] + ","
+
+	positive += f"{state['breastsLabel']} breasts,"
+	return positive, negative
+
+def scene_shots(scene_id : str, scene_params : dict) -> list[Shot]:
+	'''Raises KeyError for an unknown scene and ValueError for invalid scene_params.shots.'''
+	if "shots" in scene_params:
+		shots = scene_params["shots"]
+		if not isinstance(shots, list) or not all(isinstance(shot, dict) for shot in shots):
+			raise ValueError("scene_params.shots must be a list of {prompt, width, height, count} objects.")
+		try:
+			return [Shot(**shot) for shot in shots]
+		except (ValidationError, TypeError) as e:
+			raise ValueError(f"Invalid scene_params.shots: {e}") from None
+	if scene_id not in SCENE_PRESETS:
+		raise KeyError(f"Unknown scene '{scene_id}'. Available scenes: {', '.join(SCENE_PRESETS)}")
+	return SCENE_PRESETS[scene_id]
+
+def shot_positive_prompt(character_positive : str, shot : Shot, prefix : Optional[str] = None, suffix : Optional[str] = None) -> str:
+	positive = PREFIX_POSITIVE_PROMPT + " ,solo," + shot.prompt + "," + character_positive
+	if prefix:
+		positive = prefix + "," + positive
+	if suffix:
+		positive = positive + "," + suffix
+	return positive
+
+def render_key(positive : str, negative : str, shot : Shot, checkpoint : str, steps : int, cfg : float, seed : Optional[int], remove_background : bool) -> str:
+	'''Cache key of one shot render - renders without a requested seed are interchangeable.'''
+	payload = [positive, negative, shot.width, shot.height, shot.count, checkpoint, steps, cfg, seed, remove_background]
+	return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+def shot_seed(seed : Optional[int], index : int) -> Optional[int]:
+	'''Seed of the scene's index-th shot when the scene has a seed.'''
+	return None if seed is None else seed + index
+
+def build_scene_workflow(checkpoint : str, shots : list[tuple[str, Shot, Optional[int]]], negative : str, steps : int = DEFAULT_STEPS, cfg : float = DEFAULT_CFG, remove_background : bool = False) -> tuple[dict, list[str]]:
+	'''
+	Build one workflow rendering every (positive prompt, shot, seed) triple; a None seed is random.
+
+	Returns the workflow and the SaveImage node id of each shot, in order.
+	'''
+	workflow : dict = {
+		"5" : {"inputs" : {"ckpt_name" : checkpoint}, "class_type" : "CheckpointLoaderSimple", "_meta" : {"title" : "Load Checkpoint"}},
+		"10" : {"inputs" : {"text" : negative, "clip" : ["5", 1]}, "class_type" : "CLIPTextEncode", "_meta" : {"title" : "Negative Prompt"}},
+	}
+	save_nodes : list[str] = []
+	for index, (positive, shot, seed) in enumerate(shots):
+		base = 100 + index * 10
+		positive_id, sampler_id, latent_id, decode_id, rembg_id, save_id = (str(base + offset) for offset in range(1, 7))
+		workflow[positive_id] = {"inputs" : {"text" : positive, "clip" : ["5", 1]}, "class_type" : "CLIPTextEncode", "_meta" : {"title" : f"Positive Prompt {index}"}}
+		workflow[latent_id] = {"inputs" : {"width" : shot.width, "height" : shot.height, "batch_size" : shot.count}, "class_type" : "EmptyLatentImage", "_meta" : {"title" : f"Empty Latent Image {index}"}}
+		workflow[sampler_id] = {
+			"inputs" : {
+				"seed" : seed if seed is not None else random.randint(0, 2**32 - 1),
+				"steps" : steps, "cfg" : cfg, "sampler_name" : "euler", "scheduler" : "normal", "denoise" : 1,
+				"model" : ["5", 0], "positive" : [positive_id, 0], "negative" : ["10", 0], "latent_image" : [latent_id, 0]
+			},
+			"class_type" : "KSampler",
+			"_meta" : {"title" : f"KSampler {index}"}
+		}
+		workflow[decode_id] = {"inputs" : {"samples" : [sampler_id, 0], "vae" : ["5", 2]}, "class_type" : "VAEDecode", "_meta" : {"title" : f"VAE Decode {index}"}}
+		image_source = [decode_id, 0]
+		if remove_background:
+			workflow[rembg_id] = {"inputs" : {"threshold" : 0.5, "torchscript_jit" : "default", "image" : [decode_id, 0]}, "class_type" : "InspyrenetRembgAdvanced", "_meta" : {"title" : f"Inspyrenet Rembg Advanced {index}"}}
+			image_source = [rembg_id, 0]
+		workflow[save_id] = {"inputs" : {"filename_prefix" : f"SCENE_{index}_", "images" : image_source}, "class_type" : "SaveImage", "_meta" : {"title" : f"Save Image {index}"}}
+		save_nodes.append(save_id)
+	return workflow, save_nodes
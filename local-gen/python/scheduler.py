@@ -0,0 +1,366 @@
+'''
+Fair sharing of the GPU between the clients of the proxy.
+
+Every generation waits for one of the slots of the ComfyUI backends. Waiting requests
+are ordered by weighted fair queueing: each request gets a virtual finish time of
+max(virtual time, the client's last finish) + cost / weight, and the smallest finish
+time goes next. A client queueing many requests only pushes its own finish times
+further out, so everybody else keeps their share of the GPU.
+
+On top of that each client has quotas: requests running at once, requests waiting,
+and a token bucket limiting requests per minute.
+
+Requests also carry the checkpoints and LoRAs their workflow loads (workflow.model_key).
+Loading another checkpoint takes ComfyUI tens of seconds, so a backend which frees up
+takes a request for the model it already has loaded when one is waiting within
+`fairness_window` of the next request in fair order (in cost / weight units - roughly
+the images of other clients' work it may overtake). Otherwise the next request goes to
+an idle backend, or to the one whose model the waiting requests need least.
+
+Interactive requests name a session (one per character or portrait editor). Only the
+newest request of a session is wanted, so it replaces the client's older requests of the
+same session: queued ones are dropped and a running one is cancelled, which removes it
+from ComfyUI's queue or interrupts it. The GPU time this saves is estimated from the
+average seconds per image of the finished requests.
+'''
+
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from durations import summarize
+from workflow import ModelKey
+
+import asyncio
+import time
+
+STATS_WINDOW : int = 200 # latencies kept per client
+DEFAULT_BACKEND : str = "127.0.0.1:8188"
+FAIRNESS_WINDOW : float = 4.0
+DURATION_SMOOTHING : float = 0.2 # weight of the newest request in the seconds per image average
+
+class ClientQuota:
+	weight : float
+	concurrency : int
+	max_queued : int
+	rate_per_minute : float
+	burst : int
+
+	def __init__(self, weight : float = 1.0, concurrency : int = 1, max_queued : int = 4, rate_per_minute : float = 30.0, burst : int = 5) -> None:
+		self.weight = weight
+		self.concurrency = concurrency
+		self.max_queued = max_queued
+		self.rate_per_minute = rate_per_minute
+		self.burst = burst
+
+class Superseded(Exception):
+	'''A newer request of the same session replaced this one.'''
+
+class QuotaExceeded(Exception):
+	'''The client has to wait `retry_after` seconds before sending another request.'''
+	retry_after : int
+
+	def __init__(self, message : str, retry_after : int) -> None:
+		super().__init__(message)
+		self.retry_after = retry_after
+
+def describe_model(model : Optional[ModelKey]) -> Optional[str]:
+	if model is None:
+		return None
+	checkpoints, loras = model
+	return " + ".join(list(checkpoints) + [f"lora:{lora}" for lora in loras])
+
+class Backend:
+	'''A ComfyUI server and the model it was last given.'''
+	address : str
+	slots : int
+
+	def __init__(self, address : str, slots : int = 1) -> None:
+		self.address = address
+		self.slots = slots
+		self.running = 0
+		self.loaded : Optional[ModelKey] = None
+		self.jobs = 0
+		self.swaps = 0
+		self.swap_seconds = 0.0
+		self.load_seconds = 0.0
+
+class Ticket:
+	client : "Client"
+	cost : float
+	start_tag : float
+	finish_tag : float
+	enqueued_at : float
+	granted : asyncio.Future
+	model : Optional[ModelKey]
+	session : Optional[str]
+
+	def __init__(self, client : "Client", cost : float, start_tag : float, finish_tag : float, model : Optional[ModelKey] = None, session : Optional[str] = None) -> None:
+		self.client = client
+		self.cost = cost
+		self.start_tag = start_tag
+		self.finish_tag = finish_tag
+		self.enqueued_at = time.perf_counter()
+		self.granted = asyncio.get_running_loop().create_future()
+		self.model = model
+		self.backend : Optional[Backend] = None # set when the ticket is granted
+		self.swapped = False # the backend had another model loaded
+		self.load_seconds : Optional[float] = None # time ComfyUI spent in the model loaders, when measured
+		self.session = session
+		self.task : Optional[asyncio.Task] = asyncio.current_task()
+		self.started_at : Optional[float] = None
+		self.superseded = False
+
+	def clear_cancel(self) -> None:
+		'''Call after catching the CancelledError of a superseded ticket, so the task is not cancelled again later.'''
+		if self.task is not None and hasattr(self.task, "uncancel"): # python 3.11+ counts cancel requests
+			self.task.uncancel()
+
+	@property
+	def order(self) -> tuple[float, float]:
+		return self.finish_tag, self.enqueued_at
+
+class Client:
+	id : str
+	quota : ClientQuota
+
+	def __init__(self, id : str, quota : ClientQuota) -> None:
+		self.id = id
+		self.quota = quota
+		self.queue : deque[Ticket] = deque()
+		self.active : set[Ticket] = set()
+		self.running = 0
+		self.last_finish = 0.0
+		self.tokens = float(quota.burst)
+		self.tokens_updated = time.monotonic()
+		self.submitted = 0
+		self.completed = 0
+		self.failed = 0
+		self.rejected = 0
+		self.superseded = 0
+		self.waits : deque[float] = deque(maxlen=STATS_WINDOW)
+		self.latencies : deque[float] = deque(maxlen=STATS_WINDOW)
+
+	def take_token(self) -> None:
+		now = time.monotonic()
+		rate = self.quota.rate_per_minute / 60.0
+		self.tokens = min(float(self.quota.burst), self.tokens + (now - self.tokens_updated) * rate)
+		self.tokens_updated = now
+		if self.tokens < 1.0:
+			raise QuotaExceeded(f"Client '{self.id}' is limited to {self.quota.rate_per_minute:g} requests per minute.", max(1, int((1.0 - self.tokens) / rate + 0.999)))
+		self.tokens -= 1.0
+
+class FairScheduler:
+	default_quota : ClientQuota
+	fairness_window : float
+
+	def __init__(self, capacity : int = 1, default_quota : Optional[ClientQuota] = None, backends : Optional[list[str]] = None, fairness_window : float = FAIRNESS_WINDOW) -> None:
+		'''Up to `capacity` requests are sent to each backend at once.'''
+		self.backends : list[Backend] = [Backend(address, capacity) for address in backends or [DEFAULT_BACKEND]]
+		self.default_quota = default_quota or ClientQuota()
+		self.fairness_window = fairness_window
+		self.clients : dict[str, Client] = {}
+		self.virtual_time = 0.0
+		self.running = 0
+		self.affinity_jumps = 0 # requests run ahead of fair order to avoid a model swap
+		self.seconds_per_cost : Optional[float] = None
+		self.superseded_queued = 0
+		self.superseded_running = 0
+		self.saved_seconds = 0.0 # estimated GPU time not spent on superseded requests
+		self.wasted_seconds = 0.0 # GPU time superseded requests used before they were cancelled
+
+	@property
+	def capacity(self) -> int:
+		return sum(backend.slots for backend in self.backends)
+
+	def client(self, client_id : str, quota : Optional[ClientQuota] = None) -> Client:
+		client = self.clients.get(client_id)
+		if client is None:
+			client = self.clients[client_id] = Client(client_id, quota or self.default_quota)
+		elif quota is not None:
+			client.quota = quota
+		return client
+
+	def _admit(self, client : Client, cost : float, model : Optional[ModelKey], session : Optional[str]) -> Ticket:
+		if len(client.queue) >= client.quota.max_queued:
+			client.rejected += 1
+			raise QuotaExceeded(f"Client '{client.id}' already has {len(client.queue)} requests waiting.", 5)
+		try:
+			client.take_token()
+		except QuotaExceeded:
+			client.rejected += 1
+			raise
+		start_tag = max(self.virtual_time, client.last_finish)
+		ticket = Ticket(client, cost, start_tag, start_tag + cost / client.quota.weight, model, session)
+		client.last_finish = ticket.finish_tag
+		client.queue.append(ticket)
+		client.submitted += 1
+		return ticket
+
+	def _estimate(self, ticket : Ticket) -> float:
+		return ticket.cost * (self.seconds_per_cost or 0.0)
+
+	def _supersede(self, newer : Ticket) -> None:
+		'''Drop the client's older requests of the newer ticket's session.'''
+		client = newer.client
+		for ticket in [ticket for ticket in client.queue if ticket.session == newer.session and ticket is not newer and ticket.granted.done() is False]:
+			client.queue.remove(ticket)
+			ticket.superseded = True
+			client.superseded += 1
+			self.superseded_queued += 1
+			self.saved_seconds += self._estimate(ticket)
+			ticket.granted.set_exception(Superseded("Replaced by a newer request of the same session."))
+		for ticket in [ticket for ticket in client.active if ticket.session == newer.session and ticket.superseded is False]:
+			elapsed = time.perf_counter() - ticket.started_at
+			ticket.superseded = True
+			client.superseded += 1
+			self.superseded_running += 1
+			self.saved_seconds += max(0.0, self._estimate(ticket) - elapsed)
+			self.wasted_seconds += elapsed
+			ticket.task.cancel() # the request cancels its ComfyUI prompt and the slot is released
+
+	def _start(self, ticket : Ticket, backend : Backend) -> None:
+		ticket.client.queue.remove(ticket)
+		ticket.client.active.add(ticket)
+		ticket.started_at = time.perf_counter()
+		self.virtual_time = max(self.virtual_time, ticket.start_tag)
+		self.running += 1
+		ticket.client.running += 1
+		backend.running += 1
+		backend.jobs += 1
+		ticket.backend = backend
+		if ticket.model is not None:
+			ticket.swapped = backend.loaded is not None and backend.loaded != ticket.model
+			backend.swaps += int(ticket.swapped)
+			backend.loaded = ticket.model
+		ticket.granted.set_result(True)
+
+	def _dispatch(self) -> None:
+		while True:
+			free = [backend for backend in self.backends if backend.running < backend.slots]
+			if len(free) == 0:
+				return
+			for client in self.clients.values():
+				for ticket in [ticket for ticket in client.queue if ticket.granted.done()]: # cancelled while waiting
+					client.queue.remove(ticket)
+			candidates = [ticket for client in self.clients.values() if client.running < client.quota.concurrency for ticket in client.queue]
+			if len(candidates) == 0:
+				return
+			first = min(candidates, key=lambda ticket: ticket.order)
+			window = [ticket for ticket in candidates if ticket.finish_tag <= first.finish_tag + self.fairness_window]
+			choice : Optional[tuple[Ticket, Backend]] = None
+			# a backend which has the model of a request in the window loaded runs that request
+			for backend in free:
+				matching = [ticket for ticket in window if ticket.model is not None and ticket.model == backend.loaded]
+				if matching:
+					choice = (min(matching, key=lambda ticket: ticket.order), backend)
+					break
+			if choice is None:
+				# otherwise an empty backend, else the one whose model the waiting requests need least
+				wanted = lambda backend: sum(1 for ticket in window if ticket.model == backend.loaded)
+				choice = (first, min(free, key=lambda backend: (backend.loaded is not None, wanted(backend), backend.running)))
+			if choice[0] is not first:
+				self.affinity_jumps += 1
+			self._start(*choice)
+
+	def _release(self, ticket : Ticket) -> None:
+		self.running -= 1
+		ticket.client.running -= 1
+		ticket.client.active.discard(ticket)
+		ticket.backend.running -= 1
+		if ticket.load_seconds is not None:
+			ticket.backend.load_seconds += ticket.load_seconds
+			if ticket.swapped:
+				ticket.backend.swap_seconds += ticket.load_seconds
+		self._dispatch()
+
+	@asynccontextmanager
+	async def slot(self, client_id : str, cost : float = 1.0, quota : Optional[ClientQuota] = None, model : Optional[ModelKey] = None, session : Optional[str] = None) -> AsyncIterator[Ticket]:
+		'''
+		Wait for the client's turn on a GPU. Yields the granted ticket: run the request on
+		ticket.backend and set ticket.load_seconds if it is known. Raises QuotaExceeded when
+		over a quota and Superseded when a newer request of the session replaces this one -
+		a running request is cancelled then, see Ticket.clear_cancel.
+		'''
+		client = self.client(client_id, quota)
+		ticket = self._admit(client, cost, model, session)
+		if session is not None:
+			self._supersede(ticket)
+		self._dispatch()
+		try:
+			await ticket.granted
+		except asyncio.CancelledError:
+			# the request was dropped while it waited
+			if ticket in client.queue:
+				client.queue.remove(ticket)
+			elif ticket.granted.cancelled() is False:
+				self._release(ticket)
+			if ticket.superseded: # granted, then superseded before it got to run
+				ticket.clear_cancel()
+				raise Superseded("Replaced by a newer request of the same session.") from None
+			raise
+		started = time.perf_counter()
+		client.waits.append(started - ticket.enqueued_at)
+		try:
+			yield ticket
+		except Superseded:
+			raise
+		except asyncio.CancelledError:
+			if ticket.superseded is False:
+				client.failed += 1
+				raise
+			ticket.clear_cancel()
+			raise Superseded("Replaced by a newer request of the same session.") from None
+		except BaseException:
+			client.failed += 1
+			raise
+		else:
+			client.completed += 1
+			client.latencies.append(time.perf_counter() - ticket.enqueued_at)
+			seconds_per_cost = (time.perf_counter() - started) / max(ticket.cost, 1e-6)
+			self.seconds_per_cost = seconds_per_cost if self.seconds_per_cost is None else self.seconds_per_cost + DURATION_SMOOTHING * (seconds_per_cost - self.seconds_per_cost)
+		finally:
+			self._release(ticket)
+
+	def stats(self) -> dict:
+		return {
+			"capacity" : self.capacity,
+			"running" : self.running,
+			"queued" : sum(len(client.queue) for client in self.clients.values()),
+			"fairness_window" : self.fairness_window,
+			"affinity_jumps" : self.affinity_jumps,
+			"swaps" : sum(backend.swaps for backend in self.backends),
+			"swap_seconds" : round(sum(backend.swap_seconds for backend in self.backends), 1),
+			"seconds_per_image" : None if self.seconds_per_cost is None else round(self.seconds_per_cost, 1),
+			"superseded" : {
+				"queued" : self.superseded_queued,
+				"running" : self.superseded_running,
+				"saved_seconds" : round(self.saved_seconds, 1),
+				"wasted_seconds" : round(self.wasted_seconds, 1),
+			},
+			"backends" : {
+				backend.address : {
+					"slots" : backend.slots,
+					"running" : backend.running,
+					"loaded" : describe_model(backend.loaded),
+					"jobs" : backend.jobs,
+					"swaps" : backend.swaps,
+					"swap_seconds" : round(backend.swap_seconds, 1),
+					"load_seconds" : round(backend.load_seconds, 1),
+				} for backend in self.backends
+			},
+			"clients" : {
+				client.id : {
+					"weight" : client.quota.weight,
+					"running" : client.running,
+					"queued" : len(client.queue),
+					"submitted" : client.submitted,
+					"completed" : client.completed,
+					"failed" : client.failed,
+					"rejected" : client.rejected,
+					"superseded" : client.superseded,
+					"wait" : summarize(client.waits),
+					"latency" : summarize(client.latencies),
+				} for client in self.clients.values()
+			},
+		}
@@ -0,0 +1,324 @@
+'''
+ComfyUI API-format workflow graphs.
+
+	{"5" : {"class_type" : "CheckpointLoaderSimple", "inputs" : {"ckpt_name" : "x.safetensors"}},
+	 "9" : {"class_type" : "CLIPTextEncode", "inputs" : {"text" : "...", "clip" : ["5", 1]}}, ...}
+
+Workflows are checked before they are queued - broken links, unknown node classes,
+missing inputs and checkpoints that are not installed are rejected locally instead of
+after a round trip to ComfyUI - and reduced to the nodes that feed an output, with
+identical loaders merged, so less redundant work reaches the GPU.
+'''
+
+from typing import Any, NamedTuple, Optional, Union
+
+import hashlib
+import json
+import time
+
+# used to find the outputs when /object_info is not available
+OUTPUT_NODE_CLASSES : set[str] = {"SaveImage", "PreviewImage", "SaveAnimatedWEBP", "SaveAnimatedPNG", "SaveLatent", "Image Save"}
+OBJECT_INFO_TTL : float = 300.0
+# loader classes -> the input naming the model file they load (see model_key)
+MODEL_LOADER_INPUTS : dict[str, str] = {
+	"CheckpointLoaderSimple" : "ckpt_name",
+	"CheckpointLoader" : "ckpt_name",
+	"LoraLoader" : "lora_name",
+	"LoraLoaderModelOnly" : "lora_name",
+}
+
+ModelKey = tuple[tuple[str, ...], tuple[str, ...]] # (checkpoints, loras)
+
+class WorkflowError(ValueError):
+	'''A workflow which cannot be run, with every problem found.'''
+	problems : list[str]
+
+	def __init__(self, problems : list[str]) -> None:
+		super().__init__("Invalid workflow: " + "; ".join(problems))
+		self.problems = problems
+
+class Link(NamedTuple):
+	node_id : str
+	output : int
+
+class Node:
+	id : str
+	class_type : str
+	inputs : dict[str, Union[Link, Any]]
+	meta : dict
+
+	def __init__(self, id : str, class_type : str, inputs : dict[str, Union[Link, Any]], meta : dict) -> None:
+		self.id = id
+		self.class_type = class_type
+		self.inputs = inputs
+		self.meta = meta
+
+	def links(self) -> list[tuple[str, Link]]:
+		return [(name, value) for name, value in self.inputs.items() if isinstance(value, Link)]
+
+	def signature(self) -> str:
+		'''Class and inputs - nodes with the same signature compute the same thing.'''
+		return json.dumps([self.class_type, {name : list(value) if isinstance(value, Link) else value for name, value in self.inputs.items()}], sort_keys=True, separators=(",", ":"))
+
+def is_link(value : Any) -> bool:
+	return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int) and not isinstance(value[1], bool)
+
+class Workflow:
+	nodes : dict[str, Node]
+
+	def __init__(self, nodes : dict[str, Node]) -> None:
+		self.nodes = nodes
+
+	@staticmethod
+	def parse(data : Any) -> "Workflow":
+		'''Parse an API-format graph. Raises WorkflowError when it is not one.'''
+		if not isinstance(data, dict) or len(data) == 0:
+			raise WorkflowError(["a workflow is a non-empty object of nodes keyed by id (export it with 'Save (API Format)')"])
+		problems : list[str] = []
+		nodes : dict[str, Node] = {}
+		for node_id, node in data.items():
+			if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+				problems.append(f"node {node_id} has no class_type")
+				continue
+			inputs = node.get("inputs", {})
+			if not isinstance(inputs, dict):
+				problems.append(f"node {node_id} ({node['class_type']}) has invalid inputs")
+				continue
+			nodes[str(node_id)] = Node(str(node_id), node["class_type"], {name : Link(*value) if is_link(value) else value for name, value in inputs.items()}, node.get("_meta", {}))
+		if problems:
+			raise WorkflowError(problems)
+		return Workflow(nodes)
+
+	def output_nodes(self, object_info : Optional[dict] = None) -> list[str]:
+		if object_info is not None:
+			return [node.id for node in self.nodes.values() if object_info.get(node.class_type, {}).get("output_node") is True]
+		return [node.id for node in self.nodes.values() if node.class_type in OUTPUT_NODE_CLASSES]
+
+	def validate(self, object_info : Optional[dict] = None) -> None:
+		'''
+		Check links, cycles and outputs - and with /object_info also node classes, required
+		inputs, link types and choices (such as installed checkpoints). Raises WorkflowError.
+		'''
+		problems : list[str] = []
+		for node in self.nodes.values():
+			for name, link in node.links():
+				source = self.nodes.get(link.node_id)
+				if source is None:
+					problems.append(f"node {node.id} ({node.class_type}) input '{name}' links to missing node {link.node_id}")
+				elif object_info is not None and source.class_type in object_info:
+					outputs : list = object_info[source.class_type].get("output", [])
+					if link.output < 0 or link.output >= len(outputs):
+						problems.append(f"node {node.id} ({node.class_type}) input '{name}' uses output {link.output} of {source.class_type}, which has {len(outputs)}")
+			if object_info is not None:
+				problems.extend(self._check_node(node, object_info))
+		if not self.output_nodes(object_info):
+			problems.append("the workflow has no output node (such as SaveImage)")
+		if not problems:
+			try:
+				self.topological_order()
+			except WorkflowError as e:
+				problems.extend(e.problems)
+		if problems:
+			raise WorkflowError(problems)
+
+	def _check_node(self, node : Node, object_info : dict) -> list[str]:
+		info : Optional[dict] = object_info.get(node.class_type)
+		if info is None:
+			return [f"node {node.id} uses unknown class {node.class_type} (is its custom node installed?)"]
+		problems : list[str] = []
+		declared : dict = info.get("input", {})
+		required : dict = declared.get("required", {})
+		specs : dict = {**declared.get("optional", {}), **required}
+		for name in required:
+			if name not in node.inputs:
+				problems.append(f"node {node.id} ({node.class_type}) is missing input '{name}'")
+		for name, value in node.inputs.items():
+			spec = specs.get(name)
+			if not spec:
+				continue
+			kind = spec[0]
+			if isinstance(value, Link):
+				source = self.nodes.get(value.node_id)
+				source_outputs : list = object_info.get(source.class_type, {}).get("output", []) if source is not None else []
+				if isinstance(kind, str) and value.output < len(source_outputs):
+					output_kind = source_outputs[value.output]
+					if "*" not in (kind, output_kind) and kind != output_kind and output_kind not in kind.split(","):
+						problems.append(f"node {node.id} ({node.class_type}) input '{name}' expects {kind} but gets {output_kind} from node {value.node_id}")
+			elif isinstance(kind, list) and len(kind) > 0 and value not in kind:
+				problems.append(f"node {node.id} ({node.class_type}) input '{name}' is {value!r}, which is not one of the {len(kind)} available choices")
+		return problems
+
+	def topological_order(self) -> list[str]:
+		'''Node ids with every node after the nodes it links to. Raises WorkflowError on cycles.'''
+		order : list[str] = []
+		state : dict[str, int] = {} # 1 = visiting, 2 = done
+		for start in sorted(self.nodes):
+			if start in state:
+				continue
+			stack : list[tuple[str, int]] = [(start, 0)]
+			state[start] = 1
+			while stack:
+				node_id, index = stack[-1]
+				links = [link.node_id for _, link in self.nodes[node_id].links() if link.node_id in self.nodes]
+				if index < len(links):
+					stack[-1] = (node_id, index + 1)
+					child = links[index]
+					if state.get(child) == 1:
+						raise WorkflowError([f"nodes {child} and {node_id} form a cycle"])
+					if child not in state:
+						state[child] = 1
+						stack.append((child, 0))
+				else:
+					state[node_id] = 2
+					order.append(node_id)
+					stack.pop()
+		return order
+
+	def prune(self, object_info : Optional[dict] = None) -> list[str]:
+		'''Remove the nodes which do not feed an output and return their ids.'''
+		keep : set[str] = set()
+		pending : list[str] = self.output_nodes(object_info)
+		while pending:
+			node_id = pending.pop()
+			if node_id in keep or node_id not in self.nodes:
+				continue
+			keep.add(node_id)
+			pending.extend(link.node_id for _, link in self.nodes[node_id].links())
+		removed = [node_id for node_id in self.nodes if node_id not in keep]
+		for node_id in removed:
+			del self.nodes[node_id]
+		return removed
+
+	def deduplicate_loaders(self, object_info : Optional[dict] = None) -> dict[str, str]:
+		'''
+		Merge nodes which only have literal inputs (checkpoint/LoRA/VAE loaders, empty latents)
+		and are identical, relinking their users to the first one. Returns {removed : kept}.
+		'''
+		outputs = set(self.output_nodes(object_info))
+		first : dict[str, str] = {}
+		merged : dict[str, str] = {}
+		for node_id in sorted(self.nodes, key=lambda node_id: (len(node_id), node_id)):
+			node = self.nodes[node_id]
+			if node_id in outputs or node.links():
+				continue
+			signature = node.signature()
+			if signature in first:
+				merged[node_id] = first[signature]
+			else:
+				first[signature] = node_id
+		if not merged:
+			return merged
+		for node_id in merged:
+			del self.nodes[node_id]
+		for node in self.nodes.values():
+			for name, link in node.links():
+				if link.node_id in merged:
+					node.inputs[name] = Link(merged[link.node_id], link.output)
+		return merged
+
+	def optimize(self, object_info : Optional[dict] = None) -> tuple[list[str], dict[str, str]]:
+		'''Merge identical loaders, then prune what no longer feeds an output.'''
+		merged = self.deduplicate_loaders(object_info)
+		removed = self.prune(object_info)
+		return removed, merged
+
+	def to_prompt(self, include_meta : bool = False) -> dict:
+		'''The API-format dict to queue, keeping the node ids (the caller maps outputs by them).'''
+		prompt : dict = {}
+		for node_id, node in self.nodes.items():
+			prompt[node_id] = {"inputs" : {name : list(value) if isinstance(value, Link) else value for name, value in node.inputs.items()}, "class_type" : node.class_type}
+			if include_meta and node.meta:
+				prompt[node_id]["_meta"] = node.meta
+		return prompt
+
+	def canonical_json(self) -> str:
+		'''
+		Serialization which is the same for every equivalent workflow: UI-only data dropped,
+		nodes renumbered in a deterministic topological order and keys sorted.
+		'''
+		order = self.topological_order()
+		# order ties by what the node computes rather than by its arbitrary id
+		depth : dict[str, int] = {}
+		for node_id in order:
+			depth[node_id] = 1 + max((depth[link.node_id] for _, link in self.nodes[node_id].links() if link.node_id in depth), default=0)
+		renumbered : dict[str, str] = {}
+		canonical : dict[str, dict] = {}
+		for level in range(1, max(depth.values(), default=0) + 1):
+			# the nodes of a level only link to shallower levels, which already have their new ids
+			level_nodes : list[tuple[str, dict]] = []
+			for node_id in order:
+				if depth[node_id] == level:
+					node = self.nodes[node_id]
+					level_nodes.append((node_id, {
+						"class_type" : node.class_type,
+						"inputs" : {name : [renumbered[value.node_id], value.output] if isinstance(value, Link) else value for name, value in node.inputs.items()},
+					}))
+			for node_id, node in sorted(level_nodes, key=lambda item: json.dumps(item[1], sort_keys=True)):
+				renumbered[node_id] = str(len(renumbered) + 1)
+				canonical[renumbered[node_id]] = node
+		return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+	def canonical_hash(self) -> str:
+		return hashlib.sha256(self.canonical_json().encode("utf-8")).hexdigest()
+
+class ObjectInfoCache:
+	'''/object_info of each backend, refreshed after OBJECT_INFO_TTL seconds.'''
+
+	def __init__(self, ttl : float = OBJECT_INFO_TTL) -> None:
+		self.ttl = ttl
+		self._entries : dict[str, tuple[float, dict]] = {}
+
+	async def get(self, api, refresh : bool = False) -> dict:
+		entry = self._entries.get(api.server_address)
+		if entry is None or refresh or time.monotonic() - entry[0] > self.ttl:
+			entry = (time.monotonic(), await api.fetch_object_info())
+			self._entries[api.server_address] = entry
+		return entry[1]
+
+	def age(self, server_address : str) -> Optional[float]:
+		entry = self._entries.get(server_address)
+		return None if entry is None else time.monotonic() - entry[0]
+
+OBJECT_INFO = ObjectInfoCache()
+
+async def prepare_workflow(api, data : Any) -> dict:
+	'''
+	Parse, validate and optimize a workflow for the given ComfyUI_API backend and
+	return the prompt to queue. Raises WorkflowError.
+	'''
+	workflow = Workflow.parse(data)
+	workflow.validate() # structural problems need no /object_info
+	object_info = await OBJECT_INFO.get(api)
+	try:
+		workflow.validate(object_info)
+	except WorkflowError:
+		# a custom node or model may have been installed since the cache was filled
+		if (OBJECT_INFO.age(api.server_address) or 0) < 5.0:
+			raise
+		object_info = await OBJECT_INFO.get(api, refresh=True)
+		workflow.validate(object_info)
+	removed, merged = workflow.optimize(object_info)
+	if removed or merged:
+		print(f"Workflow: removed {len(removed)} unused nodes, merged {len(merged)} duplicate loaders.")
+	return workflow.to_prompt()
+
+def model_loader_nodes(prompt : dict) -> list[str]:
+	'''The ids of the nodes of a prompt which load checkpoints or LoRAs.'''
+	return [node_id for node_id, node in prompt.items() if node.get("class_type") in MODEL_LOADER_INPUTS]
+
+def model_key(prompt : dict) -> Optional[ModelKey]:
+	'''
+	The checkpoints and LoRAs a prompt loads, or None when it loads none. Prompts with the
+	same key run one after another without ComfyUI swapping models.
+	'''
+	checkpoints : set[str] = set()
+	loras : set[str] = set()
+	for node_id in model_loader_nodes(prompt):
+		node = prompt[node_id]
+		input_name = MODEL_LOADER_INPUTS[node["class_type"]]
+		value = node.get("inputs", {}).get(input_name)
+		if isinstance(value, str):
+			(checkpoints if input_name == "ckpt_name" else loras).add(value)
+	if len(checkpoints) == 0 and len(loras) == 0:
+		return None
+	return tuple(sorted(checkpoints)), tuple(sorted(loras))
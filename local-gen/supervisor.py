@@ -0,0 +1,218 @@
+'''
+Readiness-gated process supervisor for the proxy and ComfyUI.
+
+Children are started in order and each is only considered ready once its health URL
+answers. A child which exits (or, optionally, stops answering its health URL) is
+restarted with exponential backoff. SIGINT/SIGTERM are forwarded to every child and
+the startup-to-ready time of each start is recorded in tools/startup_times.jsonl.
+'''
+
+from typing import Optional
+
+import json
+import os
+import platform
+import requests
+import signal
+import subprocess
+import time
+
+STARTUP_TIMES_FILEPATH : str = "tools/startup_times.jsonl"
+
+class ManagedProcess:
+	'''A child process with a health probe and restart policy.'''
+	name : str
+	args : list[str]
+	cwd : Optional[str]
+	env : Optional[dict[str, str]]
+	health_url : Optional[str]
+	ready_timeout : float
+	unresponsive_timeout : Optional[float]
+
+	process : Optional[subprocess.Popen]
+	ready : bool
+	restarts : int
+
+	def __init__(self, name : str, args : list[str], cwd : Optional[str] = None, env : Optional[dict[str, str]] = None, health_url : Optional[str] = None, ready_timeout : float = 600.0, unresponsive_timeout : Optional[float] = None) -> None:
+		self.name = name
+		self.args = args
+		self.cwd = cwd
+		self.env = env
+		self.health_url = health_url
+		self.ready_timeout = ready_timeout
+		self.unresponsive_timeout = unresponsive_timeout
+		self.process = None
+		self.ready = False
+		self.restarts = 0
+		self._started_at = 0.0
+		self._last_healthy = 0.0
+		self._backoff = 1.0
+		self._restart_at : Optional[float] = None
+
+	def spawn(self) -> None:
+		self.process = subprocess.Popen(self.args, cwd=self.cwd, env=self.env, shell=False)
+		self.ready = False
+		self._started_at = time.monotonic()
+		self._last_healthy = self._started_at
+		print(f"[supervisor] started {self.name} (pid {self.process.pid})")
+
+	def is_running(self) -> bool:
+		return self.process is not None and self.process.poll() is None
+
+	def is_healthy(self) -> bool:
+		if not self.is_running():
+			return False
+		if self.health_url is None:
+			return True
+		try:
+			return requests.get(self.health_url, timeout=2).status_code < 500
+		except requests.RequestException:
+			return False
+
+	def terminate(self) -> None:
+		if not self.is_running():
+			return
+		if platform.system() == "Windows":
+			self.process.terminate()
+		else:
+			os.kill(self.process.pid, signal.SIGTERM)
+
+	def kill(self) -> None:
+		'''Kill the process and reap it.'''
+		if self.process is None:
+			return
+		self.process.kill()
+		try:
+			self.process.wait(timeout=5.0)
+		except subprocess.TimeoutExpired:
+			print(f"[supervisor] {self.name} (pid {self.process.pid}) is still running after being killed.")
+
+class Supervisor:
+	'''Starts, health-checks and restarts a set of ManagedProcess children.'''
+	children : list[ManagedProcess]
+
+	def __init__(self, poll_interval : float = 0.25, health_interval : float = 5.0, max_backoff : float = 30.0, stable_after : float = 60.0, terminate_timeout : float = 10.0) -> None:
+		self.children = []
+		self.terminate_timeout = terminate_timeout
+		self.poll_interval = poll_interval
+		self.health_interval = health_interval
+		self.max_backoff = max_backoff
+		self.stable_after = stable_after
+		self._stopping = False
+		self._created_at = time.monotonic()
+
+	def start(self, child : ManagedProcess, wait_until_ready : bool = True) -> bool:
+		'''Start a child and (optionally) block until its health probe passes.'''
+		self.children.append(child)
+		child.spawn()
+		if wait_until_ready:
+			return self.wait_until_ready(child)
+		return True
+
+	def wait_until_ready(self, child : ManagedProcess) -> bool:
+		deadline = time.monotonic() + child.ready_timeout
+		while time.monotonic() < deadline and not self._stopping:
+			if not child.is_running():
+				print(f"[supervisor] {child.name} exited with code {child.process.returncode} before becoming ready.")
+				return False
+			if child.is_healthy():
+				self._mark_ready(child)
+				return True
+			time.sleep(self.poll_interval)
+		if not self._stopping:
+			print(f"[supervisor] {child.name} did not become ready within {child.ready_timeout:.0f}s.")
+		return False
+
+	def _mark_ready(self, child : ManagedProcess) -> None:
+		child.ready = True
+		child._last_healthy = time.monotonic()
+		elapsed = child._last_healthy - child._started_at
+		print(f"[supervisor] {child.name} is ready ({elapsed:.2f}s after start).")
+		record = {"time" : time.time(), "name" : child.name, "ready_seconds" : round(elapsed, 3), "restarts" : child.restarts}
+		try:
+			os.makedirs(os.path.dirname(STARTUP_TIMES_FILEPATH) or ".", exist_ok=True)
+			with open(STARTUP_TIMES_FILEPATH, "a") as file:
+				file.write(json.dumps(record) + "\n")
+		except OSError:
+			pass
+
+	def stop(self, timeout : float = 10.0) -> None:
+		'''Forward termination to every child, killing any which do not exit in time.'''
+		self._stopping = True
+		for child in self.children:
+			child.terminate()
+		deadline = time.monotonic() + timeout
+		for child in self.children:
+			if child.process is None:
+				continue
+			try:
+				child.process.wait(timeout=max(0.1, deadline - time.monotonic()))
+			except subprocess.TimeoutExpired:
+				print(f"[supervisor] {child.name} did not stop - killing it.")
+				child.kill()
+
+	def _handle_signal(self, signum, frame) -> None:
+		print(f"[supervisor] received signal {signum} - stopping.")
+		self._stopping = True
+
+	def install_signal_handlers(self) -> None:
+		signal.signal(signal.SIGINT, self._handle_signal)
+		signal.signal(signal.SIGTERM, self._handle_signal)
+		if hasattr(signal, "SIGBREAK"):
+			signal.signal(signal.SIGBREAK, self._handle_signal)
+
+	def _check(self, child : ManagedProcess, now : float, probe_health : bool) -> None:
+		if child._restart_at is not None:
+			if now >= child._restart_at:
+				child._restart_at = None
+				child.restarts += 1
+				child.spawn()
+			return
+
+		if child.is_running():
+			if child.ready and now - child._started_at > self.stable_after:
+				child._backoff = 1.0
+			if not probe_health:
+				return
+			if child.is_healthy():
+				if not child.ready:
+					self._mark_ready(child)
+				child._last_healthy = now
+			elif child.ready and child.unresponsive_timeout is not None and now - child._last_healthy > child.unresponsive_timeout:
+				print(f"[supervisor] {child.name} has not responded for {child.unresponsive_timeout:.0f}s - restarting it.")
+				child.terminate()
+				try:
+					child.process.wait(timeout=self.terminate_timeout)
+				except subprocess.TimeoutExpired:
+					# a hung process may ignore SIGTERM
+					print(f"[supervisor] {child.name} did not stop - killing it.")
+					child.kill()
+			else:
+				return
+
+		if not child.is_running():
+			code = child.process.returncode if child.process else None
+			print(f"[supervisor] {child.name} exited with code {code} - restarting in {child._backoff:.0f}s.")
+			child.ready = False
+			child._restart_at = now + child._backoff
+			child._backoff = min(child._backoff * 2, self.max_backoff)
+
+	def run(self) -> None:
+		'''Supervise the children until a termination signal is received.'''
+		ready = [child for child in self.children if child.ready]
+		if len(ready) == len(self.children):
+			print(f"[supervisor] all processes ready ({time.monotonic() - self._created_at:.2f}s since launch).")
+		last_probe = 0.0
+		try:
+			while not self._stopping:
+				now = time.monotonic()
+				probe_health = now - last_probe >= self.health_interval
+				if probe_health:
+					last_probe = now
+				for child in self.children:
+					self._check(child, now, probe_health)
+				time.sleep(self.poll_interval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop()
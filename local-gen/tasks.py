@@ -0,0 +1,227 @@
+'''
+Dependency graph of install steps.
+
+Every step names the steps it needs; a step starts as soon as those have finished, so
+downloads, clones and pip installs run side by side on a thread pool. Steps holding the
+same lock (pip installs into one interpreter) never overlap, and an exclusive step (one
+which asks the user something) runs on its own.
+
+Lines printed by a step are prefixed with its name and a status line lists what is still
+running, so the interleaved output stays readable. A timing table is printed at the end.
+
+Finished steps are recorded in a state file until the whole graph succeeds: running the
+installer again after a failure skips them and continues with the step which failed.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import Lock, local
+from typing import Callable, Optional
+
+import json
+import os
+import sys
+import time
+
+STATUS_INTERVAL : float = 15.0 # seconds between status lines while steps run
+
+def format_seconds(seconds : float) -> str:
+	minutes, seconds = divmod(int(seconds), 60)
+	return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+class Task:
+	name : str
+	run : Callable[[], None]
+	after : list[str]
+	locks : list[str]
+	exclusive : bool
+	key : Optional[str]
+
+	def __init__(self, name : str, run : Callable[[], None], after : Optional[list[str]] = None, locks : Optional[list[str]] = None, exclusive : bool = False, key : Optional[str] = None) -> None:
+		self.name = name
+		self.run = run
+		self.after = after or []
+		self.locks = locks or []
+		self.exclusive = exclusive
+		self.key = key
+		self.status = "pending" # pending, running, done, resumed, failed, skipped
+		self.started : Optional[float] = None
+		self.finished : Optional[float] = None
+		self.error : Optional[BaseException] = None
+
+	@property
+	def seconds(self) -> float:
+		if self.started is None:
+			return 0.0
+		return (self.finished or time.monotonic()) - self.started
+
+class _TaskOutput:
+	'''Stand-in for sys.stdout which prefixes whole lines with the name of the printing task.'''
+
+	def __init__(self, stream) -> None:
+		self.stream = stream
+		self.current = local()
+		self._lock = Lock()
+
+	def write(self, text : str) -> int:
+		# whole lines only, so lines of different threads never run into each other
+		name : Optional[str] = getattr(self.current, "name", None)
+		prefix : str = f"[{name}] " if name else ""
+		buffered : str = getattr(self.current, "buffer", "") + text
+		lines = buffered.split("\n")
+		self.current.buffer = lines.pop()
+		if lines:
+			with self._lock:
+				self.stream.write("".join(f"{prefix}{line}\n" for line in lines))
+		return len(text)
+
+	def flush(self) -> None:
+		name : Optional[str] = getattr(self.current, "name", None)
+		pending : str = getattr(self.current, "buffer", "")
+		with self._lock:
+			if pending:
+				# an input() prompt or a partial line - show it now
+				self.stream.write(f"[{name}] {pending}" if name else pending)
+				self.current.buffer = ""
+			self.stream.flush()
+
+	def __getattr__(self, attribute : str):
+		return getattr(self.stream, attribute)
+
+class TaskGraph:
+	'''Runs tasks concurrently in dependency order.'''
+	state_filepath : Optional[str]
+	max_workers : int
+
+	def __init__(self, state_filepath : Optional[str] = None, max_workers : int = 6) -> None:
+		self.state_filepath = state_filepath
+		self.max_workers = max_workers
+		self.tasks : dict[str, Task] = {}
+		self._completed : dict[str, Optional[str]] = {}
+		self._state_lock = Lock()
+
+	def add(self, name : str, run : Callable[[], None], after : Optional[list[str]] = None, locks : Optional[list[str]] = None, exclusive : bool = False, key : Optional[str] = None) -> Task:
+		'''Add a task; tasks are started in the order they were added once they are ready.'''
+		assert name not in self.tasks, f"Duplicate task {name}."
+		for dependency in after or []:
+			assert dependency in self.tasks, f"Task {name} depends on unknown task {dependency}."
+		task = Task(name, run, after, locks, exclusive, key)
+		self.tasks[name] = task
+		return task
+
+	def _load_state(self) -> dict[str, Optional[str]]:
+		if self.state_filepath is None or os.path.exists(self.state_filepath) is False:
+			return {}
+		try:
+			with open(self.state_filepath, "r") as file:
+				return json.load(file).get("completed", {})
+		except (OSError, ValueError):
+			return {}
+
+	def _save_state(self) -> None:
+		if self.state_filepath is None:
+			return
+		with self._state_lock:
+			os.makedirs(os.path.dirname(self.state_filepath) or ".", exist_ok=True)
+			temp_path = self.state_filepath + ".tmp"
+			with open(temp_path, "w") as file:
+				json.dump({"completed" : self._completed}, file, indent=1)
+			os.replace(temp_path, self.state_filepath)
+
+	def _clear_state(self) -> None:
+		if self.state_filepath is not None and os.path.exists(self.state_filepath):
+			os.remove(self.state_filepath)
+
+	def _execute(self, task : Task, output : _TaskOutput) -> None:
+		output.current.name = task.name
+		try:
+			task.run()
+		finally:
+			output.flush()
+			output.current.name = None
+
+	def _is_ready(self, task : Task, running : dict[Future, Task]) -> bool:
+		if any(self.tasks[dependency].status not in ("done", "resumed") for dependency in task.after):
+			return False
+		held : set[str] = {lock for other in running.values() for lock in other.locks}
+		if any(lock in held for lock in task.locks):
+			return False
+		if task.exclusive:
+			return len(running) == 0
+		return not any(other.exclusive for other in running.values())
+
+	def _print_status(self, running : dict[Future, Task]) -> None:
+		finished = sum(1 for task in self.tasks.values() if task.status in ("done", "resumed"))
+		details = ", ".join(f"{task.name} ({format_seconds(task.seconds)})" for task in running.values())
+		print(f"[install] {finished}/{len(self.tasks)} steps done - running: {details}")
+
+	def run(self) -> bool:
+		'''Run every task. Returns False when any task failed (its dependents are skipped).'''
+		previous : dict[str, Optional[str]] = self._load_state()
+		for task in self.tasks.values():
+			if task.name in previous and previous[task.name] == task.key:
+				task.status = "resumed"
+				self._completed[task.name] = task.key
+		resumed = [task.name for task in self.tasks.values() if task.status == "resumed"]
+		if resumed:
+			print(f"[install] Resuming - already finished: {', '.join(resumed)}")
+
+		output = _TaskOutput(sys.stdout)
+		sys.stdout = output
+		started = time.monotonic()
+		running : dict[Future, Task] = {}
+		try:
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				while True:
+					for task in self.tasks.values():
+						if task.status == "pending" and any(self.tasks[dependency].status in ("failed", "skipped") for dependency in task.after):
+							task.status = "skipped"
+					pending = [task for task in self.tasks.values() if task.status == "pending"]
+					ready_exclusive = any(task.exclusive and all(self.tasks[dependency].status in ("done", "resumed") for dependency in task.after) for task in pending)
+					for task in pending:
+						if len(running) >= self.max_workers:
+							break
+						# a waiting question goes before any new work so it is not starved
+						if ready_exclusive and task.exclusive is False:
+							continue
+						if self._is_ready(task, running):
+							task.status = "running"
+							task.started = time.monotonic()
+							print(f"[install] Starting {task.name}")
+							running[executor.submit(self._execute, task, output)] = task
+					if len(running) == 0:
+						break
+					finished, _ = wait(list(running.keys()), timeout=STATUS_INTERVAL, return_when=FIRST_COMPLETED)
+					if len(finished) == 0:
+						self._print_status(running)
+						continue
+					for future in finished:
+						task = running.pop(future)
+						task.finished = time.monotonic()
+						task.error = future.exception()
+						if task.error is None:
+							task.status = "done"
+							self._completed[task.name] = task.key
+							self._save_state()
+							print(f"[install] Finished {task.name} in {format_seconds(task.seconds)}")
+						else:
+							task.status = "failed"
+							print(f"[install] FAILED {task.name} after {format_seconds(task.seconds)}: {task.error!r}")
+		finally:
+			output.flush()
+			sys.stdout = output.stream
+
+		self.print_timings(time.monotonic() - started)
+		if all(task.status in ("done", "resumed") for task in self.tasks.values()):
+			self._clear_state()
+			return True
+		print("Some install steps failed. Run the installer again to continue from the failed steps.")
+		return False
+
+	def print_timings(self, elapsed : float) -> None:
+		print("="*20)
+		print(f"{'Step':<32} {'Status':<8} {'Time':>8}")
+		for task in self.tasks.values():
+			print(f"{task.name:<32} {task.status:<8} {format_seconds(task.seconds) if task.started else '-':>8}")
+		work = sum(task.seconds for task in self.tasks.values())
+		print(f"Install took {format_seconds(elapsed)} for {format_seconds(work)} of work.")
+		print("="*20)
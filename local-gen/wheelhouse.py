@@ -0,0 +1,150 @@
+'''
+Local wheel cache ("wheelhouse") for the installer's pip steps.
+
+Wheels are kept under tools/wheelhouse/<platform>-<device>, e.g. linux-x86_64-cp310-cuda,
+since the torch builds differ per device. A pip step first installs offline with
+--no-index --find-links from that folder. When a package is missing, "pip wheel"
+downloads (or builds) the wheels of the whole requirement set into the folder once and
+the install is retried offline, so a reinstall never downloads the same gigabytes twice.
+
+One machine can provision others by exporting its wheelhouse and importing it there:
+	python wheelhouse.py list
+	python wheelhouse.py export wheels.zip [--key linux-x86_64-cp310-cuda]
+	python wheelhouse.py import wheels.zip
+'''
+
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Optional
+
+import argparse
+import os
+import subprocess
+import zipfile
+
+WHEELHOUSE_DIRECTORY : str = "tools/wheelhouse"
+PLATFORM_SCRIPT : str = "import sys, sysconfig; print(f'{sysconfig.get_platform()}-cp{sys.version_info[0]}{sys.version_info[1]}')"
+
+def run_shell(command : str) -> int:
+	print(command)
+	return subprocess.run(command, shell=True).returncode
+
+class Wheelhouse:
+	'''Per platform and device folders of wheels which pip installs from offline.'''
+	root : str
+
+	def __init__(self, root : str = WHEELHOUSE_DIRECTORY, run : Callable[[str], int] = run_shell) -> None:
+		self.root = Path(os.path.abspath(root)).as_posix()
+		self.run = run
+		self._platforms : dict[str, Optional[str]] = {}
+		self._locks : dict[str, Lock] = {}
+		self._locks_lock = Lock()
+
+	def platform_of(self, python_command : str) -> Optional[str]:
+		'''Platform and python version tag of the interpreter, e.g. win-amd64-cp310.'''
+		if python_command not in self._platforms:
+			try:
+				result = subprocess.run([python_command, "-c", PLATFORM_SCRIPT], capture_output=True, text=True, timeout=60)
+				self._platforms[python_command] = result.stdout.strip() if result.returncode == 0 else None
+			except (OSError, subprocess.TimeoutExpired):
+				self._platforms[python_command] = None
+		return self._platforms[python_command]
+
+	def directory(self, python_command : str, device : str) -> Optional[str]:
+		platform = self.platform_of(python_command)
+		if platform is None:
+			return None
+		return Path(os.path.join(self.root, f"{platform}-{device}")).as_posix()
+
+	def _lock(self, directory : str) -> Lock:
+		with self._locks_lock:
+			return self._locks.setdefault(directory, Lock())
+
+	def install(self, python_command : str, arguments : str, device : str, install_arguments : str = "") -> int:
+		'''
+		pip install `arguments` (requirements, -r files, index urls) from the wheelhouse,
+		filling it first when something is missing. `install_arguments` are only given to
+		pip install (e.g. --target). Returns the pip exit status.
+		'''
+		pip : str = f"\"{python_command}\" -m pip"
+		directory = self.directory(python_command, device)
+		if directory is None:
+			print(f"Unable to tell the platform of {python_command} - installing without the wheelhouse.")
+			return self.run(f"{pip} install {install_arguments} {arguments}")
+		offline : str = f"{pip} install --no-index --find-links \"{directory}\" {install_arguments} {arguments}"
+		with self._lock(directory):
+			# with the packages already installed an offline install succeeds without any wheels,
+			# so an empty folder is filled anyway - it is what gets exported to other computers
+			has_wheels : bool = os.path.isdir(directory) and any(name.endswith(".whl") for name in os.listdir(directory))
+			if has_wheels and self.run(offline) == 0:
+				return 0
+			print(f"Downloading the missing wheels into {directory}.")
+			os.makedirs(directory, exist_ok=True)
+			if self.run(f"{pip} wheel --wheel-dir \"{directory}\" --find-links \"{directory}\" {arguments}") == 0:
+				return self.run(offline)
+		print("Unable to fill the wheelhouse - installing straight from the package index.")
+		return self.run(f"{pip} install {install_arguments} {arguments}")
+
+	def keys(self) -> list[str]:
+		if os.path.isdir(self.root) is False:
+			return []
+		return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+	def wheels(self, key : str) -> list[str]:
+		directory = os.path.join(self.root, key)
+		return sorted(name for name in os.listdir(directory) if name.endswith(".whl"))
+
+	def export(self, filepath : str, keys : Optional[list[str]] = None) -> int:
+		'''Write the wheels of the given keys (default: all) to a zip. Returns the number of wheels.'''
+		count = 0
+		temp_path = filepath + ".tmp"
+		# wheels are already compressed
+		with zipfile.ZipFile(temp_path, "w", compression=zipfile.ZIP_STORED) as archive:
+			for key in keys or self.keys():
+				for name in self.wheels(key):
+					archive.write(os.path.join(self.root, key, name), f"{key}/{name}")
+					count += 1
+		os.replace(temp_path, filepath)
+		return count
+
+	def import_archive(self, filepath : str) -> int:
+		'''Add the wheels of an exported zip, keeping wheels already present. Returns the number added.'''
+		count = 0
+		with zipfile.ZipFile(filepath, "r") as archive:
+			for member in archive.namelist():
+				parts = member.split("/")
+				if len(parts) != 2 or parts[1].endswith(".whl") is False or parts[0] in ("", ".", ".."):
+					continue # only <key>/<wheel> entries, nothing outside the wheelhouse
+				target = os.path.join(self.root, parts[0], parts[1])
+				if os.path.exists(target):
+					continue
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				with archive.open(member) as source, open(target + ".tmp", "wb") as destination:
+					while True:
+						data = source.read(1024 * 1024)
+						if not data:
+							break
+						destination.write(data)
+				os.replace(target + ".tmp", target)
+				count += 1
+		return count
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Manage the installer\'s local wheel cache.')
+	parser.add_argument('command', choices=['list', 'export', 'import'])
+	parser.add_argument('archive', nargs='?', help='(export/import) zip file')
+	parser.add_argument('--key', action='append', help='(export) only this platform-device folder; repeatable')
+	parser.add_argument('--root', default=WHEELHOUSE_DIRECTORY)
+	args = parser.parse_args()
+
+	wheelhouse = Wheelhouse(args.root)
+	if args.command == 'list':
+		for key in wheelhouse.keys():
+			size = sum(os.path.getsize(os.path.join(wheelhouse.root, key, name)) for name in wheelhouse.wheels(key))
+			print(f"{key:<40} {len(wheelhouse.wheels(key)):>5} wheels {size / 1_000_000:>10.2f} MB")
+	elif args.archive is None:
+		parser.error(f"{args.command} needs the zip file")
+	elif args.command == 'export':
+		print(f"Exported {wheelhouse.export(args.archive, args.key)} wheels to {args.archive}.")
+	elif args.command == 'import':
+		print(f"Imported {wheelhouse.import_archive(args.archive)} new wheels from {args.archive}.")
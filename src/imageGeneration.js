@@ -659,7 +659,7 @@ setup.ComfyUI_GenerateAdvancedHTMLPage = function() {
 }
 
 setup.updateComfyUIStatus = async function() {
-	const url = "http://127.0.0.1:12500/echo";
+	const url = setup.proxyAddress() + "/echo";
 
 	var is_running = false;
 
@@ -676,14 +676,20 @@ setup.updateComfyUIStatus = async function() {
 	notificationElement.style.color = is_running ? "green" : "red"
 }
 
-setup.comfyUI_InvokeGenerator = async function(url, payload) {
+setup.comfyUI_InvokeGenerator = async function(url, payload, session) {
 	// console.log(url, JSON.stringify(payload));
 
+	// a newer request of the same session makes the proxy cancel this one
+	const headers = {'Origin' : 'AbyssDiver.html', 'Content-Type': 'application/json'};
+	if (session != null) {
+		headers['X-Session-Id'] = session;
+	}
+
 	var response = null;
 	try {
 		response = await fetch(url, {
 			method: 'POST',
-			headers: {'Origin' : 'AbyssDiver.html', 'Content-Type': 'application/json'},
+			headers: setup.proxyHeaders(headers),
 			body: JSON.stringify(payload)
 		});
 	} catch (error) {
@@ -691,7 +697,23 @@ setup.comfyUI_InvokeGenerator = async function(url, payload) {
 	}
 
 	if (!response.ok) {
-		throw new Error('Failed to connect to Proxy. Please check your Proxy and ensure the server is running.');
+		// the proxy explains what went wrong (invalid workflow, ComfyUI down, over the client quota, ...)
+		let detail = null;
+		let superseded = false;
+		try {
+			const body = await response.json();
+			detail = body.detail;
+			superseded = body.superseded == true;
+		} catch (error) {}
+		if (response.status == 409 && superseded) {
+			const error = new Error(detail);
+			error.superseded = true;
+			throw error;
+		}
+		if (response.status == 429) {
+			throw new Error('The proxy is busy with other players. Try again in ' + (response.headers.get('Retry-After') || 'a few') + ' seconds. ' + (detail || ''));
+		}
+		throw new Error(detail || 'Failed to connect to Proxy. Please check your Proxy and ensure the server is running.');
 	}
 
 	const data = await response.json();
@@ -940,22 +962,48 @@ setup.comfyUI_GeneratePortraitWorkflow = async function() {
 
 // http://127.0.0.1:12500/generate_image
 var is_generation_busy = false;
+var generation_session = null; // session of the running ComfyUI generation
+var generation_request = 0;
 var last_workflow = null;
-setup.comfyUI_GeneratePortrait = async function() {
-	const notificationElement = document.getElementById('notification');
 
-	if (is_generation_busy) {
+// Returns the number of the new request, or null when another generation is running.
+// Requesting the running session again replaces its request - the proxy cancels the old one.
+setup.comfyUI_BeginGeneration = function(session, notificationElement) {
+	if (is_generation_busy && generation_session != session) {
 		console.log("generation busy");
 		notificationElement.style.display = "block";
 		notificationElement.textContent = "An image is already being generated.";
-		return;
+		return null;
 	}
 	is_generation_busy = true;
+	generation_session = session;
+	generation_request += 1;
+	return generation_request;
+}
+
+// Returns false when a newer request replaced this one - its result is not wanted anymore.
+setup.comfyUI_EndGeneration = function(request) {
+	if (request != generation_request) {
+		return false;
+	}
+	is_generation_busy = false;
+	generation_session = null;
+	return true;
+}
+
+setup.comfyUI_GeneratePortrait = async function() {
+	const notificationElement = document.getElementById('notification');
+
+	const session = "portrait";
+	const request = setup.comfyUI_BeginGeneration(session, notificationElement);
+	if (request == null) {
+		return;
+	}
 
 	notificationElement.style.display = "none";
 
 	// data to be sent to comfyui
-	const url = "http://127.0.0.1:12500/generate_workflow"
+	const url = setup.proxyAddress() + "/generate_workflow"
 
 	// log outputted workflow
 	// console.log(workflow);
@@ -970,10 +1018,12 @@ setup.comfyUI_GeneratePortrait = async function() {
 		// }
 		// workflow was updated
 		last_workflow = JSON.stringify(workflow);
-		data = await setup.comfyUI_InvokeGenerator(url, workflow);
+		data = await setup.comfyUI_InvokeGenerator(url, workflow, session);
 	} catch (error) {
+		if (setup.comfyUI_EndGeneration(request) == false || error.superseded) {
+			return; // replaced by a newer portrait request
+		}
 		console.error('Unable to invoke ComfyUI generator: ', error);
-		is_generation_busy = false;
 		notificationElement.style.display = "block";
 		notificationElement.textContent = "Unable to contact the ComfyUI proxy. Make sure the Python code is running! Check the one-click installer terminal. " + error;
 		return;
@@ -981,17 +1031,19 @@ setup.comfyUI_GeneratePortrait = async function() {
 
 	// console.log(data);
 
+	if (setup.comfyUI_EndGeneration(request) == false) {
+		return; // replaced by a newer portrait request
+	}
+
 	// check if we actually received any images
 	if (data.images == null || data.images.length == 0) {
 		console.error('No images returned from server. This might be due to an issue with the Stable Diffusion model or the server.');
-		is_generation_busy = false;
 		notificationElement.style.display = "block";
 		notificationElement.textContent = "No images were returned from the proxy! Is ComfyUI running? Check the one-click installer terminal.";
 		return;
 	}
 
 	// once we receive the image, save it as the player portrait
-	is_generation_busy = false;
 
 	var storeKey = "generatedImage";
 	var b64Image = data.images[0];
@@ -1006,58 +1058,69 @@ setup.comfyUI_GeneratePortrait = async function() {
 	}
 }
 
-/*
-	// TODO: future update (also edit return to be the raise Error)
+setup.comfyUI_PrepareSceneData = function(scene_id, scene_params) {
+	// prompts for the scene are compiled by the proxy (local-gen/python/prompts.py)
+	const params = Object.assign({'remove_background' : SugarCube.State.variables.DisableTransparentPortraitBackground != true}, scene_params);
+	return {'scene_id' : scene_id, 'scene_params' : params, 'prefix' : setup.customPromptPrefix, 'suffix' : setup.customPromptSuffix};
+}
 
-	setup.comfyUI_PrepareSceneData = async function(scene_id, scene_params) {
-		return {'scene_id' : scene_id, 'scene_params' : scene_params}
-	}
+// http://127.0.0.1:12500/generate_scene
+setup.comfyUI_GenerateCharacterScene = async function(scene_id, scene_params) {
+	// notification element
+	const notificationElement = document.getElementById('notification');
 
-	// http://127.0.0.1:12500/generate_scene
-	setup.comfyUI_GenerateCharacterScene = async function(scene_id, scene_params) {
-		if (is_generation_busy) {
-			return;
-		}
-		is_generation_busy = true;
+	const session = "scene:" + scene_id;
+	const request = setup.comfyUI_BeginGeneration(session, notificationElement);
+	if (request == null) {
+		return;
+	}
 
-		// notification element
-		const notificationElement = document.getElementById('notification');
+	notificationElement.style.display = "none";
 
-		// data to be sent to comfyui
-		const url = "http://127.0.0.1:12500/generate_scene";
+	// data to be sent to comfyui
+	const url = setup.proxyAddress() + "/generate_scene";
 
-		// prepare Payload
-		const payload = {'character' : setup.comfyUI_PrepareCharacterData(), 'scene' : setup.comfyUI_PrepareSceneData(scene_id, scene_params)}
+	// asking again for a scene the player already has means a new image, not the proxy's cached render
+	const has_image = await setup.queryImageDB(scene_id).then(() => true, () => false);
+	if (has_image) {
+		scene_params = Object.assign({'refresh' : true}, scene_params);
+	}
 
-		// inspect payload
-		console.log(payload);
+	// prepare payload
+	const payload = {'character' : setup.comfyUI_PrepareCharacterData(), 'scene' : setup.comfyUI_PrepareSceneData(scene_id, scene_params)};
 
-		// request to the proxy to generate the portrait
-		let data = null;
-		try {
-			data = await setup.comfyUI_InvokeGenerator(url, {'character' : payload});
-		} catch (error) {
-			console.error('Unable to invoke ComfyUI generator.');
-			is_generation_busy = false;
-			return;
+	// request to the proxy to generate the scene
+	let data = null;
+	try {
+		data = await setup.comfyUI_InvokeGenerator(url, payload, session);
+	} catch (error) {
+		if (setup.comfyUI_EndGeneration(request) == false || error.superseded) {
+			return; // replaced by a newer request for this scene
 		}
+		console.error('Unable to invoke ComfyUI generator: ', error);
+		notificationElement.style.display = "block";
+		notificationElement.textContent = "Unable to contact the ComfyUI proxy. Make sure the Python code is running! Check the one-click installer terminal. " + error;
+		return;
+	}
 
-		// check if we actually received any images
-		if (data.images == null || data.images.length == 0) {
-			console.error('No images returned from server. This might be due to an issue with the proxy server or ComfyUI!');
-			notificationElement.textContent = 'Error generating image: ' + error.message + (error.response ? (await error.response.json()).error : 'No additional error information from OpenAI.');
-			notificationElement.style.display = 'block';
-			is_generation_busy = false;
-			return;
-		}
+	if (setup.comfyUI_EndGeneration(request) == false) {
+		return; // replaced by a newer request for this scene
+	}
 
-		// once we receive the images, save it under the key
-		const storeKey = scene_id;
-		const b64Images = data.images; // Assuming the images are returned as base64 strings
-		console.log("Base64 Data Length: ", b64Images.reduce((sum, str) => sum + str.length, 0));
-		setup.storeImage(storeKey, b64Images)
-			.then(() => console.log('Image successfully stored.'))
-			.finally(() => is_generation_busy)
-			.catch((error) => console.error('Failed to store image:', error));
+	// check if we actually received any images
+	if (data.images == null || data.images.length == 0) {
+		console.error('No images returned from server. This might be due to an issue with the proxy server or ComfyUI!');
+		notificationElement.style.display = "block";
+		notificationElement.textContent = "No images were returned from the proxy! Is ComfyUI running? Check the one-click installer terminal.";
+		return;
 	}
-*/
+
+	// once we receive the images, save them under the scene id
+	console.log("Base64 Data Length: ", data.images.reduce((sum, str) => sum + str.length, 0), "(" + data.cached + " cached shots)");
+	try {
+		await setup.storeImage(scene_id, data.images);
+		console.log('Images successfully stored.');
+	} catch (error) {
+		console.error('Failed to store images:', error);
+	}
+}
@@ -468,6 +468,11 @@ Setting.addToggle("ComfyUIGeneration", {
     default: false,
 });
 
+Setting.addToggle("ProxyImageStore", {
+    label: "Keep generated images in the one-click proxy's image store instead of the browser's storage. The proxy has to be running to show them.",
+    default: false,
+});
+
 // Setting.addToggle("ReForgeGeneration", {
 //     label: "Allow for the creation of portraits using Stable Diffusion WebUI ReForge.",
 //     default: false,
@@ -1379,7 +1384,99 @@ Object.defineProperties(JSON, {
     }
 })
 
+// Address of the one-click proxy - another computer's address when sharing its GPU over the network.
+setup.proxyAddress = function () {
+    return (settings.ProxyAddress || "http://127.0.0.1:12500").replace(/\/+$/, "");
+};
+
+// Identify this browser to the proxy, which shares the GPU fairly between its players.
+setup.proxyHeaders = function (headers) {
+    if (!setup.proxyClientId) {
+        try {
+            setup.proxyClientId = localStorage.getItem("abyssDiverClientId");
+        } catch (e) { /* empty */ }
+        if (!setup.proxyClientId) {
+            setup.proxyClientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+            try {
+                localStorage.setItem("abyssDiverClientId", setup.proxyClientId);
+            } catch (e) { /* empty */ }
+        }
+    }
+    const result = Object.assign({"X-Client-Id": setup.proxyClientId}, headers);
+    if (settings.ProxyToken) {
+        result["X-Client-Token"] = settings.ProxyToken;
+    }
+    return result;
+};
+
+setup.base64ToBytes = function (base64) {
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+};
+
+setup.bytesToBase64 = function (bytes) {
+    let binary = "";
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+};
+
+// Store bytes (or a string) in the proxy's content-addressed blob store and return their hash.
+setup.blobStorePut = async function (data, contentType) {
+    const response = await fetch(setup.proxyAddress() + "/blobs", {
+        method: "POST",
+        headers: setup.proxyHeaders({"Content-Type": contentType || "application/octet-stream"}),
+        body: data
+    });
+    if (!response.ok) {
+        throw new Error("The blob store rejected the upload (" + response.status + ").");
+    }
+    return (await response.json()).hash;
+};
+
+setup.blobStoreGet = async function (hash) {
+    const response = await fetch(setup.proxyAddress() + "/blobs/" + hash, {headers: setup.proxyHeaders()});
+    if (!response.ok) {
+        throw new Error("Blob " + hash + " is not available (" + response.status + ").");
+    }
+    return new Uint8Array(await response.arrayBuffer());
+};
+
+// Replace base64 images (or arrays of them) with references into the blob store.
+setup.offloadImages = async function (images) {
+    if (Array.isArray(images)) {
+        return Promise.all(images.map(setup.offloadImages));
+    }
+    if (typeof images !== "string") {
+        return images;
+    }
+    return { blob: await setup.blobStorePut(setup.base64ToBytes(images), "image/png") };
+};
+
+setup.restoreImages = async function (images) {
+    if (Array.isArray(images)) {
+        return Promise.all(images.map(setup.restoreImages));
+    }
+    if (images && typeof images === "object" && images.blob) {
+        return setup.bytesToBase64(await setup.blobStoreGet(images.blob));
+    }
+    return images;
+};
+
 setup.storeImage = async function (key, base64Image) {
+    if (settings.ProxyImageStore) {
+        try {
+            base64Image = await setup.offloadImages(base64Image);
+        } catch (error) {
+            console.warn("The proxy's image store is unavailable, keeping the image in the browser:", error);
+        }
+    }
+
     const dbName = "ImagesDB";
     const storeName = "images";
     const dbVersion = 5; // Define a version number for your database
@@ -1450,7 +1547,7 @@ setup.queryImageDB = async function (key) {
             request.onsuccess = function () {
                 const imageData = request.result;
                 if (imageData && imageData.image) {
-                    resolve(imageData.image); // Return the base64 image
+                    setup.restoreImages(imageData.image).then(resolve, reject); // Return the base64 image
                 } else {
                     reject("No base64 image data found.");
                 }
@@ -0,0 +1,133 @@
+// Template for the loader build.py --lazy adds to the story. The passages of the lazy
+// source files are compiled into bundles/*.js and added to the story with Story.add()
+// the first time the player is about to reach one of them. A bundle is loaded together
+// with the bundles its passages <<include>> (manifest.dependencies).
+
+(function () {
+    const manifest = /* MANIFEST */ { bundles: {}, passages: {}, dependencies: {} };
+    const loadingPassage = "Lazy Bundle Loading";
+    const loading = {};
+    const loaded = {};
+
+    window.abyssDiverRegisterBundle = function (bundle, passages) {
+        if (typeof Story.add !== "function") {
+            console.error("Lazy passage bundles need SugarCube 2.37 or newer (Story.add).");
+            return;
+        }
+        for (const passage of passages) {
+            if (!Story.has(passage.name)) {
+                Story.add(passage);
+            }
+        }
+        loaded[bundle] = true;
+    };
+
+    // The bundle and every bundle it includes passages from, directly or through another bundle.
+    function withDependencies(bundle) {
+        const needed = [bundle];
+        for (let index = 0; index < needed.length; index++) {
+            for (const dependency of manifest.dependencies[needed[index]] || []) {
+                if (!needed.includes(dependency)) {
+                    needed.push(dependency);
+                }
+            }
+        }
+        return needed;
+    }
+
+    // The bundle to load before the passage can be shown, or null once it and its dependencies are loaded.
+    function bundleOf(passageName) {
+        const bundle = manifest.passages[passageName];
+        return bundle && withDependencies(bundle).some(needed => !loaded[needed]) ? bundle : null;
+    }
+
+    function loadOne(bundle) {
+        if (!loading[bundle]) {
+            loading[bundle] = new Promise((resolve, reject) => {
+                // a script tag rather than fetch() so the game still works from file://
+                const script = document.createElement("script");
+                script.src = "bundles/" + manifest.bundles[bundle];
+                script.onload = resolve;
+                script.onerror = () => {
+                    delete loading[bundle];
+                    script.remove();
+                    reject(new Error("Unable to load passage bundle " + manifest.bundles[bundle]));
+                };
+                document.head.appendChild(script);
+            });
+        }
+        return loading[bundle];
+    }
+
+    function load(bundle) {
+        return Promise.all(withDependencies(bundle).map(loadOne));
+    }
+
+    setup.lazyBundles = { manifest, bundleOf, load };
+
+    // Show a loading passage while the destination's bundle downloads, then continue to it.
+    const override = Config.navigation.override;
+    let pending = null;
+    Config.navigation.override = function (destPassage) {
+        const result = typeof override === "function" ? override(destPassage) : undefined;
+        const bundle = bundleOf(result || destPassage);
+        if (!bundle) {
+            return result;
+        }
+        pending = result || destPassage;
+        load(bundle).then(() => {
+            const destination = pending;
+            pending = null;
+            if (State.passage !== loadingPassage) {
+                return; // the player went elsewhere while the bundle loaded
+            }
+            // Drop the loading moment so Back and restored sessions never land on it,
+            // keeping the variables set on the way (e.g. by the link that was clicked).
+            const variables = clone(State.variables);
+            if (typeof State.pop === "function") {
+                State.pop();
+            } else {
+                Engine.backward();
+            }
+            Object.assign(State.variables, variables);
+            Engine.play(destination);
+        }, error => {
+            pending = null;
+            console.error(error);
+            UI.alert(error.message);
+        });
+        return loadingPassage;
+    };
+
+    // Passages shown without navigating (restored sessions, loaded saves) are re-rendered once loaded.
+    $(document).on(":passageinit", ev => {
+        if (ev.passage.name === loadingPassage && pending === null) {
+            // a loading moment saved by an older build - nothing will continue from it
+            setTimeout(() => Engine.backward(), 0);
+            return;
+        }
+        const bundle = bundleOf(ev.passage.name);
+        if (bundle) {
+            load(bundle).then(() => Engine.play(ev.passage.name, true), console.error);
+        }
+    });
+
+    // Prefetch the bundles the current passage links to, so following a link rarely has to wait.
+    $(document).on(":passagedisplay", () => {
+        const bundles = new Set();
+        $("#passages [data-passage]").each(function () {
+            const bundle = bundleOf(this.getAttribute("data-passage"));
+            if (bundle) {
+                bundles.add(bundle);
+            }
+        });
+        for (const bundle of bundles) {
+            load(bundle).then(() => {
+                $("#passages .link-broken[data-passage]")
+                    .filter(function () { return Story.has(this.getAttribute("data-passage")); })
+                    .removeClass("link-broken")
+                    .addClass("link-internal");
+            }, console.error);
+        }
+    });
+})();
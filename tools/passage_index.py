@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""Persistent passage and link index of src/*.twee.
+
+The index is a SQLite database with a full-text table of every passage and the links,
+<<goto>>/<<include>> targets and macro uses found in them, plus the string literals of
+src/*.js (the scripts reach passages through Engine.play() and navigation overrides). It is refreshed incrementally
+(files whose size and mtime are unchanged are skipped, and files whose hash is unchanged
+are not re-parsed), so queries stay in the millisecond range:
+
+    python tools/passage_index.py backlinks "Layer1 1"
+    python tools/passage_index.py links "Layer1 1"
+    python tools/passage_index.py orphans
+    python tools/passage_index.py search "crystal NEAR/5 flask"
+    python tools/passage_index.py widgets
+    python tools/passage_index.py widgets InventoryGrid
+"""
+
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+import time
+
+from twee import SPECIAL_PASSAGES, STRING_LITERAL, expression_pattern, read_passages
+
+ROOT = Path(__file__).resolve().parent.parent
+SOURCE_DIRECTORY = ROOT / "src"
+INDEX_PATH = Path(__file__).resolve().parent / "passage-index.sqlite"
+SCHEMA_VERSION = 2
+
+LINK = re.compile(r"\[\[(.+?)\]\]")
+MACRO_TARGET = re.compile(r"<<(goto|include)\s+(?:\"([^\"]+)\"|'([^']+)'|\[\[([^\]]+)\]\]|`([^`]+)`)")
+LINK_MACRO = re.compile(r"<<(?:link|button)\s+(?:\"[^\"]*\"|'[^']*')\s+(?:\"([^\"]+)\"|'([^']+)')\s*>>")
+DATA_PASSAGE = re.compile(r"(@?)data-passage\s*=\s*(?:\"([^\"]+)\"|'([^']+)')")
+TEMPLATE_PLACEHOLDER = re.compile(r"\$\{[^}]*\}")
+CONCATENATION = re.compile(r"[\"']\s*\+|\+\s*[\"']")
+ENGINE_PLAY = re.compile(r"Engine\.play\(\s*(?:\"([^\"]+)\"|'([^']+)')")
+MACRO = re.compile(r"<<([A-Za-z][\w-]*)")
+WIDGET_DEFINITION = re.compile(r"<<widget\s+(?:\"([^\"]+)\"|'([^']+)')")
+
+# tags of passages SugarCube reaches on its own, which are never orphans
+ENTRY_TAGS = {"init", "script", "stylesheet", "widget", "start"}
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT);
+CREATE TABLE IF NOT EXISTS passages (id INTEGER PRIMARY KEY, name TEXT, file TEXT, line INTEGER, offset INTEGER, tags TEXT, metadata TEXT, bytes INTEGER);
+CREATE INDEX IF NOT EXISTS passages_name ON passages (name);
+CREATE INDEX IF NOT EXISTS passages_file ON passages (file);
+CREATE TABLE IF NOT EXISTS refs (passage_id INTEGER, kind TEXT, target TEXT);
+CREATE INDEX IF NOT EXISTS refs_target ON refs (target, kind);
+CREATE INDEX IF NOT EXISTS refs_passage ON refs (passage_id);
+CREATE TABLE IF NOT EXISTS widgets (name TEXT, passage_id INTEGER);
+CREATE TABLE IF NOT EXISTS script_refs (file TEXT, line INTEGER, kind TEXT, target TEXT);
+CREATE INDEX IF NOT EXISTS script_refs_target ON script_refs (target);
+CREATE VIRTUAL TABLE IF NOT EXISTS passage_text USING fts5 (name, tags, body);
+PRAGMA user_version = {SCHEMA_VERSION};
+"""
+
+
+def link_target(inner):
+    """The passage a [[link]] leads to: [[Text|Target]], [[Text->Target]], [[Target<-Text]] or [[Target]]."""
+    inner = inner.split("][", 1)[0]  # drop a setter component
+    if "|" in inner:
+        return inner.rsplit("|", 1)[1]
+    if "->" in inner:
+        return inner.rsplit("->", 1)[1]
+    if "<-" in inner:
+        return inner.split("<-", 1)[0]
+    return inner
+
+
+def template_pattern(value):
+    """Regex of the names a template literal value such as `${_name} Overview` can produce."""
+    parts = []
+    for index, literal in enumerate(TEMPLATE_PLACEHOLDER.split(value)):
+        if index > 0:
+            parts.append("_value")
+        if literal:
+            parts.append(json.dumps(literal))
+    return expression_pattern(" + ".join(parts))
+
+
+def extract_references(body):
+    """Yield (kind, target) for every link, goto, include and macro use in a passage body.
+
+    Targets built from an expression are stored as a regex with kind "link-pattern",
+    "goto-pattern" or "include-pattern" when their literal parts are distinctive enough.
+    """
+    for match in LINK.finditer(body):
+        yield "link", link_target(match.group(1)).strip()
+    for match in LINK_MACRO.finditer(body):
+        yield "link", match.group(1) or match.group(2)
+    for match in DATA_PASSAGE.finditer(body):
+        value = match.group(2) or match.group(3)
+        if match.group(1) or CONCATENATION.search(value) or "${" in value:
+            # @data-passage and 'Take on ' + _name are expressions, ${...} is filled in by a template literal
+            pattern = template_pattern(value) if "${" in value else expression_pattern(value)
+            if pattern is not None:
+                yield "link-pattern", pattern.pattern
+            continue
+        yield "link", value
+    for match in ENGINE_PLAY.finditer(body):
+        yield "goto", match.group(1) or match.group(2)
+    for match in MACRO_TARGET.finditer(body):
+        kind, expression = match.group(1), match.group(5)
+        if expression is None:
+            yield kind, (match.group(2) or match.group(3) or link_target(match.group(4) or "")).strip()
+            continue
+        pattern = expression_pattern(expression)
+        if pattern is not None:
+            yield f"{kind}-pattern", pattern.pattern
+    for name in set(MACRO.findall(body)):
+        yield "macro", name
+
+
+class PassageIndex:
+    """SQLite full-text index of the passages in a source directory."""
+
+    def __init__(self, path=INDEX_PATH, source_directory=SOURCE_DIRECTORY):
+        self.path = Path(path)
+        self.source_directory = Path(source_directory)
+        self.connection = sqlite3.connect(str(self.path))
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] not in (0, SCHEMA_VERSION):
+            self.connection.close()
+            self.path.unlink()
+            self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def source_files(self):
+        return sorted(path for path in self.source_directory.rglob("*") if path.suffix in (".twee", ".tw", ".js"))
+
+    def _remove_file(self, key):
+        ids = [row[0] for row in self.connection.execute("SELECT id FROM passages WHERE file = ?", (key,))]
+        self.connection.executemany("DELETE FROM passage_text WHERE rowid = ?", ((i,) for i in ids))
+        self.connection.executemany("DELETE FROM refs WHERE passage_id = ?", ((i,) for i in ids))
+        self.connection.executemany("DELETE FROM widgets WHERE passage_id = ?", ((i,) for i in ids))
+        self.connection.execute("DELETE FROM passages WHERE file = ?", (key,))
+        self.connection.execute("DELETE FROM script_refs WHERE file = ?", (key,))
+
+    def _index_script(self, path, key):
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                for match in STRING_LITERAL.finditer(line):
+                    literal = match.group(1) if match.group(1) is not None else match.group(2)
+                    if 1 < len(literal) <= 200:
+                        self.connection.execute("INSERT INTO script_refs (file, line, kind, target) VALUES (?, ?, 'literal', ?)", (key, line_number, literal))
+                    # markup the script wikifies, e.g. '<<include "Wetting Events">>'
+                    references = {(kind, target) for kind, target in extract_references(literal) if kind != "macro"}
+                    self.connection.executemany("INSERT INTO script_refs (file, line, kind, target) VALUES (?, ?, ?, ?)", ((key, line_number, kind, target) for kind, target in references))
+
+    def _index_file(self, path, key):
+        if path.suffix == ".js":
+            self._index_script(path, key)
+            return
+        for passage in read_passages(path):
+            body = passage.text
+            cursor = self.connection.execute(
+                "INSERT INTO passages (name, file, line, offset, tags, metadata, bytes) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (passage.name, key, passage.line, passage.offset, " ".join(passage.tags), json.dumps(passage.metadata), len(body.encode("utf-8")))
+            )
+            passage_id = cursor.lastrowid
+            self.connection.execute("INSERT INTO passage_text (rowid, name, tags, body) VALUES (?, ?, ?, ?)", (passage_id, passage.name, " ".join(passage.tags), body))
+            self.connection.executemany("INSERT INTO refs (passage_id, kind, target) VALUES (?, ?, ?)", ((passage_id, kind, target) for kind, target in extract_references(body)))
+            if "widget" in passage.tags:
+                widgets = {match.group(1) or match.group(2) for match in WIDGET_DEFINITION.finditer(body)}
+                self.connection.executemany("INSERT INTO widgets (name, passage_id) VALUES (?, ?)", ((name, passage_id) for name in widgets))
+
+    def update(self):
+        """Re-index the files which changed since the last update. Returns (files, changed)."""
+        known = {row[0] : row[1:] for row in self.connection.execute("SELECT path, size, mtime_ns, sha256 FROM files")}
+        files = self.source_files()
+        changed = 0
+        with self.connection:
+            seen = set()
+            for path in files:
+                key = path.relative_to(self.source_directory).as_posix()
+                seen.add(key)
+                stat = path.stat()
+                record = known.get(key)
+                if record is not None and record[:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                digest = hashlib.sha256(path.read_bytes()).hexdigest()
+                if record is None or record[2] != digest:
+                    self._remove_file(key)
+                    self._index_file(path, key)
+                    changed += 1
+                self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)", (key, stat.st_size, stat.st_mtime_ns, digest))
+            for key in set(known) - seen:
+                self._remove_file(key)
+                self.connection.execute("DELETE FROM files WHERE path = ?", (key,))
+                changed += 1
+        return len(files), changed
+
+    def backlinks(self, name):
+        """Passages (and script lines) which link to, go to or include the named passage, directly or through a name pattern."""
+        rows = list(self.connection.execute(
+            "SELECT DISTINCT p.name, p.file, p.line, r.kind FROM refs r JOIN passages p ON p.id = r.passage_id WHERE r.target = ? AND r.kind IN ('link', 'goto', 'include') ORDER BY p.file, p.line",
+            (name,)
+        ))
+        rows += list(self.connection.execute("SELECT DISTINCT '<script>', file, line, 'script' FROM script_refs WHERE target = ? AND kind NOT LIKE '%-pattern' ORDER BY file, line", (name,)))
+        for source, file, line, kind, pattern in self.connection.execute(
+            "SELECT p.name, p.file, p.line, r.kind, r.target FROM refs r JOIN passages p ON p.id = r.passage_id WHERE r.kind IN ('link-pattern', 'goto-pattern', 'include-pattern') "
+            "UNION ALL SELECT '<script>', file, line, 'script', target FROM script_refs WHERE kind LIKE '%-pattern'"
+        ):
+            if re.fullmatch(pattern, name):
+                rows.append((source, file, line, kind))
+        return rows
+
+    def links(self, name):
+        """Everything the named passage links to, goes to or includes."""
+        return list(self.connection.execute(
+            "SELECT r.kind, r.target FROM refs r JOIN passages p ON p.id = r.passage_id WHERE p.name = ? AND r.kind != 'macro' ORDER BY r.kind, r.target",
+            (name,)
+        ))
+
+    def orphans(self):
+        """Passages nothing refers to, not counting the special passages and tags SugarCube uses on its own."""
+        targets = {row[0] for row in self.connection.execute("SELECT DISTINCT target FROM refs WHERE kind IN ('link', 'goto', 'include') UNION SELECT target FROM script_refs WHERE kind NOT LIKE '%-pattern'")}
+        patterns = [re.compile(row[0]) for row in self.connection.execute(
+            "SELECT DISTINCT target FROM refs WHERE kind IN ('link-pattern', 'goto-pattern', 'include-pattern') UNION SELECT target FROM script_refs WHERE kind LIKE '%-pattern'"
+        )]
+        orphans = []
+        for name, file, line, tags in self.connection.execute("SELECT name, file, line, tags FROM passages ORDER BY file, line"):
+            if name in targets or name in SPECIAL_PASSAGES or ENTRY_TAGS.intersection(tags.split()):
+                continue
+            if any(pattern.fullmatch(name) for pattern in patterns):
+                continue
+            orphans.append((name, file, line))
+        return orphans
+
+    def search(self, query, limit=20):
+        """Full-text search over passage names, tags and text (FTS5 query syntax)."""
+        return list(self.connection.execute(
+            "SELECT p.name, p.file, p.line, snippet(passage_text, 2, '[', ']', '...', 12) FROM passage_text JOIN passages p ON p.id = passage_text.rowid WHERE passage_text MATCH ? ORDER BY rank LIMIT ?",
+            (query, limit)
+        ))
+
+    def widgets(self, name=None):
+        """Widget definitions with their number of uses, or the passages using one widget."""
+        if name is None:
+            return list(self.connection.execute(
+                "SELECT w.name, p.name, (SELECT COUNT(*) FROM refs r WHERE r.kind = 'macro' AND r.target = w.name) FROM widgets w JOIN passages p ON p.id = w.passage_id ORDER BY w.name"
+            ))
+        return list(self.connection.execute(
+            "SELECT p.name, p.file, p.line FROM refs r JOIN passages p ON p.id = r.passage_id WHERE r.kind = 'macro' AND r.target = ? ORDER BY p.file, p.line",
+            (name,)
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index src/*.twee and query passages, links and widgets.")
+    parser.add_argument("--index", default=str(INDEX_PATH), help="index database path")
+    parser.add_argument("--no-update", action="store_true", help="query the index without refreshing it first")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="create or refresh the index")
+    commands.add_parser("backlinks", help="passages referring to a passage").add_argument("name")
+    commands.add_parser("links", help="references made by a passage").add_argument("name")
+    commands.add_parser("orphans", help="passages nothing refers to")
+    search_parser = commands.add_parser("search", help="full-text search")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=20)
+    commands.add_parser("widgets", help="widget definitions, or the uses of one widget").add_argument("name", nargs="?")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = PassageIndex(args.index)
+    if not args.no_update or args.command == "build":
+        files, changed = index.update()
+        if args.command == "build" or changed:
+            print(f"Indexed {files} files ({changed} changed) in {(time.perf_counter() - started) * 1000:.0f} ms.")
+    queried = time.perf_counter()
+
+    if args.command == "backlinks":
+        for source, file, line, kind in index.backlinks(args.name):
+            print(f"{file}:{line}  {source}  ({kind})")
+    elif args.command == "links":
+        for kind, target in index.links(args.name):
+            print(f"{kind:<16} {target}")
+    elif args.command == "orphans":
+        for name, file, line in index.orphans():
+            print(f"{file}:{line}  {name}")
+    elif args.command == "search":
+        try:
+            results = index.search(args.query, args.limit)
+        except sqlite3.OperationalError as e:
+            parser.exit(1, f"Invalid search query: {e}. Quote phrases with double quotes and see https://www.sqlite.org/fts5.html#full_text_query_syntax\n")
+        for name, file, line, snippet in results:
+            print(f"{file}:{line}  {name}\n    {' '.join(snippet.split())}")
+    elif args.command == "widgets":
+        if args.name is None:
+            for widget, passage, uses in index.widgets():
+                print(f"{widget:<32} {uses:>5} uses  (defined in {passage})")
+        else:
+            for name, file, line in index.widgets(args.name):
+                print(f"{file}:{line}  {name}")
+    if args.command != "build":
+        print(f"({(time.perf_counter() - queried) * 1000:.1f} ms)")
+    index.close()
@@ -1,55 +1,9 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
-import json
-import re
-
-def parse_header(line):
-    assert line.startswith("::")
-    i = 2
-    name_chars = []
-    tag_chars = []
-    chars = name_chars
-    while i < len(line):
-        ch = line[i]
-        i += 1
-        if ch == "[":
-            assert chars is name_chars
-            chars = tag_chars
-        elif ch == "]":
-            break
-        elif ch == "{":
-            i -= 1
-            break
-        elif ch == "\\":
-            ch = line[i]
-            i += 1
-        chars.append(ch)
-
-    name = "".join(name_chars).strip()
-    tags = "".join(tag_chars[1:]).split()
-    if i == len(line):
-        metadata = {}
-    else:
-        metadata = json.loads(line[i:])
-
-    return name, tags, metadata
-
-
-def split_passages(lines):
-    header = None
-    body = []
-    for line in lines:
-        line = line.rstrip()
-        if line.startswith("::"):
-            if header is not None:
-                yield header, body
-            header = parse_header(line)
-            body = []
-        else:
-            body.append(line)
-    if header is not None:
-        yield header, body
+import os
+import time
+
+from twee import AtomicWriter, escape, read_passages
 
 
 def classify_passage(name, tags, metadata):
@@ -82,44 +36,50 @@ def classify_passage(name, tags, metadata):
     return "global.twee"
 
 
-def escape(s):
-    s = s.replace("\\", "\\\\")
-    s = s.replace("[", "\\[").replace("]", "\\]")
-    s = s.replace("{", "\\{").replace("}", "\\}")
-    return s
-
-
-def split_file(path):
-    passages_by_filename = defaultdict(list)
-    with open(path, "r") as f:
-        for header, body in split_passages(f):
-            filename = classify_passage(*header)
+def format_passage(filename, name, tags, body):
+    lines = []
+    if filename.endswith(".twee"):
+        tags = set(tags)
+        tags.discard("new")
+        tags.discard("altered")
+        if tags:
+            tags_str = " ".join(escape(tag) for tag in sorted(tags))
+            lines.append(f":: {escape(name)} [{tags_str}]")
+        else:
+            lines.append(f":: {escape(name)}")
+    lines.extend(body)
+    return "".join(line + "\n" for line in lines)
+
+
+def split_file(path, directory="src"):
+    """Split a Twine export into the src files, only rewriting the files whose content changed."""
+    started = time.perf_counter()
+    writers = {}
+    try:
+        for passage in read_passages(path):
+            filename = classify_passage(passage.name, passage.tags, passage.metadata)
+            body = [line.rstrip() for line in passage.body.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
             while body and not body[-1]:
                 del body[-1]
-            passages_by_filename[filename].append((header, body))
-
-    for filename, passages in passages_by_filename.items():
-        print(f"Writing: {filename}")
-        first = True
-        with open(f"src/{filename}", "w") as out:
-            for (name, tags, metadata), body in passages:
-                if first:
-                    first = False
-                else:
-                    print("", file=out)
-                    print("", file=out)
-                if filename.endswith(".twee"):
-                    tags = set(tags)
-                    tags.discard("new")
-                    tags.discard("altered")
-                    if tags:
-                        tags_str = " ".join(escape(tag) for tag in sorted(tags))
-                        print(f":: {escape(name)} [{tags_str}]", file=out)
-                    else:
-                        print(f":: {escape(name)}", file=out)
-                for line in body:
-                    print(line, file=out)
-                
+            writer = writers.get(filename)
+            if writer is None:
+                writer = writers[filename] = AtomicWriter(os.path.join(directory, filename))
+            else:
+                writer.write("\n\n")
+            writer.write(format_passage(filename, passage.name, passage.tags, body))
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        raise
+
+    unchanged = 0
+    for filename, writer in writers.items():
+        if writer.commit():
+            print(f"Writing: {filename}")
+        else:
+            unchanged += 1
+    print(f"{len(writers) - unchanged} files written, {unchanged} unchanged ({time.perf_counter() - started:.2f}s).")
+
 
 if __name__ == "__main__":
     split_file("all.twee")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Streaming Twee 3 parser.
+
+Passages are read one line at a time and yielded as soon as the next header is seen,
+so arbitrarily large exports never have to be held in memory. Every passage keeps its
+raw header line and body together with its offset in the source, and concatenating
+the `source` of everything `iter_passages` yields reproduces the input exactly.
+"""
+
+from typing import Iterable, Iterator, NamedTuple, Optional
+import json
+import os
+import re
+
+HEADER = re.compile(
+    r"::(?P<name>(?:\\.|[^\\\[{\r\n])*)"
+    r"(?:\[(?P<tags>(?:\\.|[^\\\]\r\n])*)\])?"
+    r"[ \t]*(?P<metadata>\{.*?)?[ \t]*(?:\r\n|\n|\r)?$"
+)
+ESCAPED = re.compile(r"\\(.)")
+SPECIAL = re.compile(r"([\\\[\]{}])")
+# passages SugarCube uses on its own
+SPECIAL_PASSAGES = {
+    "StoryInit", "StoryData", "StoryTitle", "StoryAuthor", "StorySubtitle", "StoryCaption", "StoryBanner", "StoryMenu",
+    "StoryInterface", "StoryShare", "PassageReady", "PassageDone", "PassageHeader", "PassageFooter",
+}
+STRING_LITERAL = re.compile(r'"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'')
+
+
+class Passage(NamedTuple):
+    name: Optional[str]  # None for the text before the first header
+    tags: list
+    metadata: dict
+    header: str  # the raw header line, including its line ending
+    body: str  # the raw text up to the next header
+    offset: int  # character offset of the header in the source
+    line: int  # 1-based line number of the header
+
+    @property
+    def source(self):
+        return self.header + self.body
+
+    @property
+    def text(self):
+        """The passage text the way Tweego compiles it: LF line endings, trailing whitespace removed."""
+        return self.body.replace("\r\n", "\n").rstrip()
+
+
+def unescape(s):
+    return ESCAPED.sub(r"\1", s)
+
+
+def escape(s):
+    return SPECIAL.sub(r"\\\1", s)
+
+
+def parse_header(line, line_number=0):
+    """Return the name, tags and metadata of a `:: Name [tags] {metadata}` line."""
+    match = HEADER.match(line)
+    if match is None:
+        raise ValueError(f"line {line_number}: not a passage header: {line.rstrip()!r}")
+    name = unescape(match["name"]).strip()
+    tags = unescape(match["tags"]).split() if match["tags"] else []
+    metadata = {}
+    if match["metadata"]:
+        try:
+            metadata = json.loads(match["metadata"])
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: invalid passage metadata: {e}") from None
+    return name, tags, metadata
+
+
+def iter_passages(lines: Iterable[str]) -> Iterator[Passage]:
+    """Yield the passages of Twee source given as lines which keep their line endings.
+
+    Open files with newline="" so CRLF sources round-trip unchanged.
+    """
+    header = None
+    name, tags, metadata = None, [], {}
+    body = []
+    offset = start = 0
+    line_number = start_line = 1
+    for line in lines:
+        if line.startswith("::"):
+            if header is not None or body:
+                yield Passage(name, tags, metadata, header or "", "".join(body), start, start_line)
+            name, tags, metadata = parse_header(line, line_number)
+            header = line
+            body = []
+            start = offset
+            start_line = line_number
+        else:
+            body.append(line)
+        offset += len(line)
+        line_number += 1
+    if header is not None or body:
+        yield Passage(name, tags, metadata, header or "", "".join(body), start, start_line)
+
+
+def read_passages(path) -> Iterator[Passage]:
+    """Stream the passages of a .twee file, skipping any text before the first header."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for passage in iter_passages(f):
+            if passage.name is not None:
+                yield passage
+
+
+def expression_pattern(expression):
+    """Turn a passage name expression such as `_item.name + " Description"` into a regex of the names it can produce.
+
+    Returns None when the expression has too little literal text to tell anything apart.
+    """
+    parts = []
+    literal_length = 0
+    for part in expression.split("+"):
+        match = STRING_LITERAL.fullmatch(part.strip())
+        if match is None:
+            if not parts or parts[-1] != ".*":
+                parts.append(".*")
+            continue
+        literal = match.group(1) if match.group(1) is not None else match.group(2)
+        parts.append(re.escape(literal))
+        literal_length += len(literal)
+    if literal_length < 3:
+        return None
+    return re.compile("".join(parts))
+
+
+def format_header(name, tags=(), metadata=None):
+    header = f":: {escape(name)}"
+    if tags:
+        header += " [" + " ".join(escape(tag) for tag in tags) + "]"
+    if metadata:
+        header += " " + json.dumps(metadata)
+    return header
+
+
+class AtomicWriter:
+    """Write a file through a temporary file which only replaces the target when the content differs.
+
+    Files whose content did not change keep their mtime, so editors, watchers and the
+    build cache do not see a change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.temp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.temp_path, "w", encoding="utf-8", newline="")
+
+    def write(self, s):
+        self.file.write(s)
+
+    def commit(self):
+        """Close the file and return True if the target was replaced."""
+        self.file.close()
+        if same_content(self.temp_path, self.path):
+            os.remove(self.temp_path)
+            return False
+        os.replace(self.temp_path, self.path)
+        return True
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+def same_content(a, b, chunk_size=1 << 20):
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            while True:
+                chunk = fa.read(chunk_size)
+                if chunk != fb.read(chunk_size):
+                    return False
+                if not chunk:
+                    return True
+    except FileNotFoundError:
+        return False